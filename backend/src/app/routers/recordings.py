@@ -8,6 +8,17 @@ from ..dependencies import get_db, get_current_user_dependency
 from .. import crud, schemas
 from ..models import User
 
+# Media types for the containers the recorders can write
+AUDIO_MEDIA_TYPES = {
+    ".wav": "audio/wav",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+    ".opus": "audio/ogg",
+    ".mp3": "audio/mpeg",
+}
+# Suffix of the speech-to-text derivative written next to each recording
+STT_SUFFIX = "_16k.wav"
+
 router = APIRouter(
     prefix="/recordings",
     tags=["recordings"]
@@ -76,9 +87,10 @@ def get_recording_audio(
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Audio file not found")
 
+    extension = os.path.splitext(recording.filename)[1].lower()
     return FileResponse(
         file_path,
-        media_type="audio/mpeg",
+        media_type=AUDIO_MEDIA_TYPES.get(extension, "audio/mpeg"),
         filename=recording.filename
     )
 
@@ -133,9 +145,12 @@ def delete_recording(
         raise HTTPException(status_code=404, detail="Recording not found")
 
     file_path = os.path.join("/recordings", recording.filename)
+    # The recorders keep a 16 kHz derivative next to each recording for STT
+    stt_path = os.path.splitext(file_path)[0] + STT_SUFFIX
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        for path in (file_path, stt_path):
+            if os.path.exists(path):
+                os.remove(path)
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Failed to delete audio file: {str(e)}")
@@ -14,6 +14,7 @@ class TranscriptSegment(BaseModel):
     text: str
     start: datetime
     end: datetime
+    confidence: Optional[float] = None
 
 
 class RecordingBase(BaseModel):
@@ -78,7 +78,7 @@ function RecordingCard({ recording }) {
   const handleTranscriptDownload = () => {
     downloadFile(
       `/recordings/${recording.id}/transcript`,
-      recording.filename.replace('.wav', '.txt')
+      recording.filename.replace(/\.[^.]+$/, '.txt')
     );
   };
 
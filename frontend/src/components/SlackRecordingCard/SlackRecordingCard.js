@@ -81,7 +81,7 @@ function SlackRecordingCard({ recording }) {
   const handleTranscriptDownload = () => {
     downloadFile(
       `/recordings/${recording.id}/transcript`,
-      recording.filename.replace('.wav', '.txt')
+      recording.filename.replace(/\.[^.]+$/, '.txt')
     );
   };
 
@@ -5,6 +5,7 @@ import logging
 
 from main import GoogleMeetRecorder
 from state import RecorderState, set_state, get_state
+from scheduler import scheduler
 
 app = FastAPI()
 logger = logging.getLogger("google_recorder_api")
@@ -24,6 +25,20 @@ def get_recorder_state():
     return {"state": get_state()}
 
 
+@app.get("/scheduler")
+def get_scheduler_metrics():
+    """Queue depth and waiting time of outbound API requests per provider"""
+    return {"scheduler": scheduler.metrics()}
+
+
+@app.get("/jobs")
+def get_job_metrics():
+    """Post-processing jobs per state, retries, backlog age and stage timings"""
+    if recorder is None:
+        raise HTTPException(status_code=503, detail="Recorder not initialized")
+    return {"jobs": recorder.jobs.metrics()}
+
+
 @app.on_event("startup")
 def startup_event():
     global recorder
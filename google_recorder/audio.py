@@ -1,77 +1,300 @@
 import os
+import glob
 import platform
 import logging
 import pyaudio
 import soundfile as sf
 import numpy
+import threading
+import subprocess
 import time
 
+from segments import (OUTPUT_FORMATS, OUTPUT_FORMAT, STT_SUFFIX,
+                      SEGMENTS_SUFFIX, MANIFEST_NAME, SegmentManifest,
+                      SegmentedWriter, finalize_recording)
+
 logger = logging.getLogger(__name__)
 
+CHUNK = 1024
+FORMAT = pyaudio.paFloat32
+CHANNELS = 2  # Force stereo as per PulseAudio config
+RATE = 48000  # Match PulseAudio daemon.conf setting
+
+# "callback" fills a ring buffer from the PortAudio thread and drains it from a
+# writer thread; "blocking" keeps the original read/write loop as a fallback.
+CAPTURE_MODE = os.environ.get('AUDIO_CAPTURE_MODE', 'callback')
+# Seconds of audio the ring buffer can hold before the writer has to catch up
+RING_BUFFER_SECONDS = float(os.environ.get('AUDIO_RING_BUFFER_SECONDS', '10'))
+# Seconds of audio the writer thread collects before each file write
+WRITE_BLOCK_SECONDS = float(os.environ.get('AUDIO_WRITE_BLOCK_SECONDS', '0.5'))
+
+# Names PortAudio may list the PulseAudio capture device under
+PULSE_DEVICE_NAMES = ["pulse", "virtual-mic-out",
+                      "virtual-mic.monitor", "virtual-mic Monitor"]
+# Seconds to give PulseAudio to come up when it is not listed on first use
+DEVICE_WAIT_SECONDS = float(os.environ.get('AUDIO_DEVICE_WAIT_SECONDS', '2'))
+# Seconds to wait for a new capture stream to show up in PulseAudio
+ROUTE_WAIT_SECONDS = float(os.environ.get('AUDIO_ROUTE_WAIT_SECONDS', '2'))
+
+
+class RingBuffer:
+    """
+    Preallocated single-producer/single-consumer ring buffer of audio frames.
+
+    The PortAudio callback is the only writer and the writer thread the only
+    reader. Each side advances its own monotonically increasing frame counter,
+    so no lock is needed between them.
+    """
+
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.buffer = numpy.zeros((capacity, channels), dtype=numpy.float32)
+        self.write_count = 0
+        self.read_count = 0
+        self.overflows = 0
+        self.dropped_frames = 0
+
+    def available(self):
+        """Number of frames written but not read yet"""
+        return self.write_count - self.read_count
+
+    def write(self, frames):
+        """Copy frames into the buffer, dropping what does not fit"""
+        count = len(frames)
+        free = self.capacity - self.available()
+        if count > free:
+            self.overflows += 1
+            self.dropped_frames += count - free
+            count = free
+        if count == 0:
+            return 0
+
+        start = self.write_count % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first] = frames[:first]
+        if count > first:
+            self.buffer[:count - first] = frames[first:count]
+        self.write_count += count
+        return count
+
+    def read(self, max_frames):
+        """Return up to max_frames of the oldest unread frames as a copy"""
+        count = min(max_frames, self.available())
+        start = self.read_count % self.capacity
+        first = min(count, self.capacity - start)
+        if count > first:
+            frames = numpy.concatenate(
+                (self.buffer[start:], self.buffer[:count - first]))
+        else:
+            frames = self.buffer[start:start + count].copy()
+        self.read_count += count
+        return frames
+
+
+
+
+# Capture streams are opened on the default source and moved to their own
+# one at a time, so the process's one new source output is the stream just
+# opened
+_routing_lock = threading.Lock()
+
+
+class _PortAudio:
+    """
+    The process's PyAudio instance, shared by every AudioSystem and
+    terminated with the last one, and the capture devices found on it.
+
+    PortAudio enumerates devices once, when it is initialized, so a device
+    is looked up once per instance; when it is missing, PortAudio is
+    reinitialized to see devices that appeared since.
+    """
 
-class AudioSystem:
     def __init__(self):
-        self.pa = pyaudio.PyAudio()
+        self.pa = None
+        self.users = 0
+        self.devices = {}
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.pa is None:
+                self.pa = pyaudio.PyAudio()
+            self.users += 1
+
+    def release(self):
+        with self._lock:
+            self.users -= 1
+            if self.users == 0 and self.pa is not None:
+                self.pa.terminate()
+                self.pa = None
+                self.devices.clear()
+
+    def find_device(self, names, wait_seconds=0):
+        """
+        Info of the first device whose name contains one of names, or None.
+
+        If none does and nobody else has streams open, wait wait_seconds,
+        reinitialize PortAudio and look once more.
+        """
+        key = tuple(names)
+        with self._lock:
+            if key not in self.devices:
+                device = self._scan(names)
+                if device is None and wait_seconds and self.users == 1:
+                    logger.info(
+                        "Virtual mic not found immediately, waiting for PulseAudio initialization...")
+                    time.sleep(wait_seconds)
+                    self.pa.terminate()
+                    self.pa = pyaudio.PyAudio()
+                    device = self._scan(names)
+                if device is None:
+                    return None
+                logger.info(f"Found audio device: {device['name']}")
+                logger.info(f"Device info: {device}")
+                self.devices[key] = device
+            return self.devices[key]
+
+    def device_names(self):
+        with self._lock:
+            return [self.pa.get_device_info_by_index(i)["name"]
+                    for i in range(self.pa.get_device_count())]
+
+    def _scan(self, names):
+        for i in range(self.pa.get_device_count()):
+            device_info = self.pa.get_device_info_by_index(i)
+            logger.debug(f"Found audio device: {device_info['name']}")
+            if any(name.lower() in device_info["name"].lower() for name in names):
+                return device_info
+        return None
+
+
+_portaudio = _PortAudio()
+
+
+def _pactl(*args):
+    return subprocess.run(["pactl", *args], check=True, capture_output=True,
+                          text=True, env={**os.environ, "LC_ALL": "C"}).stdout.strip()
+
+
+def own_source_outputs():
+    """Indices of the PulseAudio source outputs (capture streams) of this process"""
+    outputs, index = set(), None
+    for line in _pactl("list", "source-outputs").splitlines():
+        line = line.strip()
+        if line.startswith("Source Output #"):
+            index = line[len("Source Output #"):]
+        elif line.startswith("application.process.id") and index is not None:
+            if line.split("=", 1)[1].strip().strip('"') == str(os.getpid()):
+                outputs.add(index)
+    return outputs
+
+
+def create_null_sink(name):
+    """
+    Create a PulseAudio null sink in the capture format.
+
+    Returns:
+        str: Index of the module to pass to remove_null_sink
+    """
+    try:
+        return _pactl("load-module", "module-null-sink", f"sink_name={name}",
+                      f"sink_properties=device.description={name}",
+                      f"channels={CHANNELS}", f"rate={RATE}", "format=float32le")
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise Exception(f"Could not create sink {name}: {e}")
+
+
+def remove_null_sink(module):
+    _pactl("unload-module", module)
+
+
+class AudioSystem:
+    def __init__(self, capture_source=None):
+        """
+        Args:
+            capture_source: PulseAudio source to record, e.g. the monitor of a
+                            session's null sink; by default the server's
+                            default source
+        """
+        self.capture_source = capture_source
+        # Set by for_session()
+        self.sink_name = None
+        self._sink_module = None
+        self._portaudio_acquired = False
         # Use Linux audio setup if we're in container or on Linux
         self.system = "Linux" if os.environ.get(
             'FORCE_LINUX_AUDIO') else platform.system()
         self.recording_device = None
         self.recording = False
-        self._setup_recording_device()
+        if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+            raise Exception(
+                f"Unsupported audio output format: {OUTPUT_FORMAT} "
+                f"(expected one of {', '.join(OUTPUT_FORMATS)})")
+        self.output_format = OUTPUT_FORMATS[OUTPUT_FORMAT]
+        self._stop_event = threading.Event()
+        self._ring = None
+        self._capturing = False
+        # Captured audio is dropped until the stream is on capture_source
+        self._routed = threading.Event()
+        self._writer = None
+        # Called with (manifest, segment) whenever a segment is closed
+        self.on_segment_closed = None
+        # Returns the meeting details kept in the manifest for crash recovery
+        self.recording_metadata = None
+        self._reset_stats()
+        _portaudio.acquire()
+        self._portaudio_acquired = True
+        try:
+            self._setup_recording_device()
+        except Exception:
+            self._release_portaudio()
+            raise
+
+    @classmethod
+    def for_session(cls, name):
+        """
+        AudioSystem recording a null sink of its own, so several sessions
+        can be captured at once. A browser started with browser_env() plays
+        into the sink; cleanup() removes it.
+        """
+        module = create_null_sink(name)
+        try:
+            system = cls(capture_source=f"{name}.monitor")
+        except Exception:
+            remove_null_sink(module)
+            raise
+        system.sink_name, system._sink_module = name, module
+        logger.info(f"Created sink {name} for the session")
+        return system
+
+    def browser_env(self):
+        """
+        Environment for a browser process that plays into the session sink,
+        or None to inherit the recorder's. Routing a process never depends
+        on the recorder's own PULSE_* variables.
+        """
+        if not self.sink_name:
+            return None
+        env = {key: value for key, value in os.environ.items()
+               if key not in ("PULSE_SINK", "PULSE_SOURCE")}
+        env["PULSE_SINK"] = self.sink_name
+        return env
+
+    @property
+    def pa(self):
+        return _portaudio.pa
 
     def _setup_recording_device(self):
         """Setup the appropriate recording device based on the platform"""
         if self.system == "Linux":
             # Look for our virtual microphone
-            device_found = False
-            for i in range(self.pa.get_device_count()):
-                device_info = self.pa.get_device_info_by_index(i)
-                logger.debug(f"Found audio device: {device_info['name']}")
-
-                # Check for both the source and monitor names as they might appear differently
-                device_names = [
-                    "pulse",
-                    "virtual-mic-out",
-                    "virtual-mic.monitor",
-                    "virtual-mic Monitor"
-                ]
-
-                if any(name.lower() in device_info["name"].lower() for name in device_names):
-                    self.recording_device = device_info
-                    device_found = True
-                    logger.info(
-                        f"Found virtual microphone: {device_info['name']}")
-                    logger.info(f"Device info: {device_info}")
-                    break
-
-            if not device_found:
-                # Wait for a short time and retry once, as PulseAudio might need a moment
-                logger.info(
-                    "Virtual mic not found immediately, waiting for PulseAudio initialization...")
-                time.sleep(2)
-
-                for i in range(self.pa.get_device_count()):
-                    device_info = self.pa.get_device_info_by_index(i)
-                    device_names = [
-                        "pulse",
-                        "virtual-mic-out",
-                        "virtual-mic.monitor",
-                        "virtual-mic Monitor"
-                    ]
-
-                    if any(name.lower() in device_info["name"].lower() for name in device_names):
-                        self.recording_device = device_info
-                        device_found = True
-                        logger.info(
-                            f"Found virtual microphone after retry: {device_info['name']}")
-                        logger.info(f"Device info: {device_info}")
-                        break
+            self.recording_device = _portaudio.find_device(
+                PULSE_DEVICE_NAMES, wait_seconds=DEVICE_WAIT_SECONDS)
 
-            if not device_found:
+            if not self.recording_device:
                 logger.error("No virtual-mic found. Available devices:")
-                for i in range(self.pa.get_device_count()):
-                    dev_info = self.pa.get_device_info_by_index(i)
-                    logger.error(f"Index {i}: {dev_info['name']}")
+                for i, name in enumerate(_portaudio.device_names()):
+                    logger.error(f"Index {i}: {name}")
                 raise Exception("virtual-mic not found in container")
 
         elif self.system == "Darwin":  # macOS (non-containerized)
@@ -82,14 +305,9 @@ class AudioSystem:
                 "Docker setup handles all audio routing internally without requiring BlackHole.")
 
             # Fall back to BlackHole for non-containerized macOS
-            for i in range(self.pa.get_device_count()):
-                device_info = self.pa.get_device_info_by_index(i)
-                if "BlackHole" in device_info["name"]:
-                    self.recording_device = device_info
-                    logger.info(
-                        f"Found BlackHole device: {device_info['name']}")
-                    logger.info(f"Device info: {device_info}")
-                    return
+            self.recording_device = _portaudio.find_device(["BlackHole"])
+            if self.recording_device:
+                return
 
             logger.error("BlackHole 2ch not found. Please either:")
             logger.error("1. Run this application using Docker (recommended)")
@@ -100,66 +318,260 @@ class AudioSystem:
         else:
             raise Exception(f"Unsupported platform: {self.system}")
 
+    def _reset_stats(self):
+        self.input_overflows = 0
+        self.input_underflows = 0
+
+    def get_stats(self):
+        """
+        Capture counters for the current (or last) recording.
+
+        input_overflows/input_underflows are reported by PortAudio, while
+        ring_overflows/dropped_frames count audio the writer thread could not
+        keep up with. All of them stay at zero for a lossless recording.
+        """
+        return {
+            "mode": CAPTURE_MODE,
+            "input_overflows": self.input_overflows,
+            "input_underflows": self.input_underflows,
+            "ring_overflows": self._ring.overflows if self._ring else 0,
+            "dropped_frames": self._ring.dropped_frames if self._ring else 0,
+            "frames_written": self._writer.frames_written if self._writer else 0,
+        }
+
+    def get_output_path(self, filename):
+        """Return filename with the extension of the configured output format"""
+        return os.path.splitext(filename)[0] + self.output_format["extension"]
+
+    def get_stt_path(self, filename):
+        """Return the path of the 16 kHz mono derivative of a recording"""
+        return os.path.splitext(filename)[0] + STT_SUFFIX
+
+    def get_manifest(self):
+        """Manifest of the recording in progress, or None"""
+        return self._writer.manifest if self._writer else None
+
+    def recover_orphaned_recordings(self, directory):
+        """
+        Finalize recordings whose segments were left behind by a crash.
+
+        Returns:
+            list: {"recording", "stt_recording", "started_at", "duration",
+                "meeting"} for each recovered recording; "meeting" is what
+                the recorder's recording_metadata last returned, or None
+        """
+        recovered = []
+        pattern = os.path.join(directory, "*" + SEGMENTS_SUFFIX, MANIFEST_NAME)
+        for manifest_path in glob.glob(pattern):
+            try:
+                data = SegmentManifest.load(manifest_path).data
+                recording_path = finalize_recording(manifest_path)
+                recovered.append({
+                    "recording": recording_path,
+                    "stt_recording": data["stt_recording"],
+                    "started_at": data["started_at"],
+                    "duration": sf.info(recording_path).duration,
+                    "meeting": data.get("meeting")
+                })
+                logger.info(f"Recovered orphaned recording: {recording_path}")
+            except Exception as e:
+                logger.error(
+                    f"Failed to recover {manifest_path}: {str(e)}")
+        return recovered
+
     def start_recording(self, filename):
-        """Start recording audio"""
+        """Start recording audio, blocking until stop_recording is called"""
         if not self.recording_device:
             raise Exception("No recording device configured")
 
+        full_path = self.get_output_path(filename)
+        stt_path = self.get_stt_path(full_path)
+        logger.info(f"Recording to file: {full_path}")
+
         self.recording = True
-        CHUNK = 1024
-        FORMAT = pyaudio.paFloat32
-        CHANNELS = 2  # Force stereo as per PulseAudio config
-        RATE = 48000  # Match PulseAudio daemon.conf setting
+        self._stop_event.clear()
+        self._ring = None
+        self._reset_stats()
 
         logger.info(f"Starting recording with settings:")
         logger.info(f"Device: {self.recording_device['name']}")
+        if self.capture_source:
+            logger.info(f"Source: {self.capture_source}")
         logger.info(f"Channels: {CHANNELS}")
         logger.info(f"Rate: {RATE}")
         logger.info(f"Format: Float32")
+        logger.info(
+            f"Output: {self.output_format['format']}/{self.output_format['subtype']}")
+        logger.info(f"Capture mode: {CAPTURE_MODE}")
 
         try:
-            stream = self.pa.open(
-                format=FORMAT,
-                channels=CHANNELS,
-                rate=RATE,
-                input=True,
-                input_device_index=int(self.recording_device["index"]),
-                frames_per_buffer=CHUNK
-            )
-
-            with sf.SoundFile(filename, mode='w', samplerate=RATE,
-                              channels=CHANNELS, format='WAV') as audio_file:
-                while self.recording:  # Continue while recording flag is True
-                    try:
-                        data = stream.read(CHUNK, exception_on_overflow=False)
-                        audio_data = numpy.frombuffer(
-                            data, dtype=numpy.float32)
-                        audio_data = audio_data.reshape(-1, CHANNELS)
-                        audio_file.write(audio_data)
-                    except IOError as e:
-                        if e.errno == -9981:  # Input overflow
-                            logger.warning("Audio input overflow occurred")
-                            continue
-                        else:
-                            logger.error(f"IOError during recording: {str(e)}")
-                            break
-                    except Exception as e:
-                        logger.error(f"Error recording audio: {str(e)}")
-                        break
-
-            stream.stop_stream()
-            stream.close()
+            self._writer = SegmentedWriter(
+                full_path, stt_path, OUTPUT_FORMAT, RATE, CHANNELS,
+                on_segment_closed=self.on_segment_closed,
+                metadata=self.recording_metadata)
+            try:
+                if CAPTURE_MODE == "blocking":
+                    self._record_blocking()
+                else:
+                    self._record_callback()
+            finally:
+                self._writer.close()
+                logger.info(f"Recording stats: {self.get_stats()}")
+            finalize_recording(self._writer.manifest.path)
 
         except Exception as e:
             self.recording = False
             logger.error(f"Failed to initialize audio stream: {str(e)}")
             raise
 
+    def _open_stream(self, **kwargs):
+        """
+        Open and start the input stream on the recording device. With a
+        capture_source, the stream's PulseAudio source output is then moved
+        to it; audio captured before the move is dropped.
+        """
+        kwargs.update(format=FORMAT, channels=CHANNELS, rate=RATE, input=True,
+                      input_device_index=int(self.recording_device["index"]),
+                      frames_per_buffer=CHUNK)
+        if not self.capture_source:
+            self._routed.set()
+            return self.pa.open(**kwargs)
+        self._routed.clear()
+        with _routing_lock:
+            before = own_source_outputs()
+            stream = self.pa.open(**kwargs)
+            try:
+                self._route(before)
+            except Exception:
+                stream.close()
+                raise
+        self._routed.set()
+        return stream
+
+    def _route(self, before):
+        """Move the process's new source output to capture_source"""
+        deadline = time.monotonic() + ROUTE_WAIT_SECONDS
+        while True:
+            new = own_source_outputs() - before
+            if new:
+                break
+            if time.monotonic() >= deadline:
+                raise Exception(
+                    f"No capture stream to move to {self.capture_source}")
+            time.sleep(0.05)
+        for index in new:
+            _pactl("move-source-output", index, self.capture_source)
+        logger.info(f"Moved capture stream {', '.join(sorted(new))} "
+                    f"to {self.capture_source}")
+
+    def _write_block(self, frames):
+        """Write captured frames to the recording and its STT derivative"""
+        self._writer.write(frames)
+
+    def _record_blocking(self):
+        """Read and write the stream on the calling thread"""
+        stream = self._open_stream()
+        # Audio buffered before the stream was moved
+        stale = stream.get_read_available()
+        if self.capture_source and stale:
+            stream.read(stale, exception_on_overflow=False)
+
+        while self.recording:  # Continue while recording flag is True
+            try:
+                data = stream.read(CHUNK, exception_on_overflow=False)
+                audio_data = numpy.frombuffer(
+                    data, dtype=numpy.float32)
+                audio_data = audio_data.reshape(-1, CHANNELS)
+                self._write_block(audio_data)
+            except IOError as e:
+                if e.errno == -9981:  # Input overflow
+                    logger.warning("Audio input overflow occurred")
+                    self.input_overflows += 1
+                    continue
+                else:
+                    logger.error(f"IOError during recording: {str(e)}")
+                    break
+            except Exception as e:
+                logger.error(f"Error recording audio: {str(e)}")
+                break
+
+        stream.stop_stream()
+        stream.close()
+
+    def _record_callback(self):
+        """
+        Let PortAudio push audio into a ring buffer and write it to disk
+        from a separate writer thread in large blocks.
+        """
+        self._ring = RingBuffer(int(RATE * RING_BUFFER_SECONDS), CHANNELS)
+        block_frames = int(RATE * WRITE_BLOCK_SECONDS)
+
+        stream = self._open_stream(stream_callback=self._stream_callback)
+
+        self._capturing = True
+        writer = threading.Thread(
+            target=self._drain_ring_buffer, args=(block_frames,),
+            name="audio-writer", daemon=True)
+        writer.start()
+        stream.start_stream()
+
+        try:
+            self._stop_event.wait()
+        finally:
+            stream.stop_stream()
+            stream.close()
+            # The writer flushes whatever is left once the stream is closed
+            self._capturing = False
+            writer.join()
+
+    def _stream_callback(self, in_data, frame_count, time_info, status_flags):
+        """PortAudio callback: only copies the captured frames into the ring"""
+        if status_flags & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        if status_flags & pyaudio.paInputUnderflow:
+            self.input_underflows += 1
+        if not self._routed.is_set():
+            return (None, pyaudio.paContinue)
+        self._ring.write(numpy.frombuffer(
+            in_data, dtype=numpy.float32).reshape(-1, CHANNELS))
+        return (None, pyaudio.paContinue)
+
+    def _drain_ring_buffer(self, block_frames):
+        """Writer thread: move audio from the ring buffer to the file"""
+        poll_interval = WRITE_BLOCK_SECONDS / 4
+        while True:
+            capturing = self._capturing
+            if self._ring.available() >= block_frames or not capturing:
+                frames = self._ring.read(block_frames)
+                if len(frames):
+                    try:
+                        self._write_block(frames)
+                    except Exception as e:
+                        logger.error(f"Error writing audio: {str(e)}")
+                        self.stop_recording()
+                        break
+                elif not capturing:
+                    break
+            else:
+                time.sleep(poll_interval)
+
     def stop_recording(self):
         """Stop the recording"""
         self.recording = False
+        self._stop_event.set()
 
     def cleanup(self):
-        """Cleanup audio resources"""
-        self.recording = False
-        self.pa.terminate()
+        """Cleanup audio resources, including the session sink"""
+        self.stop_recording()
+        if self._sink_module is not None:
+            try:
+                remove_null_sink(self._sink_module)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"Failed to remove sink {self.sink_name}: {e}")
+            self._sink_module = None
+        self._release_portaudio()
+
+    def _release_portaudio(self):
+        if self._portaudio_acquired:
+            self._portaudio_acquired = False
+            _portaudio.release()
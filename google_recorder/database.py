@@ -4,6 +4,7 @@ from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import os
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -32,42 +33,56 @@ class DatabaseManager:
         Base.metadata.create_all(self.engine)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        # Job workers process recordings on their own threads and share the session
+        self._lock = threading.Lock()
 
     def add_recording(self, filename, source, transcript=None):
-        """Add a new recording to the database"""
-        try:
-            # Log the transcript before storing
-            if transcript:
-                logger.info(
-                    "About to store transcript in database. First 1000 chars:")
-                # Use repr to see escape sequences
-                logger.info(repr(transcript[:1000]))
-                logger.info("Number of newlines in transcript: %d",
-                            transcript.count('\n'))
+        """
+        Add a new recording to the database.
 
-            recording = Recording(
-                filename=filename,
-                source=source,
-                transcript=transcript
-            )
-            self.session.add(recording)
-            self.session.commit()
+        The extension of filename (.wav, .flac or .ogg) identifies the audio
+        container, which the backend uses to serve the file's media type.
+        """
+        with self._lock:
+            try:
+                # Log the transcript before storing
+                if transcript:
+                    logger.info(
+                        "About to store transcript in database. First 1000 chars:")
+                    # Use repr to see escape sequences
+                    logger.info(repr(transcript[:1000]))
+                    logger.info("Number of newlines in transcript: %d",
+                                transcript.count('\n'))
 
-            # Verify what was actually stored
-            stored_recording = self.session.query(
-                Recording).filter_by(filename=filename).first()
-            if stored_recording and stored_recording.transcript:
-                logger.info("Stored transcript in database. First 100 chars:")
-                logger.info(repr(stored_recording.transcript[:100]))
-                logger.info("Number of newlines in stored transcript: %d",
-                            stored_recording.transcript.count('\n'))
+                recording = Recording(
+                    filename=filename,
+                    source=source,
+                    transcript=transcript
+                )
+                self.session.add(recording)
+                self.session.commit()
 
-            logger.info(f"Added recording {filename} to database")
-            return recording
-        except Exception as e:
-            logger.error(f"Failed to add recording to database: {str(e)}")
-            self.session.rollback()
-            raise
+                # Verify what was actually stored
+                stored_recording = self.session.query(
+                    Recording).filter_by(filename=filename).first()
+                if stored_recording and stored_recording.transcript:
+                    logger.info("Stored transcript in database. First 100 chars:")
+                    logger.info(repr(stored_recording.transcript[:100]))
+                    logger.info("Number of newlines in stored transcript: %d",
+                                stored_recording.transcript.count('\n'))
+
+                logger.info(f"Added recording {filename} to database")
+                return recording
+            except Exception as e:
+                logger.error(f"Failed to add recording to database: {str(e)}")
+                self.session.rollback()
+                raise
+
+    def has_recording(self, filename):
+        """Whether a recording with this filename was already added"""
+        with self._lock:
+            return self.session.query(Recording.id).filter_by(
+                filename=filename).first() is not None
 
     def close(self):
         """Close the database session"""
@@ -13,7 +13,11 @@ from datetime import datetime
 from database import DatabaseManager
 from transcription import TranscriptionManager
 from audio import AudioSystem
+from jobs import JobQueue, JobWorkerPool
 from state import set_state, RecorderState
+from browser_events import (BrowserEvents, PARTICIPANT_JOINED, PARTICIPANT_LEFT,
+                            CALL_ENDED, DISCONNECTED)
+from meet_watcher import MEET_WATCHER_SCRIPT
 
 
 # Configure logging
@@ -27,6 +31,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Job kind of a finished recording waiting to be transcribed and stored
+RECORDING_JOB = "meet_recording"
+
 
 load_dotenv()
 
@@ -45,6 +52,9 @@ class GoogleMeetRecorder:
         self.db_manager = DatabaseManager()
         self.transcription_manager = TranscriptionManager()
         self.audio_system = None
+        self.jobs = JobQueue()
+        self.workers = JobWorkerPool(
+            self.jobs, {RECORDING_JOB: self._process_recording})
 
         # Create directories
         os.makedirs('recordings', exist_ok=True)
@@ -58,10 +68,26 @@ class GoogleMeetRecorder:
         try:
             self.audio_system = AudioSystem()
             logger.info("Audio system initialized successfully")
+            # Finalize segments left behind if the container died mid-call
+            recovered = self.audio_system.recover_orphaned_recordings('recordings')
         except Exception as e:
             logger.error(f"Failed to initialize audio system: {str(e)}")
             raise
 
+        # and process them like any other finished recording
+        for recording in recovered:
+            try:
+                self.jobs.enqueue(RECORDING_JOB, {
+                    "recording_filename": recording["recording"],
+                    "stt_filename": recording["stt_recording"]
+                })
+            except Exception as e:
+                logger.error(f"Failed to queue recovered recording "
+                             f"{recording['recording']}: {str(e)}")
+
+        # Also picks up recordings queued before a restart
+        self.workers.start()
+
     def _initialize_browser(self):
         """Initialize or reinitialize the Chrome browser with appropriate options"""
         options = webdriver.ChromeOptions()
@@ -230,7 +256,8 @@ class GoogleMeetRecorder:
             self.start_recording(f"meet_recording_{timestamp}.wav")
             set_state(RecorderState.RECORDING)
 
-            # Monitor meet status
+            # Monitor meet status: the page pushes participant and
+            # end-of-call changes over CDP, or is polled without CDP
             def check_meet_status():
                 time.sleep(10)
                 # Make sure the participants list is visible
@@ -239,25 +266,14 @@ class GoogleMeetRecorder:
                 people_button.click()
                 time.sleep(2)
 
-                while self.recording:
-                    try:
-                        # Check number of participants
-                        participants_list = self.driver.find_elements(
-                            By.CSS_SELECTOR, "div.AE8xFb.OrqRRb.GvcuGe.goTdfd div[role='listitem']")
-                        if len(participants_list) <= 1:
-                            logger.info(
-                                "Only one participant left, leaving the call")
-                            leave_button = self.driver.find_element(
-                                By.CSS_SELECTOR, "[aria-label='Leave call']")
-                            leave_button.click()
-                            self.stop_recording()
-                            break
-
-                        time.sleep(3)
-                    except Exception as e:
-                        logger.info(f"Meeting ended or disconnected: {str(e)}")
-                        self.stop_recording()
-                        break
+                events = BrowserEvents(self.driver, MEET_WATCHER_SCRIPT)
+                if events.start():
+                    logger.info("Following meeting events over CDP")
+                    self._follow_meet_events(events)
+                else:
+                    logger.info(f"CDP events unavailable ({events.error}), "
+                                "polling the meeting")
+                    self._poll_meet_status()
 
                 # Wait for cleanup to complete
                 while not self.cleanup_complete:
@@ -270,11 +286,62 @@ class GoogleMeetRecorder:
             logger.error(f"Error joining meet: {e}")
             raise e
 
+    def _leave_call(self):
+        logger.info("Only one participant left, leaving the call")
+        leave_button = self.driver.find_element(
+            By.CSS_SELECTOR, "[aria-label='Leave call']")
+        leave_button.click()
+
+    def _follow_meet_events(self, events):
+        """Stop the recording as soon as the page reports the meeting is over"""
+        try:
+            while self.recording:
+                event = events.get(timeout=1)
+                if event is None:
+                    continue
+                if event.type in (PARTICIPANT_JOINED, PARTICIPANT_LEFT):
+                    count = event.data["count"]
+                    logger.info(f"{event.data['name']} "
+                                f"{'joined' if event.type == PARTICIPANT_JOINED else 'left'}"
+                                f" the meeting ({count} present)")
+                    if count <= 1:
+                        try:
+                            self._leave_call()
+                        except Exception as e:
+                            logger.info(f"Could not leave the call: {str(e)}")
+                        self.stop_recording()
+                        break
+                elif event.type in (CALL_ENDED, DISCONNECTED):
+                    logger.info(f"Meeting ended or disconnected: "
+                                f"{event.data.get('reason')}")
+                    self.stop_recording()
+                    break
+        finally:
+            events.stop()
+
+    def _poll_meet_status(self):
+        """Count the participants every few seconds until the meeting is over"""
+        while self.recording:
+            try:
+                # Check number of participants
+                participants_list = self.driver.find_elements(
+                    By.CSS_SELECTOR, "div.AE8xFb.OrqRRb.GvcuGe.goTdfd div[role='listitem']")
+                if len(participants_list) <= 1:
+                    self._leave_call()
+                    self.stop_recording()
+                    break
+
+                time.sleep(3)
+            except Exception as e:
+                logger.info(f"Meeting ended or disconnected: {str(e)}")
+                self.stop_recording()
+                break
+
     def start_recording(self, filename):
         """Start recording a meet"""
         if not self.recording:
-            self.current_recording_filename = os.path.join(
-                'recordings', filename)
+            self.current_recording_filename = self.audio_system.get_output_path(
+                os.path.join('recordings', filename))
             self.recording = True
             self.recorder_thread = threading.Thread(target=self._record)
             self.recorder_thread.start()
@@ -289,48 +356,60 @@ class GoogleMeetRecorder:
             set_state(RecorderState.READY)
 
     def stop_recording(self):
-        """Stop the recording, transcribe it, and add it to database"""
+        """Stop the recording and queue it to be transcribed and added to database"""
         if self.recording and self.recorder_thread:
             self.audio_system.stop_recording()
             self.recorder_thread.join()
             self.recording = False
             set_state(RecorderState.PROCESSING)
 
-            # Process recording
-            if hasattr(self, 'current_recording_filename'):
+            if getattr(self, 'current_recording_filename', None):
+                # Upload the 16 kHz mono derivative when it is available
+                stt_filename = self.audio_system.get_stt_path(
+                    self.current_recording_filename)
+                if not os.path.exists(stt_filename):
+                    stt_filename = self.current_recording_filename
                 try:
-                    # Transcribe the audio
-                    transcript = self.transcription_manager.transcribe_audio(
-                        self.current_recording_filename)
-
-                    # Add to database
-                    self.db_manager.add_recording(
-                        filename=os.path.basename(
-                            self.current_recording_filename),
-                        source="google_meet",
-                        transcript=transcript
-                    )
-                    logger.info("Recording added to database")
-
+                    self.jobs.enqueue(RECORDING_JOB, {
+                        "recording_filename": self.current_recording_filename,
+                        "stt_filename": stt_filename
+                    })
                 except Exception as e:
-                    logger.error(f"Failed to process recording: {str(e)}")
-                    # Still try to save the recording without transcript
-                    try:
-                        self.db_manager.add_recording(
-                            filename=os.path.basename(
-                                self.current_recording_filename),
-                            source="google_meet",
-                            transcript=None
-                        )
-                    except Exception as db_error:
-                        logger.error(
-                            f"Failed to add recording to database: {str(db_error)}")
+                    logger.error(f"Failed to queue recording: {str(e)}")
 
             # Reset for next meeting without closing the WebDriver session
             set_state(RecorderState.INITIALIZING)
             self.reset_meeting()
             set_state(RecorderState.READY)
 
+    def _process_recording(self, job):
+        """
+        Transcribe a queued recording and add it to database. Runs on a job
+        worker; raising has the job retried.
+        """
+        filename = os.path.basename(job.payload["recording_filename"])
+        # The job may run again after it was stored, if its lease ran out
+        if self.db_manager.has_recording(filename):
+            logger.info(f"Recording {filename} already in database")
+            return
+
+        with job.stage("transcription"):
+            transcript = self.transcription_manager.transcribe_audio(
+                job.payload["stt_filename"])
+        if transcript is None:
+            if not job.final_attempt:
+                raise RuntimeError(f"Transcription of {filename} failed")
+            # Still save the recording without transcript
+            logger.error(f"Saving {filename} without transcript")
+
+        with job.stage("database"):
+            self.db_manager.add_recording(
+                filename=filename,
+                source="google_meet",
+                transcript=transcript
+            )
+        logger.info("Recording added to database")
+
     def reset_meeting(self):
         """Reset the recorder state for a new meeting without closing the WebDriver session"""
         self.meet_url = None
@@ -357,6 +436,10 @@ class GoogleMeetRecorder:
         if self.audio_system:
             self.audio_system.cleanup()
 
+        # Let running jobs finish; queued ones resume after a restart
+        self.workers.stop(timeout=30)
+        self.jobs.close()
+
         # Close database session
         self.db_manager.close()
 
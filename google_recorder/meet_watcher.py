@@ -0,0 +1,94 @@
+"""
+Participant and end-of-call watcher for the Meet page.
+
+Injected through browser_events, it observes the people panel and the call
+controls with a MutationObserver and reports participants joining and
+leaving and the call ending as soon as the DOM changes.
+"""
+import os
+
+# Milliseconds the call controls have to stay gone before the call counts
+# as ended, so a re-render of the call window is not taken for the end
+CALL_ENDED_GRACE_MS = int(os.getenv("CALL_ENDED_GRACE_MS", "300"))
+
+# Installs window.__meetWatcher once per page. Participants are only
+# counted while the people panel is open.
+MEET_WATCHER_SCRIPT = r"""
+(function () {
+    if (window.__meetWatcher) {
+        return;
+    }
+    var PEOPLE = "div.AE8xFb.OrqRRb.GvcuGe.goTdfd";
+    var LEAVE = "[aria-label='Leave call']";
+    var GRACE_MS = %d;
+    var names = {};
+    var inCall = false;
+    var endTimer = null;
+    var ended = false;
+
+    function emit(type, data) {
+        return !!(window.__recorderEmit && window.__recorderEmit(type, data));
+    }
+
+    function participantName(item) {
+        var label = item.getAttribute("aria-label");
+        if (label) {
+            return label.trim();
+        }
+        return (item.innerText || item.textContent || "").trim().split("\n")[0];
+    }
+
+    function checkEnded() {
+        endTimer = null;
+        if (!ended && !document.querySelector(LEAVE)) {
+            ended = emit("call_ended", {reason: "call controls closed"});
+        }
+    }
+
+    function snapshot() {
+        var panel = document.querySelector(PEOPLE);
+        if (panel) {
+            var items = panel.querySelectorAll("div[role='listitem']");
+            var present = {};
+            for (var i = 0; i < items.length; i++) {
+                present[participantName(items[i]) || "participant " + i] = true;
+            }
+            for (var joined in present) {
+                if (!names[joined]) {
+                    emit("participant_joined", {name: joined, count: items.length});
+                }
+            }
+            for (var left in names) {
+                if (!present[left]) {
+                    emit("participant_left", {name: left, count: items.length});
+                }
+            }
+            names = present;
+        }
+        // Only a call that was joined can end
+        if (document.querySelector(LEAVE)) {
+            inCall = true;
+        } else if (inCall && endTimer === null) {
+            endTimer = setTimeout(checkEnded, GRACE_MS);
+        }
+    }
+
+    function observe() {
+        new MutationObserver(snapshot).observe(document.body, {
+            subtree: true,
+            childList: true,
+            attributes: true,
+            attributeFilter: ["aria-label"]
+        });
+        snapshot();
+    }
+
+    window.__meetWatcher = true;
+    // Scripts for new documents run before the body exists
+    if (document.body) {
+        observe();
+    } else {
+        document.addEventListener("DOMContentLoaded", observe);
+    }
+})();
+""" % CALL_ENDED_GRACE_MS
@@ -1,23 +1,49 @@
 import os
 import logging
-import openai
+import tempfile
+import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+from vad import find_split_points, split_audio
+from cache import DiskCache, hash_file
+from engines import ENGINES
+from scheduler import bind_priority
 
 logger = logging.getLogger(__name__)
 
+# Whisper rejects uploads above 25 MB, so chunks are kept safely below that
+MAX_UPLOAD_BYTES = 24 * 1024 * 1024
+# Chunks are at most this long so long meetings transcribe in parallel
+CHUNK_SECONDS = float(os.getenv('TRANSCRIPTION_CHUNK_SECONDS', '600'))
+MIN_CHUNK_SECONDS = 30
+# Maximum number of chunks uploaded at the same time
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS', '4'))
+# Speech compresses to a few KB per second as Opus, which Whisper accepts
+CHUNK_FORMAT = {"format": "OGG", "subtype": "OPUS", "extension": ".ogg"}
+# Speech-to-text engine: whisper (OpenAI), local (faster-whisper) or stub
+TRANSCRIPTION_ENGINE = os.getenv('TRANSCRIPTION_ENGINE', 'whisper')
+# Language of the meetings; unset lets the engine detect it
+TRANSCRIPTION_LANGUAGE = os.getenv('TRANSCRIPTION_LANGUAGE') or None
+# Merged engine responses are cached by audio content so reprocessing a
+# recording does not upload it again; a size of 0 disables the cache
+TRANSCRIPTION_CACHE_DIR = os.getenv(
+    'TRANSCRIPTION_CACHE_DIR', 'recordings/.cache/whisper')
+TRANSCRIPTION_CACHE_MAX_BYTES = int(os.getenv(
+    'TRANSCRIPTION_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
 
 class TranscriptionManager:
-    def __init__(self):
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        openai.base_url = os.getenv(
-            'OPENAI_BASE_URL', 'https://api.openai.com/v1')
-        self.client = openai.Client()
+    def __init__(self, engine=None):
+        self.engine = engine or ENGINES[TRANSCRIPTION_ENGINE](
+            language=TRANSCRIPTION_LANGUAGE)
+        self.cache = DiskCache(
+            TRANSCRIPTION_CACHE_DIR, TRANSCRIPTION_CACHE_MAX_BYTES)
 
     def format_transcript(self, response_data):
         """
         Format the transcript into paragraphs based on timing gaps and sentence endings
         """
         segments = response_data.get('segments', [])
-        logger.info(f"Received {len(segments)} segments from Whisper API")
+        logger.info(f"Received {len(segments)} segments from the transcription engine")
 
         if not segments:
             logger.warning("No segments found in response data")
@@ -62,23 +88,111 @@ class TranscriptionManager:
 
     def transcribe_audio(self, audio_path):
         """
-        Transcribe audio file using OpenAI Whisper API and return formatted text
+        Transcribe audio file with the configured engine and return formatted text.
+
+        The audio is encoded to Opus chunks cut at quiet points, each below
+        Whisper's upload limit, which are transcribed concurrently and merged
+        back into one response. Complete responses are cached by the audio
+        content and chunking parameters.
         """
         try:
             logger.info(f"Starting transcription for: {audio_path}")
-            with open(audio_path, 'rb') as audio_file:
-                response = self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="verbose_json",
-                    timestamp_granularities=["segment"]
-                )
-
-                logger.debug(f"Raw API response: {response.model_dump()}")
-                formatted_text = self.format_transcript(response.model_dump())
-                logger.info("Transcription completed successfully")
-                return formatted_text
+            cache_key = hash_file(audio_path, self.engine.name,
+                                  *self.engine.parameters(),
+                                  CHUNK_SECONDS, MAX_UPLOAD_BYTES)
+            response_data = self.cache.get(cache_key)
+            if response_data is not None:
+                logger.info("Using cached transcription")
+            else:
+                response_data = self._transcribe_chunks(audio_path)
+                if response_data is None:
+                    logger.error(f"Transcription of {audio_path} failed")
+                    return None
+                if self.engine.cacheable:
+                    self.cache.set(cache_key, response_data)
+
+            formatted_text = self.format_transcript(response_data)
+            logger.info("Transcription completed successfully")
+            return formatted_text
 
         except Exception as e:
             logger.error(f"Error during transcription: {str(e)}")
             return None
+
+    def _transcribe_chunks(self, audio_path):
+        """Transcribe audio_path as concurrent chunks and merge the responses"""
+        with tempfile.TemporaryDirectory() as directory:
+            chunks = self._prepare_chunks(audio_path, directory)
+            logger.info(
+                f"Transcribing {len(chunks)} chunk(s) with {TRANSCRIPTION_WORKERS} workers")
+            with ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS) as pool:
+                responses = list(pool.map(
+                    bind_priority(self._transcribe_chunk),
+                    [path for path, _ in chunks]))
+
+        return self._merge_responses(
+            responses, [offset for _, offset in chunks])
+
+    def _prepare_chunks(self, audio_path, directory):
+        """
+        Encode audio_path into Opus chunks no longer than CHUNK_SECONDS and
+        no larger than MAX_UPLOAD_BYTES.
+
+        Returns:
+            list: (chunk path, offset in seconds) for each chunk
+        """
+        duration = sf.info(audio_path).duration
+        chunk_seconds = CHUNK_SECONDS
+        attempt = 0
+        while True:
+            points = []
+            if duration > chunk_seconds * 1.5:
+                _, points = find_split_points(audio_path, chunk_seconds)
+            attempt_directory = os.path.join(directory, str(attempt))
+            os.makedirs(attempt_directory)
+            chunks = split_audio(audio_path, points,
+                                 attempt_directory, **CHUNK_FORMAT)
+
+            largest = max(os.path.getsize(path) for path, _ in chunks)
+            if largest <= MAX_UPLOAD_BYTES or chunk_seconds <= MIN_CHUNK_SECONDS:
+                return chunks
+            logger.warning(
+                f"Chunk of {largest} bytes exceeds the upload limit, "
+                f"retrying with {chunk_seconds / 2:.0f}s chunks")
+            chunk_seconds /= 2
+            attempt += 1
+
+    def _transcribe_chunk(self, chunk_path):
+        """Transcribe one chunk, returning the engine response or None"""
+        try:
+            response = self.engine.transcribe(chunk_path)
+            logger.debug(f"Raw engine response: {response}")
+            return response
+        except Exception as e:
+            logger.error(
+                f"Error transcribing chunk {os.path.basename(chunk_path)}: {str(e)}")
+            return None
+
+    def _merge_responses(self, responses, offsets):
+        """
+        Merge chunk responses, shifting segment times by each chunk's offset.
+        Returns None if any chunk failed, rather than a transcript with a gap.
+        """
+        texts = []
+        segments = []
+        for response, offset in zip(responses, offsets):
+            if response is None:
+                logger.error(f"Chunk at {offset:.0f}s failed to transcribe")
+                return None
+            texts.append((response.get('text') or '').strip())
+            for segment in response.get('segments') or []:
+                segment = dict(segment)
+                segment['id'] = len(segments)
+                segment['start'] = segment['start'] + offset
+                segment['end'] = segment['end'] + offset
+                segments.append(segment)
+
+        if not texts:
+            return None
+        return {'text': ' '.join(text for text in texts if text),
+                'segments': segments}
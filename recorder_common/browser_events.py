@@ -0,0 +1,187 @@
+"""
+Call lifecycle events pushed from the browser over the Chrome DevTools Protocol.
+
+A watcher script runs in the call page, observes the DOM with a
+MutationObserver and reports changes through a Runtime.addBinding binding,
+so each change reaches the recorder as a Runtime.bindingCalled event within
+milliseconds instead of being found by the next WebDriver poll. Main frame
+navigations and the page going away are reported from the Page and
+Inspector domains. The watcher is registered for new documents as well, so
+it survives reloads.
+
+Events are read on a background thread through Selenium's CDP connection
+and handed to the recorder as BrowserEvent tuples on a queue.
+"""
+import json
+import time
+import queue
+import logging
+import threading
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Name of the page function watcher scripts report events through
+EVENT_BINDING = "__recorderEvent"
+# CDP events held for the reader before the connection drops new ones
+EVENT_BUFFER_SIZE = 1000
+# Seconds to wait for the CDP session to be set up
+CONNECT_TIMEOUT_SECONDS = 15
+
+# Event types. Watcher scripts send the page ones with their own data;
+# PAGE_NAVIGATED and DISCONNECTED come from the browser itself.
+PARTICIPANT_JOINED = "participant_joined"   # {"name", "count"}
+PARTICIPANT_LEFT = "participant_left"       # {"name", "count"}
+SPEAKERS_CHANGED = "speakers_changed"       # {"speakers", "metadata"}
+SCREEN_SHARE_STARTED = "screen_share_started"
+SCREEN_SHARE_STOPPED = "screen_share_stopped"
+CALL_ENDED = "call_ended"                   # {"reason"}
+PAGE_NAVIGATED = "page_navigated"           # {"url"}
+DISCONNECTED = "disconnected"               # {"reason"}
+
+# Defines window.__recorderEmit(type, data) for watcher scripts. It returns
+# false when the page has no binding, i.e. nobody is listening over CDP.
+EMIT_SCRIPT = r"""
+window.__recorderEmit = function (type, data) {
+    var binding = window.%s;
+    if (typeof binding !== "function") {
+        return false;
+    }
+    var event = Object.assign({}, data || {});
+    event.type = type;
+    event.time = performance.timeOrigin + performance.now();
+    binding(JSON.stringify(event));
+    return true;
+};
+""" % EVENT_BINDING
+
+
+class BrowserEvent(NamedTuple):
+    type: str
+    # Epoch seconds, from the page clock for page events
+    time: float
+    data: dict
+
+
+class BrowserEvents:
+    """
+    Subscribes to the call page of a WebDriver session and queues its events.
+
+    start() connects and injects the watcher script; it returns False when
+    the browser or the Selenium installation does not offer a CDP
+    connection, and the caller falls back to polling. Once connected,
+    get() returns events in the order the page sent them, and a
+    DISCONNECTED event is queued when the connection or the page goes away.
+    """
+
+    def __init__(self, driver, watcher_script):
+        self.driver = driver
+        self.script = EMIT_SCRIPT + watcher_script
+        self.error = None
+        self._events = queue.Queue()
+        self._ready = threading.Event()
+        self._thread = None
+        self._trio_token = None
+        self._cancel_scope = None
+
+    def start(self, timeout=CONNECT_TIMEOUT_SECONDS):
+        """Connect in the background. Returns True once events are flowing."""
+        try:
+            import trio  # noqa: F401, installed with selenium 4
+        except ImportError as e:
+            self.error = e
+            return False
+        self._thread = threading.Thread(
+            target=self._run, name="browser-events", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            self.error = TimeoutError(f"no CDP session after {timeout}s")
+            self.stop()
+            return False
+        return self.error is None
+
+    def get(self, timeout=None):
+        """Return the next BrowserEvent, or None if there was none within timeout"""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        """Close the CDP connection"""
+        scope, token = self._cancel_scope, self._trio_token
+        if scope is None or token is None:
+            return
+        import trio
+        try:
+            trio.from_thread.run_sync(scope.cancel, trio_token=token)
+        except trio.RunFinishedError:
+            pass
+        self._thread.join(timeout=5)
+
+    def _put(self, event_type, timestamp, data):
+        self._events.put(BrowserEvent(event_type, timestamp, data))
+
+    def _run(self):
+        import trio
+        connected = False
+        try:
+            connected = trio.run(self._listen)
+        except Exception as e:
+            if not self._ready.is_set():
+                self.error = e
+            else:
+                logger.warning(f"CDP connection lost: {e}")
+                self._put(DISCONNECTED, time.time(), {"reason": str(e)})
+        finally:
+            self._ready.set()
+        if connected:
+            self._put(DISCONNECTED, time.time(), {"reason": "connection closed"})
+
+    async def _listen(self):
+        import trio
+        self._trio_token = trio.lowlevel.current_trio_token()
+        async with self.driver.bidi_connection() as connection:
+            session, devtools = connection.session, connection.devtools
+            await session.execute(devtools.runtime.enable())
+            await session.execute(devtools.page.enable())
+            await session.execute(devtools.inspector.enable())
+            await session.execute(devtools.runtime.add_binding(name=EVENT_BINDING))
+            await session.execute(
+                devtools.page.add_script_to_evaluate_on_new_document(source=self.script))
+            events = session.listen(
+                devtools.runtime.BindingCalled,
+                devtools.page.FrameNavigated,
+                devtools.inspector.Detached,
+                devtools.inspector.TargetCrashed,
+                buffer_size=EVENT_BUFFER_SIZE)
+            await session.execute(devtools.runtime.evaluate(expression=self.script))
+
+            with trio.CancelScope() as self._cancel_scope:
+                self._ready.set()
+                async for event in events:
+                    self._dispatch(event, devtools)
+                # The session stopped delivering events
+                return True
+            return False
+
+    def _dispatch(self, event, devtools):
+        now = time.time()
+        if isinstance(event, devtools.runtime.BindingCalled):
+            if event.name != EVENT_BINDING:
+                return
+            try:
+                data = json.loads(event.payload)
+            except ValueError:
+                logger.warning(f"Malformed page event: {event.payload[:200]}")
+                return
+            event_type = data.pop("type", None)
+            page_time = data.pop("time", None)
+            self._put(event_type, page_time / 1000 if page_time else now, data)
+        elif isinstance(event, devtools.page.FrameNavigated):
+            if event.frame.parent_id is None:
+                self._put(PAGE_NAVIGATED, now, {"url": event.frame.url})
+        elif isinstance(event, devtools.inspector.Detached):
+            self._put(DISCONNECTED, now, {"reason": event.reason})
+        elif isinstance(event, devtools.inspector.TargetCrashed):
+            self._put(DISCONNECTED, now, {"reason": "page crashed"})
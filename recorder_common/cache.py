@@ -0,0 +1,171 @@
+import os
+import time
+import gzip
+import json
+import hashlib
+import contextlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Files are hashed in blocks of this many bytes so memory stays flat
+HASH_BLOCK_BYTES = 1024 * 1024
+CACHE_SUFFIX = ".json.gz"
+
+
+def hash_file(path, *params):
+    """
+    Return the SHA-256 hex digest of a file's contents followed by any
+    parameters that change what a provider returns for it.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+    for param in params:
+        digest.update(b'\0' + str(param).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hash_text(text, *params):
+    """Return the SHA-256 hex digest of a text followed by any parameters"""
+    digest = hashlib.sha256(text.encode('utf-8'))
+    for param in params:
+        digest.update(b'\0' + str(param).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    JSON values stored gzip-compressed on disk, one file per key, evicted
+    least recently used first once the directory grows beyond max_bytes.
+
+    Recency is the file modification time, refreshed on every hit, so the
+    order survives restarts without an index file. With ttl_seconds, entries
+    not used for that long expire. A max_bytes of 0 or less disables the
+    cache.
+    """
+
+    def __init__(self, directory, max_bytes, ttl_seconds=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = max_bytes > 0
+        self._lock = threading.Lock()
+
+    def _expired(self, mtime):
+        return bool(self.ttl_seconds) and time.time() - mtime > self.ttl_seconds
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def get(self, key):
+        """Return the value stored under key, or None"""
+        source = self.open(key)
+        if source is None:
+            return None
+        try:
+            with source:
+                return json.load(source)
+        except (OSError, EOFError, ValueError) as e:
+            self.discard(key, e)
+            return None
+
+    def set(self, key, value):
+        """Store a JSON-serializable value under key and evict if needed"""
+        try:
+            with self.writer(key) as output:
+                if output is not None:
+                    output.write(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        except OSError as e:
+            logger.warning(f"Could not cache entry {key}: {e}")
+
+    def open(self, key):
+        """
+        Return the entry stored under key as a binary file of uncompressed
+        JSON, for callers that parse it incrementally, or None.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                self._remove(path)
+                return None
+            source = gzip.open(path, 'rb')
+            source.peek(1)
+            os.utime(path)
+            return source
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError) as e:
+            self.discard(key, e)
+            return None
+
+    def discard(self, key, reason):
+        """Remove an entry that turned out to be unreadable"""
+        logger.warning(f"Dropping unreadable cache entry {key}: {reason}")
+        self._remove(self._path(key))
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        """
+        Yield a binary file that the uncompressed entry is written to, or
+        None when the cache is disabled. The entry is only stored if the
+        block completes, and then the cache is evicted down to size.
+        """
+        if not self.enabled:
+            yield None
+            return
+        path = self._path(key)
+        # Write to a unique temporary file so readers never see half an entry
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            output = gzip.open(temporary_path, 'wb')
+        except OSError as e:
+            logger.warning(f"Could not cache entry {key}: {e}")
+            yield None
+            return
+
+        try:
+            with output:
+                yield output
+        except BaseException:
+            self._remove(temporary_path)
+            raise
+        try:
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache entry {key}: {e}")
+            self._remove(temporary_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(CACHE_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes and not self._expired(mtime):
+                    break
+                self._remove(path)
+                total -= size
+                logger.info(f"Evicted cache entry {os.path.basename(path)}")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
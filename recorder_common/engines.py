@@ -0,0 +1,285 @@
+"""
+Speech-to-text engines behind one interface.
+
+Every engine returns the ElevenLabs response shape the pipeline already
+consumes, plus Whisper-style segments where the engine has them:
+
+    {"text": str, "language_code": str,
+     "words": [{"text", "type": "word", "start", "end", "speaker_id"}],
+     "segments": [{"text", "start", "end"}]}
+"""
+import os
+import abc
+import time
+import tempfile
+import threading
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import openai
+
+from cache import hash_file
+from scheduler import scheduler
+from vad import detect_speech, split_audio
+
+# Whisper rejects uploads above 25 MB, so other formats are sent as Opus
+UPLOAD_FORMAT = {"format": "OGG", "subtype": "OPUS", "extension": ".ogg"}
+COMPRESSED_EXTENSIONS = {".ogg", ".opus", ".mp3", ".m4a", ".webm"}
+# Local engine: faster-whisper model, worker processes and threads per worker
+LOCAL_STT_MODEL = os.getenv("LOCAL_STT_MODEL", "small")
+LOCAL_STT_WORKERS = int(os.getenv("LOCAL_STT_WORKERS", "1"))
+LOCAL_STT_THREADS = int(os.getenv(
+    "LOCAL_STT_THREADS", str(max((os.cpu_count() or 1) // LOCAL_STT_WORKERS, 1))))
+# Language of the audio; None lets the engine detect it
+LANGUAGE = "ru"
+
+
+class TranscriptionEngine(abc.ABC):
+    """
+    Base class of speech-to-text engines.
+
+    Subclasses set name, implement transcribe() and list whatever changes
+    their output in parameters() so cached results stay apart.
+    """
+
+    name = None
+    # Whether the engine can be used in this environment
+    available = True
+    # Whether results are worth caching on disk
+    cacheable = True
+
+    def __init__(self, language=LANGUAGE):
+        self.language = language
+
+    def parameters(self):
+        return ()
+
+    def cache_key(self, file_path):
+        return hash_file(file_path, self.name, *self.parameters())
+
+    @abc.abstractmethod
+    def transcribe(self, file_path, api_key=None):
+        """
+        Transcribe an audio file.
+
+        Returns:
+            dict: Transcription in the shape described in the module
+                docstring, or None if the engine failed
+        """
+
+
+def whisper_to_words(response, speaker_prefix="whisper"):
+    """
+    Convert a Whisper verbose_json response to the common shape.
+
+    Whisper does not diarize, so each segment gets its own pseudo
+    speaker_id; the speaker map then resolves every segment to a person.
+    """
+    segments = response.get("segments") or []
+    segment_starts = numpy.array([segment["start"] for segment in segments])
+    words = []
+    for word in response.get("words") or []:
+        segment = 0
+        if len(segment_starts):
+            segment = max(int(numpy.searchsorted(
+                segment_starts, word["start"], side="right")) - 1, 0)
+        words.append({
+            "text": word["word"].strip(),
+            "type": "word",
+            "start": word["start"],
+            "end": word["end"],
+            "speaker_id": f"{speaker_prefix}_{segment}"
+        })
+    return {
+        "text": response.get("text", ""),
+        "language_code": response.get("language"),
+        "words": words,
+        "segments": [{"text": segment["text"], "start": segment["start"],
+                      "end": segment["end"]} for segment in segments]
+    }
+
+
+class WhisperEngine(TranscriptionEngine):
+    """
+    OpenAI whisper-1 with word and segment timestamps.
+
+    One client is kept per API key and shared by every thread, so a key
+    passed to transcribe() is used for that request only.
+    """
+
+    name = "whisper"
+    model = "whisper-1"
+
+    def __init__(self, language=LANGUAGE):
+        super().__init__(language)
+        self.api_key = os.getenv("OPENAI_API_KEY")
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return bool(self.api_key)
+
+    def parameters(self):
+        return (self.model, self.language, "word", "segment")
+
+    def _client(self, api_key):
+        api_key = api_key or self.api_key
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._clients[api_key] = openai.Client(
+                    api_key=api_key,
+                    base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"))
+        return client
+
+    def transcribe(self, file_path, api_key=None):
+        client = self._client(api_key)
+        print(f"Uploading {file_path} to Whisper...")
+
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                upload_path = file_path
+                if os.path.splitext(file_path)[1].lower() not in COMPRESSED_EXTENSIONS:
+                    [(upload_path, _)] = split_audio(
+                        file_path, [], directory, **UPLOAD_FORMAT)
+                with open(upload_path, "rb") as audio_file:
+                    options = {"language": self.language} if self.language else {}
+                    scheduler.acquire(self.model)
+                    response = client.audio.transcriptions.create(
+                        model=self.model,
+                        file=audio_file,
+                        response_format="verbose_json",
+                        timestamp_granularities=["word", "segment"],
+                        **options
+                    )
+            return whisper_to_words(response.model_dump())
+        except openai.RateLimitError as e:
+            scheduler.penalize(self.model)
+            print(f"Whisper request was rate limited: {e}")
+            return None
+        except Exception as e:
+            print(f"Error during Whisper request: {e}")
+            return None
+
+
+# The model loaded in each local engine worker process
+_local_model = None
+
+
+def _load_local_model(model_size, threads):
+    global _local_model
+    from faster_whisper import WhisperModel
+    _local_model = WhisperModel(model_size, device="cpu", compute_type="int8",
+                                cpu_threads=threads)
+
+
+def _transcribe_local(file_path, language):
+    """Run the worker's model over a file; returns the common shape"""
+    segments, info = _local_model.transcribe(
+        file_path, language=language, word_timestamps=True)
+    response = {"text": "", "language": info.language,
+                "segments": [], "words": []}
+    texts = []
+    for segment in segments:
+        texts.append(segment.text.strip())
+        response["segments"].append(
+            {"text": segment.text, "start": segment.start, "end": segment.end})
+        response["words"].extend(
+            {"word": word.word, "start": word.start, "end": word.end}
+            for word in segment.words or [])
+    response["text"] = " ".join(texts)
+    return whisper_to_words(response, speaker_prefix="local")
+
+
+class LocalWhisperEngine(TranscriptionEngine):
+    """
+    Whisper run on the CPU with faster-whisper and int8 weights.
+
+    Models are loaded once per worker process and kept for the life of the
+    pool, so chunks transcribe in parallel without the GIL and without
+    reloading weights. Requires the optional faster-whisper package.
+    """
+
+    name = "local"
+
+    def __init__(self, language=LANGUAGE, model_size=LOCAL_STT_MODEL,
+                 workers=LOCAL_STT_WORKERS, threads=LOCAL_STT_THREADS):
+        super().__init__(language)
+        self.model_size = model_size
+        self.workers = workers
+        self.threads = threads
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return importlib.util.find_spec("faster_whisper") is not None
+
+    def parameters(self):
+        return (self.model_size, "int8", self.language)
+
+    def transcribe(self, file_path, api_key=None):
+        with self._lock:
+            if self._pool is None:
+                # Spawned rather than forked: the parent runs upload threads
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_load_local_model,
+                    initargs=(self.model_size, self.threads))
+        print(f"Transcribing {file_path} locally with faster-whisper {self.model_size}...")
+        try:
+            return self._pool.submit(
+                _transcribe_local, file_path, self.language).result()
+        except Exception as e:
+            print(f"Error during local transcription: {e}")
+            return None
+
+
+class StubEngine(TranscriptionEngine):
+    """
+    Deterministic offline engine for tests and benchmarks.
+
+    Emits one word every word_seconds inside each speech region found by
+    voice activity detection, alternating speaker_ids between regions, so
+    the rest of the pipeline sees realistic timing without any network.
+    """
+
+    name = "stub"
+    cacheable = False
+
+    def __init__(self, language=LANGUAGE, word_seconds=0.4, speakers=2,
+                 latency=0.0):
+        super().__init__(language)
+        self.word_seconds = word_seconds
+        self.speakers = speakers
+        self.latency = latency
+
+    def parameters(self):
+        return (self.word_seconds, self.speakers)
+
+    def transcribe(self, file_path, api_key=None):
+        rate, regions = detect_speech(file_path)
+        words, segments = [], []
+        for index, (start, end) in enumerate(regions):
+            start, end = start / rate, end / rate
+            speaker_id = f"speaker_{index % self.speakers}"
+            texts = []
+            for position in numpy.arange(start, end - self.word_seconds / 2,
+                                         self.word_seconds):
+                text = f"слово{len(words)}"
+                texts.append(text)
+                words.append({"text": text, "type": "word",
+                              "start": float(position),
+                              "end": float(position) + self.word_seconds * 0.8,
+                              "speaker_id": speaker_id})
+            segments.append({"text": " ".join(texts), "start": start, "end": end})
+        time.sleep(self.latency)
+        return {"text": " ".join(segment["text"] for segment in segments),
+                "language_code": self.language, "words": words, "segments": segments}
+
+
+ENGINES = {engine.name: engine for engine in
+           (WhisperEngine, LocalWhisperEngine, StubEngine)}
@@ -0,0 +1,308 @@
+"""
+Durable queue of recording post-processing jobs.
+
+Recorders enqueue a job for every finished recording (audio path, speaker
+timeline, metadata) and go back to calls right away; a JobWorkerPool
+transcribes, summarizes and stores the recordings in the background.
+
+Jobs are kept in a SQLite database next to the recordings, so they survive
+restarts. A worker leases a job and renews the lease while it runs; a job
+whose worker died is handed out again once its lease expires, so every job
+runs at least once and handlers must tolerate running twice. Failed jobs
+are retried with exponential backoff, up to JOB_MAX_ATTEMPTS attempts.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+# SQLite database holding the queue
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "recordings/jobs.db")
+# Jobs processed at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Attempts before a job is given up
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Seconds a running job stays leased without renewal; renewed every third
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Delay before the first retry, doubled for each further one
+JOB_RETRY_SECONDS = float(os.getenv("JOB_RETRY_SECONDS", "30"))
+# Idle workers look for new jobs this often
+POLL_SECONDS = 1.0
+# Finished jobs the stage timings in metrics() are computed over
+METRICS_HISTORY = 100
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_token TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    last_error TEXT,
+    stages TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, available_at);
+"""
+
+
+class Job:
+    """A leased job, passed to its handler"""
+
+    def __init__(self, id, kind, payload, attempts, token, max_attempts):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        # Including this one
+        self.attempts = attempts
+        self.token = token
+        self.max_attempts = max_attempts
+        # Seconds spent per stage, stored with the job
+        self.stages = {}
+
+    @property
+    def final_attempt(self):
+        return self.attempts >= self.max_attempts
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the handler"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - started
+
+
+class JobQueue:
+    """SQLite-backed job queue, safe to share between threads"""
+
+    def __init__(self, path=JOB_QUEUE_PATH, max_attempts=JOB_MAX_ATTEMPTS,
+                 lease_seconds=JOB_LEASE_SECONDS, retry_seconds=JOB_RETRY_SECONDS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def enqueue(self, kind, payload):
+        """Add a job; payload must be JSON-serializable. Returns the job id."""
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (kind, payload, state, available_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), QUEUED, now, now))
+        logger.info(f"Queued {kind} job {cursor.lastrowid}")
+        return cursor.lastrowid
+
+    def claim(self, kinds):
+        """
+        Lease the oldest job of one of kinds that is due, or whose previous
+        lease expired.
+
+        Returns:
+            Job or None
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        marks = ", ".join("?" * len(kinds))
+        with self._transaction() as db:
+            row = db.execute(
+                f"SELECT id, kind, payload, attempts FROM jobs "
+                f"WHERE kind IN ({marks}) AND "
+                f"((state = ? AND available_at <= ?) OR (state = ? AND lease_until < ?)) "
+                f"ORDER BY available_at, id LIMIT 1",
+                (*kinds, QUEUED, now, RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            job_id, kind, payload, attempts = row
+            db.execute(
+                "UPDATE jobs SET state = ?, attempts = ?, lease_token = ?, "
+                "lease_until = ? WHERE id = ?",
+                (RUNNING, attempts + 1, token, now + self.lease_seconds, job_id))
+        if attempts:
+            logger.info(f"Retrying {kind} job {job_id}, attempt {attempts + 1}")
+        return Job(job_id, kind, json.loads(payload), attempts + 1, token,
+                   self.max_attempts)
+
+    def renew(self, job):
+        """Extend the lease of a running job. Returns False if it was lost."""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_token = ?",
+                (time.time() + self.lease_seconds, job.id, job.token))
+        return cursor.rowcount == 1
+
+    def complete(self, job):
+        self._finish(job, DONE, time.time(), None)
+
+    def fail(self, job, error):
+        """Record a failed attempt, queueing a retry unless it was the last"""
+        if job.final_attempt:
+            logger.error(f"{job.kind} job {job.id} failed for good after "
+                         f"{job.attempts} attempts: {error}")
+            self._finish(job, FAILED, time.time(), error)
+            return
+        delay = self.retry_seconds * 2 ** (job.attempts - 1)
+        logger.warning(f"{job.kind} job {job.id} failed, retrying in "
+                       f"{delay:.0f}s: {error}")
+        self._finish(job, QUEUED, time.time() + delay, error)
+
+    def _finish(self, job, state, when, error):
+        finished = when if state in (DONE, FAILED) else None
+        available = when if state == QUEUED else None
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, available_at = COALESCE(?, available_at), "
+                "finished_at = ?, lease_token = NULL, lease_until = NULL, "
+                "last_error = COALESCE(?, last_error), stages = ? "
+                "WHERE id = ? AND lease_token = ?",
+                (state, available, finished, str(error) if error else None,
+                 json.dumps(job.stages), job.id, job.token))
+
+    def metrics(self):
+        """Jobs per state and kind, the oldest waiting job and stage timings"""
+        now = time.time()
+        with self._lock:
+            counts = self._db.execute(
+                "SELECT kind, state, COUNT(*) FROM jobs GROUP BY kind, state").fetchall()
+            oldest = self._db.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+            retrying = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = ? AND attempts > 0",
+                (QUEUED,)).fetchone()[0]
+            history = self._db.execute(
+                "SELECT stages, finished_at - created_at FROM jobs WHERE state = ? "
+                "ORDER BY finished_at DESC LIMIT ?", (DONE, METRICS_HISTORY)).fetchall()
+
+        jobs = {}
+        for kind, state, count in counts:
+            jobs.setdefault(kind, {})[state] = count
+        stages = {}
+        for stage_json, latency in history:
+            timings = json.loads(stage_json or "{}")
+            timings["enqueue_to_done"] = latency
+            for name, seconds in timings.items():
+                stages.setdefault(name, []).append(seconds)
+        return {
+            "jobs": jobs,
+            "retrying": retrying,
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest else 0.0,
+            "stages": {name: {"mean_seconds": round(sum(values) / len(values), 2),
+                              "max_seconds": round(max(values), 2),
+                              "count": len(values)}
+                       for name, values in sorted(stages.items())}
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JobWorkerPool:
+    """
+    Threads that claim jobs and run the handler registered for their kind.
+    A handler takes the Job and raises to have it retried.
+    """
+
+    def __init__(self, queue, handlers, workers=JOB_WORKERS):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = max(workers, 1)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{index}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job worker(s) on {self.queue.path}")
+
+    def stop(self, timeout=None):
+        """
+        Stop claiming jobs and wait up to timeout for running ones. Jobs
+        still running are picked up again after a restart.
+        """
+        self._stop.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None
+                        else max(deadline - time.monotonic(), 0))
+
+    def _work(self):
+        kinds = list(self.handlers)
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(kinds)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to claim a job: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(POLL_SECONDS)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(job, done),
+                                   name=f"job-lease-{job.id}", daemon=True)
+        renewer.start()
+        try:
+            logger.info(f"Processing {job.kind} job {job.id}")
+            with job.stage("total"):
+                self.handlers[job.kind](job)
+            self.queue.complete(job)
+            logger.info(f"Finished {job.kind} job {job.id}: "
+                        f"{ {name: round(seconds, 1) for name, seconds in job.stages.items()} }")
+        except Exception as e:
+            logger.exception(f"{job.kind} job {job.id} failed")
+            self.queue.fail(job, e)
+        finally:
+            done.set()
+            renewer.join()
+        logger.info(f"Job queue: {self.queue.metrics()['jobs']}")
+
+    def _renew(self, job, done):
+        while not done.wait(self.queue.lease_seconds / 3):
+            try:
+                if not self.queue.renew(job):
+                    logger.warning(f"Lost the lease of job {job.id}")
+                    return
+            except sqlite3.Error as e:
+                logger.error(f"Failed to renew the lease of job {job.id}: {e}")
@@ -0,0 +1,491 @@
+"""
+Joining encoded recording segments without decoding them.
+
+Segments are independent FLAC or Ogg/Opus streams. Instead of decoding them
+and encoding the audio again, their frames or pages are copied into one
+stream:
+
+- FLAC: every segment but the last ends with a short frame, which a
+  fixed-blocksize stream may only have at its end, so the frame headers are
+  rewritten to the variable-blocksize form, numbered by their first sample.
+- Ogg/Opus: the first segment's OpusHead and OpusTags are kept and the
+  audio pages of every segment follow as one logical stream, with the
+  granule positions, serial number and page sequence carried on. Ogg Opus
+  can only trim samples at the start and end of a stream, so Opus segments
+  overlap by whole packets instead: each one after the first starts with a
+  lead-in, the end of the segment before, which with the pre-skip fills
+  whole packets, and each one before the last ends with a lead-out, the
+  start of the segment after. Those packets are left out, so the stream
+  decodes to exactly the audio of the segments, and the packets on both
+  sides of a seam were encoded with the audio around it, so the decoder
+  carries on across it without a click.
+
+Only header bytes change, except on the pages of an Opus segment that
+packets are cut from. FLAC and Ogg checksums are plain CRCs, which are
+linear, so a frame or page's CRC is updated from the old one and the
+difference of the headers instead of being computed over the whole frame.
+A frame or page cut off by a crash is left out. Streams that cannot be
+joined this way raise ValueError.
+"""
+import bisect
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+FLAC_MAGIC = b"fLaC"
+FLAC_STREAMINFO = 0
+FLAC_SEEKTABLE = 3
+# Samples per frame of the block size codes with a fixed size
+FLAC_BLOCK_SIZES = {1: 192, 2: 576, 3: 1152, 4: 2304, 5: 4608,
+                    8: 256, 9: 512, 10: 1024, 11: 2048, 12: 4096,
+                    13: 8192, 14: 16384, 15: 32768}
+
+OGG_CAPTURE = b"OggS"
+OGG_HEADER_SIZE = 27
+OGG_CONTINUED = 0x01
+OGG_EOS = 0x04
+
+
+class _Crc:
+    """MSB-first CRC with a zero initial value and no final XOR, as FLAC and Ogg use"""
+
+    def __init__(self, poly, width):
+        self.poly = poly | 1 << width
+        self.width = width
+        top, mask = 1 << (width - 1), (1 << width) - 1
+        self.table = []
+        for byte in range(256):
+            crc = byte << (width - 8)
+            for _ in range(8):
+                crc = (crc << 1) ^ poly if crc & top else crc << 1
+            self.table.append(crc & mask)
+        # x^(8 * 2^k) modulo the polynomial: the effect of 2^k zero bytes
+        self.zero_bytes = [self._mulmod(1 << 4, 1 << 4)]
+        for _ in range(40):
+            self.zero_bytes.append(self._mulmod(self.zero_bytes[-1], self.zero_bytes[-1]))
+
+    def __call__(self, data):
+        shift, mask, table = self.width - 8, (1 << self.width) - 1, self.table
+        crc = 0
+        for byte in data:
+            crc = ((crc << 8) & mask) ^ table[(crc >> shift) ^ byte]
+        return crc
+
+    def _mulmod(self, a, b):
+        result = 0
+        while b:
+            if b & 1:
+                result ^= a
+            b >>= 1
+            a <<= 1
+            if a >> self.width:
+                a ^= self.poly
+        return result
+
+    def skip(self, crc, length):
+        """The CRC register after length more zero bytes"""
+        k = 0
+        while length:
+            if length & 1:
+                crc = self._mulmod(crc, self.zero_bytes[k])
+            length >>= 1
+            k += 1
+        return crc
+
+
+_crc8 = _Crc(0x07, 8)
+_crc16 = _Crc(0x8005, 16)
+_crc32 = _Crc(0x04C11DB7, 32)
+
+
+def _read_coded_number(data, offset):
+    """(value, end) of a UTF-8 style coded number, or None"""
+    first = data[offset]
+    if first < 0x80:
+        return first, offset + 1
+    length = 0
+    while length < 8 and first & (0x80 >> length):
+        length += 1
+    if not 2 <= length <= 7 or offset + length > len(data):
+        return None
+    value = first & (0x7F >> length)
+    for byte in data[offset + 1:offset + length]:
+        if byte & 0xC0 != 0x80:
+            return None
+        value = value << 6 | byte & 0x3F
+    return value, offset + length
+
+
+def _coded_number(value):
+    if value < 0x80:
+        return bytes([value])
+    length = 2
+    while value >= 1 << (5 * length + 1):
+        length += 1
+    tail = []
+    for _ in range(length - 1):
+        tail.append(0x80 | value & 0x3F)
+        value >>= 6
+    return bytes([(0xFF << (8 - length)) & 0xFF | value] + tail[::-1])
+
+
+def _flac_frame_header(data, offset):
+    """
+    Parse the frame header at offset.
+
+    Returns:
+        tuple: (number, block size, number start, number end, header end),
+               or None if there is no valid header at offset
+    """
+    if offset + 6 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xFE != 0xF8:
+        return None
+    block_code, rate_code = data[offset + 2] >> 4, data[offset + 2] & 0x0F
+    if block_code == 0 or rate_code == 15 or data[offset + 3] & 1 \
+            or data[offset + 3] >> 4 > 10:
+        return None
+    coded = _read_coded_number(data, offset + 4)
+    if coded is None:
+        return None
+    number, position = coded
+    if position + 3 > len(data):
+        return None
+    if block_code == 6:
+        block_size = data[position] + 1
+        position += 1
+    elif block_code == 7:
+        block_size = int.from_bytes(data[position:position + 2], "big") + 1
+        position += 2
+    else:
+        block_size = FLAC_BLOCK_SIZES[block_code]
+    if rate_code == 12:
+        position += 1
+    elif rate_code in (13, 14):
+        position += 2
+    if position >= len(data) or _crc8(data[offset:position]) != data[position]:
+        return None
+    return number, block_size, offset + 4, coded[1], position + 1
+
+
+def _flac_metadata(data):
+    """([(type, body)] of the metadata blocks, offset of the first frame)"""
+    if data[:4] != FLAC_MAGIC:
+        raise ValueError("not a FLAC stream")
+    blocks, offset = [], 4
+    while True:
+        if offset + 4 > len(data):
+            raise ValueError("truncated FLAC metadata")
+        flags = data[offset]
+        length = int.from_bytes(data[offset + 1:offset + 4], "big")
+        blocks.append((flags & 0x7F, data[offset + 4:offset + 4 + length]))
+        offset += 4 + length
+        if flags & 0x80:
+            return blocks, offset
+
+
+def _flac_metadata_bytes(streaminfo, blocks):
+    blocks = [(FLAC_STREAMINFO, streaminfo)] + blocks
+    return FLAC_MAGIC + b"".join(
+        bytes([block_type | (0x80 if index == len(blocks) - 1 else 0)]) +
+        len(body).to_bytes(3, "big") + body
+        for index, (block_type, body) in enumerate(blocks))
+
+
+def _flac_frames(data, offset):
+    """
+    Yield (start, end, header) of the frames of a stream. A frame ends at
+    the next header that parses, passes its CRC-8 and carries the next
+    frame or sample number; the last frame is dropped if its CRC-16 fails.
+    """
+    header = _flac_frame_header(data, offset)
+    if header is None:
+        raise ValueError("no FLAC frame after the metadata")
+    sync = data[offset:offset + 2]
+    variable = sync[1] & 1
+    index, sample = 0, 0
+    while header is not None:
+        number, block_size = header[0], header[1]
+        if number != (sample if variable else index):
+            raise ValueError(f"FLAC frame {index} is out of sequence")
+        expected = sample + block_size if variable else index + 1
+        following, search = None, header[4]
+        while following is None:
+            candidate = data.find(sync, search)
+            if candidate < 0:
+                break
+            following = _flac_frame_header(data, candidate)
+            if following is not None and following[0] != expected:
+                following = None
+            search = candidate + 1
+        end = candidate if following is not None else len(data)
+        if following is None and \
+                _crc16(data[offset:end - 2]) != int.from_bytes(data[end - 2:end], "big"):
+            logger.warning(f"Dropping the truncated last FLAC frame {index}")
+            return
+        yield offset, end, header
+        offset, header = end, following
+        index, sample = index + 1, sample + block_size
+
+
+def _variable_frame_header(data, start, end, header, sample):
+    """(header, CRC-16) of a frame with a variable-blocksize header numbered sample"""
+    _, _, number_start, number_end, header_end = header
+    prefix = b"\xff\xf9" + data[start + 2:number_start] + _coded_number(sample) + \
+        data[number_end:header_end - 1]
+    new_header = prefix + bytes([_crc8(prefix)])
+    difference = _crc16(data[start:header_end]) ^ _crc16(new_header)
+    crc = int.from_bytes(data[end - 2:end], "big") ^ \
+        _crc16.skip(difference, end - 2 - header_end)
+    return new_header, crc.to_bytes(2, "big")
+
+
+def concat_flac(paths, output_path, lead_ins=None, lead_outs=None):
+    """
+    Join FLAC files of the same format into one variable-blocksize stream.
+    FLAC segments are written without lead-ins or lead-outs.
+
+    Returns:
+        int: Samples per channel written
+    """
+    if any(lead_ins or []) or any(lead_outs or []):
+        raise ValueError("FLAC segments cannot overlap")
+    stream_format, kept_blocks = None, None
+    block_sizes, frame_sizes = [], []
+    total = 0
+    with open(output_path, "wb") as output:
+        for path in paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            blocks, offset = _flac_metadata(data)
+            if blocks[0][0] != FLAC_STREAMINFO:
+                raise ValueError(f"{path} has no STREAMINFO")
+            # Sample rate, channels and bits per sample
+            segment_format = int.from_bytes(blocks[0][1][10:18], "big") >> 36
+            if kept_blocks is None:
+                # The first segment's tags are kept; its seek table would
+                # only point into the first segment
+                stream_format = segment_format
+                kept_blocks = [(block_type, body) for block_type, body in blocks[1:]
+                               if block_type != FLAC_SEEKTABLE]
+                # Filled in once the totals are known
+                output.write(bytes(len(_flac_metadata_bytes(bytes(34), kept_blocks))))
+            elif segment_format != stream_format:
+                raise ValueError(f"{path} has a different FLAC format")
+
+            for start, end, header in _flac_frames(data, offset):
+                new_header, crc = _variable_frame_header(data, start, end, header, total)
+                output.write(new_header)
+                output.write(memoryview(data)[header[4]:end - 2])
+                output.write(crc)
+                block_sizes.append(header[1])
+                frame_sizes.append(len(new_header) + end - header[4])
+                total += header[1]
+
+        if not frame_sizes:
+            raise ValueError("no FLAC frames to join")
+        # The MD5 of the audio is left unknown
+        streaminfo = (
+            min(block_sizes[:-1] or block_sizes).to_bytes(2, "big") +
+            max(block_sizes).to_bytes(2, "big") +
+            min(frame_sizes).to_bytes(3, "big") +
+            max(frame_sizes).to_bytes(3, "big") +
+            (stream_format << 36 | total).to_bytes(8, "big") +
+            bytes(16))
+        output.seek(0)
+        output.write(_flac_metadata_bytes(streaminfo, kept_blocks))
+    return total
+
+
+def _ogg_pages(data, path):
+    """Yield (start, end) of the complete pages of an Ogg file"""
+    offset = 0
+    while offset < len(data):
+        end = len(data) + 1
+        if offset + OGG_HEADER_SIZE <= len(data):
+            if data[offset:offset + 4] != OGG_CAPTURE:
+                raise ValueError(f"{path} has no Ogg page at byte {offset}")
+            lacing_end = offset + OGG_HEADER_SIZE + data[offset + 26]
+            if lacing_end <= len(data):
+                end = lacing_end + sum(data[offset + OGG_HEADER_SIZE:lacing_end])
+        if end > len(data):
+            logger.warning(f"Dropping the truncated last Ogg page of {path}")
+            return
+        yield offset, end
+        offset = end
+
+
+def _ogg_packets(data, pages):
+    """Yield (index of the page it ends on, first bytes) of every packet"""
+    head = None
+    for index, (start, _) in enumerate(pages):
+        lacing_end = start + OGG_HEADER_SIZE + data[start + 26]
+        position = lacing_end
+        for size in data[start + OGG_HEADER_SIZE:lacing_end]:
+            head = head or b""
+            if len(head) < 16:
+                head += data[position:position + min(size, 16 - len(head))]
+            position += size
+            if size < 255:
+                yield index, head
+                head = None
+
+
+def _opus_samples(packet_head):
+    """Samples at 48 kHz in an Opus packet, from its TOC byte"""
+    if not packet_head:
+        return 0
+    toc = packet_head[0]
+    config = toc >> 3
+    if config < 12:
+        frame_size = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        frame_size = (480, 960)[config % 2]
+    else:
+        frame_size = (120, 240, 480, 960)[config % 4]
+    code = toc & 3
+    if code == 0:
+        return frame_size
+    if code < 3:
+        return 2 * frame_size
+    return frame_size * (packet_head[1] & 0x3F if len(packet_head) > 1 else 0)
+
+
+def _ogg_page_header(data, start, end, flags, granule, serial, sequence):
+    """The first 26 bytes of a page with new flags, granule, serial and sequence"""
+    header = bytearray(data[start:start + 22])
+    header[5] = flags
+    header[6:14] = granule.to_bytes(8, "little", signed=True)
+    header[14:18] = serial.to_bytes(4, "little")
+    header[18:22] = sequence.to_bytes(4, "little")
+    difference = bytes(old ^ new for old, new in zip(data[start:start + 22], header))
+    crc = int.from_bytes(data[start + 22:start + 26], "little") ^ \
+        _crc32.skip(_crc32(difference), end - start - 22)
+    return header + crc.to_bytes(4, "little")
+
+
+def _ogg_page_part(data, start, end, first, stop):
+    """
+    The segment count, lacing values and data of a page reduced to its
+    lacing values from index first up to stop
+    """
+    lacing_end = start + OGG_HEADER_SIZE + data[start + 26]
+    lacing = data[start + OGG_HEADER_SIZE:lacing_end]
+    body_start = lacing_end + sum(lacing[:first])
+    body_end = body_start + sum(lacing[first:stop])
+    return bytes([stop - first]) + lacing[first:stop] + data[body_start:body_end]
+
+
+def concat_opus(paths, output_path, lead_ins=None, lead_outs=None):
+    """
+    Join Ogg Opus files with the same channel count into one logical stream.
+
+    Args:
+        lead_ins: Samples at 48 kHz at the start of each file that repeat the
+                  end of the file before it; with the pre-skip they must be
+                  a whole number of packets
+        lead_outs: Samples at 48 kHz at the end of each file that repeat the
+                   start of the file after it; a whole number of packets
+
+    Returns:
+        int: Samples at 48 kHz in the stream, pre-skip included
+    """
+    lead_ins = lead_ins or [0] * len(paths)
+    lead_outs = lead_outs or [0] * len(paths)
+    if lead_ins[0] or lead_outs[-1]:
+        raise ValueError("the first file cannot have a lead-in, nor the last "
+                         "a lead-out")
+    serial, channels = None, None
+    sequence, offset = 0, 0
+    with open(output_path, "wb") as output:
+        for number, path in enumerate(paths):
+            with open(path, "rb") as f:
+                data = f.read()
+            pages = list(_ogg_pages(data, path))
+            packets = list(_ogg_packets(data, pages))
+            if len(packets) < 2 or not packets[0][1].startswith(b"OpusHead"):
+                raise ValueError(f"{path} is not an Ogg Opus stream")
+            if len({data[start + 14:start + 18] for start, _ in pages}) > 1:
+                raise ValueError(f"{path} has more than one logical stream")
+            segment_channels = packets[0][1][9]
+            last = number == len(paths) - 1
+            if serial is None:
+                serial = int.from_bytes(data[14:18], "little")
+                channels = segment_channels
+                # OpusHead and OpusTags
+                for start, end in pages[:packets[1][0] + 1]:
+                    output.write(memoryview(data)[start:end])
+                    sequence += 1
+                drop = 0
+            elif segment_channels != channels:
+                raise ValueError(f"{path} has a different channel count")
+            else:
+                # The pre-skip and lead-in repeat audio already in the stream
+                drop = int.from_bytes(packets[0][1][10:12], "little") + lead_ins[number]
+
+            # Sample position in the file at the end of each audio packet
+            ends = list(itertools.accumulate(
+                _opus_samples(head) for _, head in packets[2:]))
+            first = bisect.bisect_right(ends, drop)
+            if last and first == len(ends):
+                logger.warning(f"{path} ends before its lead-in, leaving it out")
+                break
+            if drop and (not first or ends[first - 1] != drop):
+                raise ValueError(f"{path} has no packet boundary where its "
+                                 f"pre-skip and lead-in end")
+            stop = len(ends)
+            if not last:
+                start = pages[-1][0]
+                if not data[start + 5] & OGG_EOS:
+                    raise ValueError(f"{path} was not closed")
+                # The lead-out and the end padding are left out
+                keep = int.from_bytes(data[start + 6:start + 14], "little") - \
+                    lead_outs[number]
+                stop = bisect.bisect_right(ends, keep)
+                if not stop or ends[stop - 1] != keep:
+                    raise ValueError(f"{path} has no packet boundary where its "
+                                     f"lead-out starts")
+            if stop <= first:
+                raise ValueError(f"{path} has no audio between its lead-in "
+                                 f"and lead-out")
+
+            # Audio starts on the page after the one OpusTags ends on
+            packet = 0
+            for start, end in pages[packets[1][0] + 1:]:
+                flags = data[start + 5]
+                granule = int.from_bytes(data[start + 6:start + 14], "little", signed=True)
+                lacing = data[start + OGG_HEADER_SIZE:start + OGG_HEADER_SIZE + data[start + 26]]
+                completed = packet
+                kept = []
+                for index, size in enumerate(lacing):
+                    if first <= packet < stop:
+                        kept.append(index)
+                    if size < 255:
+                        packet += 1
+                if not kept:
+                    continue
+                if not (last and flags & OGG_EOS):
+                    # Only the end of the stream is trimmed to the granule
+                    flags &= ~OGG_EOS
+                    done = min(packet, stop) - 1
+                    granule = ends[done] if done >= max(completed, first) else -1
+                if granule != -1:
+                    granule += offset - drop
+
+                if len(kept) == len(lacing):
+                    output.write(_ogg_page_header(data, start, end, flags, granule,
+                                                  serial, sequence))
+                    output.write(memoryview(data)[start + 26:end])
+                else:
+                    if kept[0]:
+                        # The page now starts with a packet of its own
+                        flags &= ~OGG_CONTINUED
+                    page = bytearray(_ogg_page_header(
+                        data, start, end, flags, granule, serial, sequence))
+                    page += _ogg_page_part(data, start, end, kept[0], kept[-1] + 1)
+                    # Packets were cut out, so the CRC is computed afresh
+                    page[22:26] = bytes(4)
+                    page[22:26] = _crc32(page).to_bytes(4, "little")
+                    output.write(page)
+                sequence += 1
+            offset += ends[stop - 1] - drop
+    return offset
@@ -0,0 +1,344 @@
+"""
+Rate-limit-aware scheduling of outbound AI API requests.
+
+Every speech-to-text upload and chat completion acquires a slot from the
+process-wide scheduler before it is sent. Limits are token buckets per
+provider or model, so several recordings finishing at once are spread over
+the allowed rate instead of running into 429s. Waiting requests are served
+by priority class, then in arrival order.
+
+The priority of a request comes from the caller's context (see priority()),
+so it does not have to be passed down through every function on the way.
+Worker threads and event-loop tasks do not inherit it; submit work to them
+through bind_priority() or with_priority(). A caller that may give up on
+its requests, like the losing side of a hedged transcription, runs them in
+cancellation(); once its event is set, a request still waiting leaves the
+queue without taking a slot and raises RequestCancelled.
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+import contextlib
+import contextvars
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower is served first: audio of a meeting in progress,
+# a meeting that just ended, and reprocessing of old recordings
+PRIORITY_LIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKFILL = 2
+PRIORITY_NAMES = {PRIORITY_LIVE: "live", PRIORITY_DEFAULT: "default",
+                  PRIORITY_BACKFILL: "backfill"}
+
+# Comma-separated key=requests_per_minute[:tokens_per_minute]; keys are
+# provider or model names, and requests for other keys are not limited
+RATE_LIMITS = os.getenv(
+    "RATE_LIMITS", "elevenlabs=30,whisper-1=50,gpt-4o=500:30000")
+# Request buckets hold this many seconds of their rate, since providers
+# enforce per-minute request limits over shorter intervals
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "1"))
+# Token buckets hold this many seconds of their rate. Token limits are
+# enforced per minute, and a single chunk summary is a sizeable part of the
+# budget, so a short burst would let only one request through at a time.
+RATE_LIMIT_TOKEN_BURST_SECONDS = float(
+    os.getenv("RATE_LIMIT_TOKEN_BURST_SECONDS", "60"))
+# Pause after a 429 that did not say how long to wait
+RATE_LIMIT_PENALTY_SECONDS = float(os.getenv("RATE_LIMIT_PENALTY_SECONDS", "10"))
+# Requests that waited longer than this are logged with the queue depth
+SLOW_ACQUIRE_SECONDS = 1.0
+# Async waiters that are not at the head of the queue poll this often
+ASYNC_POLL_SECONDS = 0.05
+# Waiters that can be cancelled check for it this often
+CANCEL_POLL_SECONDS = 0.1
+
+_priority = contextvars.ContextVar("priority", default=PRIORITY_DEFAULT)
+_cancelled = contextvars.ContextVar("cancelled", default=None)
+
+
+class RequestCancelled(Exception):
+    """The caller gave up on the request before it was sent"""
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens per second up to capacity. A request larger than
+    the bucket is let through once the bucket is full and leaves it in debt,
+    so later requests wait until its cost has been paid off.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost, now):
+        """Seconds until cost tokens are available"""
+        self._refill(now)
+        missing = min(cost, self.capacity) - self.tokens
+        return max(missing / self.rate, 0.0)
+
+    def consume(self, cost, now):
+        self._refill(now)
+        self.tokens -= cost
+
+
+class RateLimit:
+    """Request and optional token buckets of one provider or model"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None,
+                 burst_seconds=RATE_LIMIT_BURST_SECONDS,
+                 token_burst_seconds=RATE_LIMIT_TOKEN_BURST_SECONDS):
+        self.requests = self._bucket(requests_per_minute, burst_seconds)
+        self.tokens = None
+        if tokens_per_minute:
+            self.tokens = self._bucket(tokens_per_minute, token_burst_seconds)
+        self.paused_until = 0.0
+
+    @staticmethod
+    def _bucket(per_minute, burst_seconds):
+        rate = per_minute / 60
+        return TokenBucket(rate, max(rate * burst_seconds, 1.0))
+
+    def delay(self, tokens, now):
+        delay = max(self.paused_until - now, self.requests.delay(1, now))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    def consume(self, tokens, now):
+        self.requests.consume(1, now)
+        if self.tokens is not None and tokens:
+            self.tokens.consume(tokens, now)
+
+
+def parse_rate_limits(spec):
+    """Parse RATE_LIMITS into {key: RateLimit}"""
+    limits = {}
+    for item in spec.split(","):
+        key, _, value = item.strip().partition("=")
+        if not key or not value:
+            continue
+        requests, _, tokens = value.partition(":")
+        limits[key.strip()] = RateLimit(
+            float(requests), float(tokens) if tokens else None)
+    return limits
+
+
+class RateLimitScheduler:
+    """
+    Grants request slots per key from its RateLimit.
+
+    Each key has a queue of waiters ordered by (priority, arrival); only the
+    head of the queue may take tokens, so a backfill request never overtakes
+    a live one, and the bucket never hands out slots out of order.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._queues = defaultdict(list)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._granted = defaultdict(int)
+        self._throttled = defaultdict(int)
+        self._wait_seconds = defaultdict(float)
+        self._max_wait = defaultdict(float)
+
+    def acquire(self, key, tokens=0, priority=None):
+        """
+        Block until a request for key may be sent.
+
+        Args:
+            key: Provider or model name
+            tokens: Tokens the request will use, for limits that count them
+            priority: Priority class, by default the one of the context
+
+        Returns:
+            float: Seconds spent waiting
+
+        Raises:
+            RequestCancelled: when the context's cancellation is set
+        """
+        cancelled = _cancelled.get()
+        _check_cancelled(cancelled, key)
+        limit = self.limits.get(key)
+        if limit is None:
+            return self._record(key, 0.0)
+        entry = self._enqueue(key, priority)
+        started = time.monotonic()
+        try:
+            with self._condition:
+                while True:
+                    _check_cancelled(cancelled, key)
+                    delay = self._try_grant(key, limit, entry, tokens)
+                    if delay is None:
+                        break
+                    if cancelled is not None:
+                        delay = min(delay or CANCEL_POLL_SECONDS, CANCEL_POLL_SECONDS)
+                    self._condition.wait(delay or None)
+        except BaseException:
+            self._dequeue(key, entry)
+            raise
+        return self._record(key, time.monotonic() - started)
+
+    async def acquire_async(self, key, tokens=0, priority=None):
+        """acquire() for coroutines, waiting without blocking the event loop"""
+        cancelled = _cancelled.get()
+        _check_cancelled(cancelled, key)
+        limit = self.limits.get(key)
+        if limit is None:
+            return self._record(key, 0.0)
+        entry = self._enqueue(key, priority)
+        started = time.monotonic()
+        try:
+            while True:
+                _check_cancelled(cancelled, key)
+                with self._condition:
+                    delay = self._try_grant(key, limit, entry, tokens)
+                if delay is None:
+                    break
+                await asyncio.sleep(min(delay, 1.0) if delay else ASYNC_POLL_SECONDS)
+        except BaseException:
+            self._dequeue(key, entry)
+            raise
+        return self._record(key, time.monotonic() - started)
+
+    def penalize(self, key, seconds=None):
+        """Pause key after the provider answered 429"""
+        limit = self.limits.get(key)
+        seconds = RATE_LIMIT_PENALTY_SECONDS if seconds is None else seconds
+        with self._condition:
+            self._throttled[key] += 1
+            if limit is not None:
+                limit.paused_until = max(limit.paused_until,
+                                         time.monotonic() + seconds)
+        logger.warning(f"{key} is rate limited, pausing requests for {seconds:.1f}s")
+
+    def metrics(self):
+        """Queue depth per priority class, grants, 429s and waiting time per key"""
+        with self._condition:
+            keys = set(self.limits) | set(self._granted) | set(self._throttled)
+            result = {}
+            for key in sorted(keys):
+                queued = defaultdict(int)
+                for priority, _ in self._queues.get(key, ()):
+                    queued[PRIORITY_NAMES.get(priority, str(priority))] += 1
+                granted = self._granted[key]
+                result[key] = {
+                    "queued": dict(queued),
+                    "granted": granted,
+                    "throttled": self._throttled[key],
+                    "mean_wait_seconds": round(
+                        self._wait_seconds[key] / granted, 3) if granted else 0.0,
+                    "max_wait_seconds": round(self._max_wait[key], 3)
+                }
+            return result
+
+    def _enqueue(self, key, priority):
+        if priority is None:
+            priority = _priority.get()
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._queues[key], entry)
+        return entry
+
+    def _dequeue(self, key, entry):
+        with self._condition:
+            queue = self._queues[key]
+            if entry in queue:
+                queue.remove(entry)
+                heapq.heapify(queue)
+            self._condition.notify_all()
+
+    def _try_grant(self, key, limit, entry, tokens):
+        """
+        Grant the slot if entry is at the head of the queue and the limit
+        allows it. Returns None when granted, otherwise the seconds to wait
+        (0 meaning until another waiter is granted). Call with the lock held.
+        """
+        queue = self._queues[key]
+        if queue[0] != entry:
+            return 0
+        now = time.monotonic()
+        delay = limit.delay(tokens, now)
+        if delay > 0:
+            return delay
+        limit.consume(tokens, now)
+        heapq.heappop(queue)
+        self._condition.notify_all()
+        return None
+
+    def _record(self, key, waited):
+        with self._condition:
+            self._granted[key] += 1
+            self._wait_seconds[key] += waited
+            self._max_wait[key] = max(self._max_wait[key], waited)
+            queued = len(self._queues.get(key, ()))
+        if waited > SLOW_ACQUIRE_SECONDS:
+            logger.info(f"Waited {waited:.1f}s for the {key} rate limit, "
+                        f"{queued} request(s) still queued")
+        return waited
+
+
+def _check_cancelled(cancelled, key):
+    if cancelled is not None and cancelled.is_set():
+        raise RequestCancelled(f"{key} request cancelled")
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Run the block's requests with the given priority class"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def bind_priority(function):
+    """Wrap function to run with the caller's current priority, for executors"""
+    level = _priority.get()
+
+    def run(*args, **kwargs):
+        with priority(level):
+            return function(*args, **kwargs)
+    return run
+
+
+def current_cancellation():
+    """The threading.Event that cancels the context's requests, or None"""
+    return _cancelled.get()
+
+
+@contextlib.contextmanager
+def cancellation(event):
+    """Give up on the block's requests once event is set"""
+    token = _cancelled.set(event)
+    try:
+        yield
+    finally:
+        _cancelled.reset(token)
+
+
+async def with_priority(coroutine, level):
+    """Await a coroutine with the given priority, for other event loops"""
+    with priority(level):
+        return await coroutine
+
+
+scheduler = RateLimitScheduler(parse_rate_limits(RATE_LIMITS))
@@ -0,0 +1,404 @@
+"""
+Recordings written as segments and joined back together.
+
+A recording and its 16 kHz STT derivative are written as segments of a minute
+by default, listed in a manifest next to them, so the closed segments
+survive a crash and can be processed while the call is still running. When
+the recording stops, or on startup after a crash, finalize_recording joins
+them into the final files.
+"""
+import os
+import json
+import shutil
+import logging
+import numpy
+import scipy.signal
+import soundfile as sf
+from datetime import datetime, timezone
+
+from remux import concat_flac, concat_opus
+
+logger = logging.getLogger(__name__)
+
+# Containers/codecs a recording can be encoded to while it is being captured.
+# FLAC is lossless at 24 bits, OGG/Opus is lossy but much smaller for speech.
+# "concat" joins a recording's segments without decoding them; WAV segments
+# are copied sample by sample.
+OUTPUT_FORMATS = {
+    "wav": {"format": "WAV", "subtype": "FLOAT", "extension": ".wav",
+            "concat": None},
+    "flac": {"format": "FLAC", "subtype": "PCM_24", "extension": ".flac",
+             "concat": concat_flac},
+    "opus": {"format": "OGG", "subtype": "OPUS", "extension": ".ogg",
+             "concat": concat_opus},
+}
+OUTPUT_FORMAT = os.environ.get('AUDIO_OUTPUT_FORMAT', 'flac').lower()
+
+# Speech-to-text only needs 16 kHz mono 16-bit audio, so a derivative in that
+# format is written alongside every recording and uploaded instead of it.
+STT_RATE = 16000
+STT_SUFFIX = "_16k.wav"
+
+# Recordings are written as segments of this many seconds, listed in a
+# manifest, so closed segments survive a crash and can be processed while the
+# call is still running. 0 writes a single segment.
+SEGMENT_SECONDS = float(os.environ.get('AUDIO_SEGMENT_SECONDS', '60'))
+SEGMENTS_SUFFIX = ".segments"
+MANIFEST_NAME = "manifest.json"
+
+# libsndfile encodes Opus at 48 kHz in packets of 20 ms, and the encoder's
+# look-ahead delays its output by a pre-skip of 312 samples. Opus segments
+# are cut on packet boundaries and overlap by whole packets, which
+# concat_opus leaves out again.
+OPUS_RATE = 48000
+OPUS_PACKET_FRAMES = 960
+OPUS_PRESKIP = 312
+# Packets at the start of a segment, pre-skip included, that repeat the end
+# of the previous one, and at its end that repeat the start of the next one.
+# With fewer, the decoder's state at a seam differs from what the encoder
+# assumed and the seam clicks.
+OPUS_LEAD_IN_PACKETS = 2
+OPUS_LEAD_OUT_PACKETS = 1
+
+
+class StreamingDownsampler:
+    """
+    Downmix to mono and decimate by an integer factor block by block.
+
+    The anti-aliasing FIR is evaluated polyphase-style: only the output
+    samples that survive decimation are computed, as one matrix product over
+    strided windows. The filter history carries over between blocks, so the
+    output has no seams at block boundaries.
+    """
+
+    def __init__(self, in_rate, out_rate, num_taps=96):
+        if in_rate % out_rate:
+            raise ValueError(
+                f"Cannot decimate {in_rate} Hz to {out_rate} Hz by an integer factor")
+        self.factor = in_rate // out_rate
+        self.taps = scipy.signal.firwin(
+            num_taps, 0.45 * out_rate, fs=in_rate)[::-1].astype(numpy.float32)
+        self.history = numpy.zeros(num_taps - 1, dtype=numpy.float32)
+        self.consumed = 0
+
+    def process(self, frames):
+        """Return the int16 mono samples for a block of float32 frames"""
+        mono = frames.mean(axis=1, dtype=numpy.float32)
+        padded = numpy.concatenate((self.history, mono))
+        first = -self.consumed % self.factor
+        windows = numpy.lib.stride_tricks.sliding_window_view(
+            padded, len(self.taps))[first::self.factor]
+        output = windows @ self.taps
+
+        self.history = padded[len(padded) - len(self.history):]
+        self.consumed += len(mono)
+        return (numpy.clip(output, -1.0, 1.0) * 32767).astype(numpy.int16)
+
+
+class SegmentManifest:
+    """
+    JSON manifest of the segments a recording is being written in.
+
+    It is rewritten atomically every time a segment is opened or closed, so
+    after a crash it always describes a consistent set of files.
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def create(cls, directory, recording_path, stt_path, output_format,
+               samplerate, channels):
+        os.makedirs(directory, exist_ok=True)
+        manifest = cls(os.path.join(directory, MANIFEST_NAME), {
+            "recording": os.path.abspath(recording_path),
+            "stt_recording": os.path.abspath(stt_path),
+            "output_format": output_format,
+            "samplerate": samplerate,
+            "channels": channels,
+            "stt_samplerate": STT_RATE,
+            "segment_seconds": SEGMENT_SECONDS,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "finalized": False,
+            "segments": []
+        })
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.path)
+
+    @property
+    def segments(self):
+        return self.data["segments"]
+
+    def closed_segments(self):
+        """Segments whose files are complete and safe to read"""
+        return [segment for segment in self.segments if segment["closed"]]
+
+    def segment_path(self, segment, key="path"):
+        return os.path.join(self.directory, segment[key])
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class SegmentedWriter:
+    """
+    Write a recording and its STT derivative as fixed-length segments.
+
+    on_segment_closed, if given, is called from the writer thread with the
+    manifest and the segment entry each time a segment is complete, and must
+    return quickly. metadata, if given, is called whenever the manifest is
+    saved and its JSON-serializable result is stored as the manifest's
+    "meeting", so a recording recovered after a crash keeps its details.
+
+    Opus segments overlap: every recording segment after the first starts
+    with a lead-in, the last frames of the one before, and every one before
+    the last is kept open for a lead-out, the first frames of the one after.
+    Both are recorded in the segment entry, as "lead_in" and "lead_out", and
+    are not counted in its "frames". The STT segments do not overlap.
+    """
+
+    def __init__(self, recording_path, stt_path, output_format_name,
+                 samplerate, channels, segment_seconds=SEGMENT_SECONDS,
+                 on_segment_closed=None, metadata=None):
+        self.output_format = OUTPUT_FORMATS[output_format_name]
+        self.segment_frames = int(
+            samplerate * segment_seconds) if segment_seconds > 0 else None
+        self.first_segment_frames = self.segment_frames
+        self.lead_in_frames = 0
+        self.lead_out_frames = 0
+        if self.segment_frames and output_format_name == "opus" and \
+                samplerate == OPUS_RATE:
+            # Every segment, pre-skip and overlaps included, is a whole
+            # number of packets long
+            self.segment_frames = OPUS_PACKET_FRAMES * max(
+                1, round(self.segment_frames / OPUS_PACKET_FRAMES))
+            self.first_segment_frames = self.segment_frames - OPUS_PRESKIP
+            self.lead_in_frames = OPUS_LEAD_IN_PACKETS * OPUS_PACKET_FRAMES - OPUS_PRESKIP
+            self.lead_out_frames = OPUS_LEAD_OUT_PACKETS * OPUS_PACKET_FRAMES
+        self.on_segment_closed = on_segment_closed
+        self.metadata = metadata
+        self.manifest = SegmentManifest.create(
+            os.path.splitext(recording_path)[0] + SEGMENTS_SUFFIX,
+            recording_path, stt_path, output_format_name, samplerate, channels)
+        self.samplerate = samplerate
+        self.channels = channels
+        self.downsampler = StreamingDownsampler(samplerate, STT_RATE)
+        self.frames_written = 0
+        self.segment = None
+        self.audio_file = None
+        self.stt_file = None
+        # The last frames written, for the next segment's lead-in
+        self.tail = numpy.zeros((0, channels), dtype=numpy.float32)
+        # [segment, audio file, STT file, frames] of the segment whose
+        # lead-out is still being written
+        self.ending = None
+
+    def write(self, frames):
+        """Write frames, starting new segments at segment boundaries"""
+        while len(frames):
+            if self.segment is None:
+                self._open_segment()
+            limit = self.first_segment_frames if self.segment["index"] == 1 \
+                else self.segment_frames
+            count = len(frames)
+            if limit:
+                count = min(count, limit - self.segment["frames"])
+            block = frames[:count]
+            self.audio_file.write(block)
+            self.stt_file.write(self.downsampler.process(block))
+            if self.ending:
+                self._write_lead_out(block)
+            if self.lead_in_frames:
+                self.tail = numpy.concatenate(
+                    (self.tail, block[-self.lead_in_frames:]))[-self.lead_in_frames:]
+            self.segment["frames"] += count
+            self.frames_written += count
+            frames = frames[count:]
+            if limit and self.segment["frames"] >= limit:
+                self._end_segment()
+
+    def close(self):
+        """Close the current segment, leaving the manifest complete"""
+        if self.ending and self.segment is None:
+            # Stopped right at the end of a segment, so it is the last one
+            self._close_segment(*self.ending[:3])
+            self.ending = None
+        elif self.ending:
+            # Stopped during the lead-out, which only gives the encoder
+            # look-ahead, so silence can stand in for the rest of it
+            self._write_lead_out(numpy.zeros(
+                (self.lead_out_frames - self.ending[3], self.channels),
+                dtype=numpy.float32))
+        if self.segment is not None:
+            self._end_segment(last=True)
+
+    def _open_segment(self):
+        index = len(self.manifest.segments) + 1
+        self.segment = {
+            "index": index,
+            "path": f"{index:04d}{self.output_format['extension']}",
+            "stt_path": f"{index:04d}{STT_SUFFIX}",
+            "start_frame": self.frames_written,
+            "frames": 0,
+            "lead_in": len(self.tail) if index > 1 else 0,
+            "lead_out": 0,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "ended_at": None,
+            "closed": False
+        }
+        self.audio_file = sf.SoundFile(
+            self.manifest.segment_path(self.segment), mode='w',
+            samplerate=self.samplerate, channels=self.channels,
+            format=self.output_format["format"],
+            subtype=self.output_format["subtype"])
+        if self.segment["lead_in"]:
+            self.audio_file.write(self.tail)
+        self.stt_file = sf.SoundFile(
+            self.manifest.segment_path(self.segment, "stt_path"), mode='w',
+            samplerate=STT_RATE, channels=1, format='WAV', subtype='PCM_16')
+        self.manifest.segments.append(self.segment)
+        self._save_manifest()
+
+    def _end_segment(self, last=False):
+        files = (self.segment, self.audio_file, self.stt_file)
+        self.segment = None
+        if self.lead_out_frames and not last:
+            self.ending = [*files, 0]
+        else:
+            self._close_segment(*files)
+
+    def _write_lead_out(self, block):
+        segment, audio_file, stt_file, written = self.ending
+        block = block[:self.lead_out_frames - written]
+        audio_file.write(block)
+        self.ending[3] += len(block)
+        if self.ending[3] == self.lead_out_frames:
+            segment["lead_out"] = self.lead_out_frames
+            self._close_segment(segment, audio_file, stt_file)
+            self.ending = None
+
+    def _close_segment(self, segment, audio_file, stt_file):
+        audio_file.close()
+        stt_file.close()
+        segment["ended_at"] = datetime.now(timezone.utc).isoformat()
+        segment["closed"] = True
+        self._save_manifest()
+        if self.on_segment_closed:
+            try:
+                self.on_segment_closed(self.manifest, segment)
+            except Exception as e:
+                logger.error(f"Segment callback failed: {str(e)}")
+
+    def _save_manifest(self):
+        if self.metadata:
+            try:
+                self.manifest.data["meeting"] = self.metadata()
+            except Exception as e:
+                logger.error(f"Recording metadata callback failed: {str(e)}")
+        self.manifest.save()
+
+
+def _read_segment_blocks(path, dtype, blocksize, skip=0, frames=None):
+    """
+    Yield the audio of a segment file after its first skip frames, up to
+    frames frames if given, stopping at the first unreadable block
+    """
+    with sf.SoundFile(path) as segment_file:
+        if skip:
+            segment_file.read(skip, dtype=dtype)
+        while frames is None or frames > 0:
+            try:
+                block = segment_file.read(
+                    blocksize if frames is None else min(blocksize, frames),
+                    dtype=dtype)
+            except Exception as e:
+                logger.warning(f"Segment {path} is truncated: {str(e)}")
+                return
+            if not len(block):
+                return
+            if frames is not None:
+                frames -= len(block)
+            yield block
+
+
+def _copy_segments(paths, output_path, samplerate, channels, format, subtype, dtype,
+                   lead_ins=None, lengths=None):
+    """
+    Write the audio of segment files one after another into a new file,
+    leaving out their lead-ins and anything after the first lengths frames
+    """
+    lead_ins = lead_ins or [0] * len(paths)
+    lengths = lengths or [None] * len(paths)
+    with sf.SoundFile(output_path, mode='w', samplerate=samplerate,
+                      channels=channels, format=format, subtype=subtype) as output:
+        for path, lead_in, length in zip(paths, lead_ins, lengths):
+            if os.path.exists(path):
+                for block in _read_segment_blocks(path, dtype, samplerate * 10,
+                                                  lead_in, length):
+                    output.write(block)
+
+
+def finalize_recording(manifest_path):
+    """
+    Join the segments listed in a manifest into the final recording and STT
+    derivative, then remove the segments. FLAC and Opus segments are joined
+    without decoding them; they are only decoded and encoded again if their
+    streams cannot be joined.
+
+    Returns the path of the final recording.
+    """
+    manifest = SegmentManifest.load(manifest_path)
+    data = manifest.data
+    if data["finalized"]:
+        return data["recording"]
+
+    segments = [segment for segment in manifest.segments
+                if os.path.exists(manifest.segment_path(segment))]
+    lead_ins = [segment.get("lead_in", 0) for segment in segments]
+    lead_outs = [segment.get("lead_out", 0) for segment in segments]
+    if len(segments) == 1 and not lead_ins[0]:
+        # A single segment already is the final file
+        os.replace(manifest.segment_path(segments[0]), data["recording"])
+        os.replace(manifest.segment_path(segments[0], "stt_path"),
+                   data["stt_recording"])
+    else:
+        output_format = OUTPUT_FORMATS[data["output_format"]]
+        paths = [manifest.segment_path(segment) for segment in segments]
+        joined = False
+        if output_format["concat"]:
+            try:
+                output_format["concat"](paths, data["recording"], lead_ins,
+                                        lead_outs[:-1] + [0])
+                joined = True
+            except ValueError as e:
+                logger.warning(
+                    f"Could not join the segments of {data['recording']}, "
+                    f"encoding them again: {str(e)}")
+        if not joined:
+            _copy_segments(paths, data["recording"], data["samplerate"],
+                           data["channels"], output_format["format"],
+                           output_format["subtype"], 'float32', lead_ins,
+                           # Only the last segment's length may be out of date
+                           [segment["frames"] for segment in segments[:-1]] + [None])
+        _copy_segments([manifest.segment_path(segment, "stt_path")
+                        for segment in segments],
+                       data["stt_recording"], data["stt_samplerate"], 1,
+                       'WAV', 'PCM_16', 'int16')
+
+    shutil.rmtree(manifest.directory, ignore_errors=True)
+    logger.info(
+        f"Finalized {data['recording']} from {len(segments)} segment(s)")
+    return data["recording"]
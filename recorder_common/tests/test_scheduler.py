@@ -0,0 +1,49 @@
+"""
+Cancelled requests leave the rate-limit queue without taking a slot.
+"""
+import time
+import threading
+
+from scheduler import RateLimit, RateLimitScheduler, RequestCancelled, cancellation
+
+
+def test_cancelled_waiter_does_not_take_a_slot():
+    scheduler = RateLimitScheduler({"stt": RateLimit(60)})
+    scheduler.acquire("stt")
+    cancelled = threading.Event()
+    errors = []
+
+    def wait():
+        with cancellation(cancelled):
+            try:
+                scheduler.acquire("stt")
+            except RequestCancelled as e:
+                errors.append(e)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.05)
+    cancelled.set()
+    waiter.join(timeout=0.5)
+    assert not waiter.is_alive()
+    assert len(errors) == 1
+    metrics = scheduler.metrics()["stt"]
+    assert metrics["granted"] == 1
+    assert metrics["queued"] == {}
+    # The slot it waited for is still there
+    bucket = scheduler.limits["stt"].requests
+    assert bucket.delay(1, time.monotonic()) < 1.0 - 0.05
+
+
+def test_cancelled_request_is_not_queued():
+    scheduler = RateLimitScheduler({"stt": RateLimit(60)})
+    cancelled = threading.Event()
+    cancelled.set()
+    with cancellation(cancelled):
+        try:
+            scheduler.acquire("stt")
+        except RequestCancelled:
+            pass
+        else:
+            raise AssertionError("acquire() did not raise RequestCancelled")
+    assert scheduler.metrics()["stt"]["granted"] == 0
@@ -0,0 +1,107 @@
+"""
+Segmented recordings are joined back into exactly the audio captured.
+"""
+import numpy
+import pytest
+import soundfile as sf
+
+import segments
+from segments import SegmentedWriter, finalize_recording
+
+RATE = 48000
+CHANNELS = 2
+SECONDS = 6.3
+
+
+@pytest.fixture
+def audio():
+    rng = numpy.random.default_rng(0)
+    t = numpy.arange(int(RATE * SECONDS)) / RATE
+    tone = 0.3 * numpy.sin(2 * numpy.pi * 440 * t) * (1 + 0.5 * numpy.sin(2 * numpy.pi * 0.7 * t))
+    frames = numpy.stack((tone, 0.5 * tone), axis=1)
+    return (frames + 0.02 * rng.standard_normal(frames.shape)).astype(numpy.float32)
+
+
+def record(tmp_path, audio, output_format, **kwargs):
+    """Write audio in uneven blocks as one-second segments"""
+    extension = segments.OUTPUT_FORMATS[output_format]["extension"]
+    writer = SegmentedWriter(str(tmp_path / f"call{extension}"),
+                             str(tmp_path / "call_16k.wav"), output_format,
+                             RATE, CHANNELS, segment_seconds=1, **kwargs)
+    rng = numpy.random.default_rng(1)
+    position = 0
+    while position < len(audio):
+        count = int(rng.integers(100, 30000))
+        writer.write(audio[position:position + count])
+        position += count
+    writer.close()
+    return writer.manifest
+
+
+def finalize(manifest):
+    recording = finalize_recording(manifest.path)
+    return sf.read(recording, dtype="float32")[0], \
+        sf.read(manifest.data["stt_recording"])[0]
+
+
+def seam_error(joined, audio, manifest):
+    """Largest difference around the seams between segments"""
+    starts = [segment["start_frame"] for segment in manifest.segments[1:]]
+    return max(numpy.abs(joined[start - 500:start + 500] -
+                         audio[start - 500:start + 500]).max()
+               for start in starts)
+
+
+@pytest.mark.parametrize("output_format", ["wav", "flac"])
+def test_lossless_segments_join_sample_exact(tmp_path, audio, output_format):
+    manifest = record(tmp_path, audio, output_format)
+    assert len(manifest.segments) == 7
+    joined, stt = finalize(manifest)
+    assert joined.shape == audio.shape
+    assert numpy.abs(joined - audio).max() < 1e-6
+    assert len(stt) == len(audio) // 3
+
+
+def test_opus_segments_join_without_drift(tmp_path, audio):
+    manifest = record(tmp_path, audio, "opus")
+    assert [segment["lead_in"] > 0 for segment in manifest.segments] == \
+        [False] + [True] * (len(manifest.segments) - 1)
+    assert [segment["lead_out"] > 0 for segment in manifest.segments] == \
+        [True] * (len(manifest.segments) - 1) + [False]
+    joined, stt = finalize(manifest)
+    assert joined.shape == audio.shape
+    assert len(stt) == len(audio) // 3
+    # No worse than the codec is away from the seams
+    codec_error = numpy.abs(joined[100000:110000] - audio[100000:110000]).max()
+    assert seam_error(joined, audio, manifest) < 2 * codec_error
+
+
+def test_opus_segments_encoded_again_leave_out_overlaps(tmp_path, audio, monkeypatch):
+    manifest = record(tmp_path, audio, "opus")
+
+    def cannot_join(*args):
+        raise ValueError("cannot join")
+
+    monkeypatch.setitem(segments.OUTPUT_FORMATS["opus"], "concat", cannot_join)
+    joined, _ = finalize(manifest)
+    assert joined.shape == audio.shape
+    codec_error = numpy.abs(joined[100000:110000] - audio[100000:110000]).max()
+    assert seam_error(joined, audio, manifest) < 2 * codec_error
+
+
+def test_opus_recording_stopped_during_lead_out(tmp_path, audio):
+    audio = audio[:RATE - segments.OPUS_PRESKIP + 500]
+    manifest = record(tmp_path, audio, "opus")
+    assert [segment["frames"] for segment in manifest.segments] == \
+        [RATE - segments.OPUS_PRESKIP, 500]
+    joined, _ = finalize(manifest)
+    assert joined.shape == audio.shape
+
+
+def test_opus_recording_stopped_at_segment_end(tmp_path, audio):
+    audio = audio[:RATE - segments.OPUS_PRESKIP]
+    manifest = record(tmp_path, audio, "opus")
+    assert len(manifest.segments) == 1
+    assert manifest.segments[0]["lead_out"] == 0
+    joined, _ = finalize(manifest)
+    assert joined.shape == audio.shape
@@ -0,0 +1,248 @@
+import os
+import logging
+import numpy
+import soundfile as sf
+
+logger = logging.getLogger(__name__)
+
+# Analysis frame length in milliseconds
+FRAME_MS = 30
+# Frames this far above the estimated noise floor (dB) count as speech
+ENERGY_MARGIN_DB = 12.0
+# Frames quieter than this (dBFS) never count as speech
+MIN_SPEECH_DBFS = -55.0
+# Quieter frames still count as speech when their zero-crossing rate is in
+# the range of unvoiced consonants
+FRICATIVE_MARGIN_DB = 6.0
+FRICATIVE_ZCR = (0.25, 0.6)
+# Speech regions are padded by this much so word edges are never clipped
+PADDING_SECONDS = 0.3
+# Only silences at least this long are removed
+MIN_SILENCE_SECONDS = 1.0
+# Silence kept between concatenated speech regions
+GAP_SECONDS = 0.2
+# Audio is analysed in blocks of this many seconds to keep memory flat
+BLOCK_SECONDS = 60
+
+
+class OffsetTable:
+    """
+    Mapping between the timeline of a trimmed file and the original recording.
+
+    Each entry says that `length` seconds starting at `trimmed_start` in the
+    trimmed file came from `original_start` in the original.
+    """
+
+    def __init__(self, trimmed_starts, original_starts, lengths):
+        self.trimmed_starts = numpy.asarray(trimmed_starts, dtype=numpy.float64)
+        self.original_starts = numpy.asarray(
+            original_starts, dtype=numpy.float64)
+        self.lengths = numpy.asarray(lengths, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.trimmed_starts)
+
+    def to_original(self, times):
+        """Map trimmed-file times (scalar or array, seconds) to original time"""
+        if not len(self):
+            return times
+        times = numpy.asarray(times, dtype=numpy.float64)
+        index = numpy.searchsorted(self.trimmed_starts, times, side="right") - 1
+        index = numpy.clip(index, 0, len(self) - 1)
+        within = numpy.clip(times - self.trimmed_starts[index],
+                            0, self.lengths[index])
+        mapped = self.original_starts[index] + within
+        return mapped if mapped.ndim else float(mapped)
+
+    def remap_words(self, words):
+        """Rewrite start/end of provider word dicts in place to original time"""
+        if not words or not len(self):
+            return words
+        starts = self.to_original([word.get("start", 0) for word in words])
+        ends = self.to_original([word.get("end", word.get("start", 0))
+                                 for word in words])
+        for word, start, end in zip(words, starts, ends):
+            if "start" in word:
+                word["start"] = float(start)
+            if "end" in word:
+                word["end"] = float(end)
+        return words
+
+
+def _frame_features(samples, frame_length):
+    """Return per-frame energy (dBFS) and zero-crossing rate"""
+    count = len(samples) // frame_length
+    frames = samples[:count * frame_length].reshape(count, frame_length)
+    energy = numpy.sqrt(numpy.mean(frames * frames, axis=1))
+    energy_db = 20 * numpy.log10(numpy.maximum(energy, 1e-10))
+    signs = numpy.signbit(frames)
+    zcr = numpy.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / \
+        (frame_length - 1)
+    return energy_db, zcr
+
+
+def _runs(mask):
+    """Return (start, end) index pairs of the True runs in a boolean array"""
+    edges = numpy.diff(numpy.concatenate(([0], mask.astype(numpy.int8), [0])))
+    return numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)
+
+
+def _analyse(audio_path):
+    """Return (samplerate, frame length, energy_db, zcr) for a whole file"""
+    rate = sf.info(audio_path).samplerate
+    frame_length = int(rate * FRAME_MS / 1000)
+    block_length = frame_length * int(BLOCK_SECONDS * 1000 / FRAME_MS)
+
+    energies, zcrs = [numpy.zeros(0)], [numpy.zeros(0)]
+    for block in sf.blocks(audio_path, blocksize=block_length,
+                           dtype='float32', always_2d=True):
+        energy_db, zcr = _frame_features(block.mean(axis=1), frame_length)
+        energies.append(energy_db)
+        zcrs.append(zcr)
+    return rate, frame_length, numpy.concatenate(energies), numpy.concatenate(zcrs)
+
+
+def _copy_range(source, output, start, end):
+    """Copy samples [start, end) of an open file to another in blocks"""
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = source.read(min(remaining, BLOCK_SECONDS * source.samplerate),
+                            dtype='float32', always_2d=True)
+        if not len(block):
+            break
+        output.write(block)
+        remaining -= len(block)
+
+
+def detect_speech(audio_path):
+    """
+    Build the speech map of an audio file.
+
+    Returns:
+        tuple: (samplerate, list of (start_sample, end_sample) speech regions)
+    """
+    info = sf.info(audio_path)
+    rate, frame_length, energy_db, zcr = _analyse(audio_path)
+    if not len(energy_db):
+        return rate, []
+
+    # The quietest frames of a call are background noise
+    threshold = max(numpy.percentile(energy_db, 10) + ENERGY_MARGIN_DB,
+                    MIN_SPEECH_DBFS)
+    speech = (energy_db > threshold) | (
+        (energy_db > threshold - FRICATIVE_MARGIN_DB) &
+        (zcr >= FRICATIVE_ZCR[0]) & (zcr <= FRICATIVE_ZCR[1]))
+
+    # Bridge short pauses, then pad what is left
+    starts, ends = _runs(~speech)
+    min_silence = int(MIN_SILENCE_SECONDS * 1000 / FRAME_MS)
+    for start, end in zip(starts, ends):
+        if end - start < min_silence and start > 0 and end < len(speech):
+            speech[start:end] = True
+    padding = int(PADDING_SECONDS * 1000 / FRAME_MS)
+    starts, ends = _runs(speech)
+    starts = numpy.maximum(starts - padding, 0)
+    ends = numpy.minimum(ends + padding, len(speech))
+
+    regions = []
+    for start, end in zip(starts * frame_length, ends * frame_length):
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((int(start), int(end)))
+    if regions:
+        # Keep the tail that does not fill a whole analysis frame
+        if regions[-1][1] == len(speech) * frame_length:
+            regions[-1] = (regions[-1][0], info.frames)
+    return rate, regions
+
+
+def trim_silence(audio_path, output_path):
+    """
+    Write only the speech regions of audio_path, concatenated, to output_path.
+
+    Returns:
+        tuple: (OffsetTable mapping output times back to audio_path times,
+                dict with speech/original duration and byte counts)
+    """
+    rate, regions = detect_speech(audio_path)
+    info = sf.info(audio_path)
+    gap = numpy.zeros((int(GAP_SECONDS * rate), info.channels),
+                      dtype=numpy.float32)
+
+    trimmed_starts, original_starts, lengths = [], [], []
+    position = 0
+    with sf.SoundFile(audio_path) as source, \
+            sf.SoundFile(output_path, mode='w', samplerate=rate,
+                         channels=info.channels, format='WAV',
+                         subtype='PCM_16') as output:
+        for start, end in regions:
+            if trimmed_starts:
+                output.write(gap)
+                position += len(gap)
+            trimmed_starts.append(position / rate)
+            original_starts.append(start / rate)
+            lengths.append((end - start) / rate)
+            _copy_range(source, output, start, end)
+            position += end - start
+
+    stats = {
+        "original_seconds": info.frames / rate,
+        "speech_seconds": sum(lengths),
+        "regions": len(regions),
+        "original_bytes": os.path.getsize(audio_path),
+        "trimmed_bytes": os.path.getsize(output_path),
+    }
+    logger.info(f"Voice activity detection: {stats}")
+    return OffsetTable(trimmed_starts, original_starts, lengths), stats
+
+
+def find_split_points(audio_path, chunk_seconds, search_seconds=30):
+    """
+    Choose boundaries that cut an audio file into chunks of about
+    chunk_seconds, each placed at the quietest frame within search_seconds of
+    the nominal boundary so no word is cut in half.
+
+    Returns:
+        tuple: (samplerate, list of sample positions, excluding 0 and the end)
+    """
+    rate, frame_length, energy_db, _ = _analyse(audio_path)
+    frames_per_chunk = int(chunk_seconds * 1000 / FRAME_MS)
+    search = min(int(search_seconds * 1000 / FRAME_MS), frames_per_chunk // 4)
+
+    points = []
+    previous = 0
+    target = frames_per_chunk
+    while target + search < len(energy_db):
+        window = energy_db[max(target - search, previous + 1):target + search]
+        split = max(target - search, previous + 1) + int(numpy.argmin(window))
+        points.append(split * frame_length + frame_length // 2)
+        previous = split
+        target = split + frames_per_chunk
+    return rate, points
+
+
+def split_audio(audio_path, points, directory, format='WAV', subtype='PCM_16',
+                extension='.wav'):
+    """
+    Write audio_path cut at the given sample positions into directory,
+    encoded with the given libsndfile format and subtype.
+
+    Returns:
+        list: (chunk path, offset in seconds) for each chunk
+    """
+    info = sf.info(audio_path)
+    boundaries = [0] + list(points) + [info.frames]
+    chunks = []
+    with sf.SoundFile(audio_path) as source:
+        for index, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+            chunk_path = os.path.join(
+                directory, f"chunk_{index:04d}{extension}")
+            with sf.SoundFile(chunk_path, mode='w',
+                              samplerate=info.samplerate,
+                              channels=info.channels, format=format,
+                              subtype=subtype) as output:
+                _copy_range(source, output, start, end)
+            chunks.append((chunk_path, start / info.samplerate))
+    return chunks
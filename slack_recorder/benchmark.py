@@ -0,0 +1,649 @@
+"""
+Offline benchmarks for the post-processing pipeline.
+
+Usage:
+    python benchmark.py vad [--input recording_16k.wav] [--minutes 60]
+    python benchmark.py speaker-map [--hours 3]
+    python benchmark.py pipeline [--minutes 60] [--latency 2]
+    python benchmark.py stt-json [--hours 3]
+    python benchmark.py tldr [--hours 3] [--latency 2] [--tpm 30000]
+    python benchmark.py tldr-chunks [--input transcript.json ...] [--encoding cl100k_base]
+    python benchmark.py live-tldr [--minutes 60] [--latency 2]
+    python benchmark.py rate-limit [--meetings 6] [--rpm 120]
+
+The modules shared with the Meet recorder must be importable, as they are in
+the image: PYTHONPATH=../recorder_common python benchmark.py ...
+"""
+import os
+import json
+import time
+import asyncio
+import tracemalloc
+import argparse
+import datetime
+import tempfile
+import threading
+from collections import defaultdict
+import numpy
+import soundfile as sf
+import dateutil.parser
+import tiktoken
+import openai
+
+from vad import trim_silence
+from diarization import DiarizationEngine
+from engines import StubEngine
+from stt_router import SpeechRouter
+from words import parse_transcription
+from cache import DiskCache
+import scheduler
+from live_summary import LiveSummarizer
+import tldr_generator
+import transcription
+
+STT_RATE = 16000
+# Context budget of the former character-based TLDR splitter
+LEGACY_MAX_TOKENS = 16000
+
+
+def synthesize_call(path, minutes, speech_ratio=0.6, seed=0):
+    """
+    Write a synthetic 16 kHz mono call: voiced bursts (harmonics of a moving
+    pitch, syllable-rate amplitude modulation) separated by noisy silences.
+    """
+    rng = numpy.random.default_rng(seed)
+    total = int(minutes * 60 * STT_RATE)
+    written = 0
+    with sf.SoundFile(path, mode='w', samplerate=STT_RATE, channels=1,
+                      format='WAV', subtype='PCM_16') as output:
+        while written < total:
+            if rng.random() < speech_ratio:
+                length = int(rng.uniform(1.0, 12.0) * STT_RATE)
+                t = numpy.arange(length) / STT_RATE
+                pitch = rng.uniform(100, 220) * (1 + 0.05 * numpy.sin(
+                    2 * numpy.pi * 0.5 * t))
+                phase = 2 * numpy.pi * numpy.cumsum(pitch) / STT_RATE
+                voice = sum(numpy.sin(k * phase) / k for k in range(1, 8))
+                envelope = 0.5 * (1 + numpy.sin(2 * numpy.pi * 4 * t))
+                block = 0.1 * voice * envelope
+            else:
+                length = int(rng.uniform(1.0, 30.0) * STT_RATE)
+                block = numpy.zeros(length)
+            block = block + rng.normal(0, 0.001, length)
+            block = block[:total - written].astype(numpy.float32)
+            output.write(block)
+            written += len(block)
+
+
+def benchmark_vad(args):
+    with tempfile.TemporaryDirectory() as directory:
+        audio_path = args.input
+        if not audio_path:
+            audio_path = os.path.join(directory, "call_16k.wav")
+            print(f"Synthesizing {args.minutes} minutes of call audio...")
+            synthesize_call(audio_path, args.minutes)
+
+        trimmed_path = os.path.join(directory, "trimmed.wav")
+        started = time.perf_counter()
+        offsets, stats = trim_silence(audio_path, trimmed_path)
+        elapsed = time.perf_counter() - started
+
+    hours = stats["original_seconds"] / 3600
+    saved = stats["original_bytes"] - stats["trimmed_bytes"]
+    print(f"Audio:            {stats['original_seconds']:.0f} s "
+          f"({stats['regions']} speech regions)")
+    print(f"Speech kept:      {stats['speech_seconds']:.0f} s "
+          f"({stats['speech_seconds'] / stats['original_seconds']:.0%})")
+    print(f"Bytes uploaded:   {stats['trimmed_bytes']} "
+          f"of {stats['original_bytes']}")
+    print(f"Bytes saved:      {saved} ({saved / stats['original_bytes']:.0%}), "
+          f"{saved / hours / 2**20:.1f} MiB per hour of audio")
+    print(f"Processing time:  {elapsed:.2f} s, "
+          f"{elapsed / hours:.2f} s per hour of audio")
+
+
+def synthesize_timeline(hours, speakers=6, seed=0):
+    """
+    Build a Slack speaker timeline and a matching ElevenLabs word list: the
+    active speaker changes every 0.5-4 s and words arrive every 0.3 s.
+    """
+    rng = numpy.random.default_rng(seed)
+    launch_time = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    names = [f"Speaker {i}" for i in range(speakers)]
+    records, words = [], []
+    position = 0.0
+    while position < hours * 3600:
+        speaker = int(rng.integers(speakers))
+        turn = rng.uniform(0.5, 4.0)
+        records.append({
+            "timestamp": (launch_time + datetime.timedelta(seconds=position)).isoformat(),
+            "speakers": [names[speaker]] if rng.random() > 0.1 else []
+        })
+        for start in numpy.arange(position, position + turn - 0.3, 0.3):
+            words.append({"text": "слово", "type": "word", "start": float(start),
+                          "end": float(start) + 0.25,
+                          "speaker_id": f"speaker_{speaker}"})
+        position += turn
+    return launch_time.isoformat(), records, {"text": "", "words": words}
+
+
+def _legacy_speaker_at_time(speaker_activity, time_point):
+    """Active speaker at a time point, the lookup the speaker map used to make"""
+    # Sort activity by timestamp
+    sorted_activity = sorted(speaker_activity,
+                             key=lambda x: dateutil.parser.parse(x["timestamp"]))
+
+    # Find the last activity entry before the given time point
+    current_speaker = None
+    for activity in sorted_activity:
+        activity_time = dateutil.parser.parse(activity["timestamp"])
+        if activity_time <= time_point:
+            current_speaker = activity["speakers"][0] if activity["speakers"] else None
+        else:
+            break
+
+    return current_speaker
+
+
+def _legacy_speaker_votes(segments, speaker_activity, recording_start_time):
+    """Point sampling with _legacy_speaker_at_time, as create_improved_speaker_map used to do"""
+    reference_time = dateutil.parser.parse(recording_start_time)
+    speaker_votes = defaultdict(lambda: defaultdict(int))
+    for speaker_id, start, end, _ in segments:
+        segment_duration = end - start
+        num_samples = max(3, int(segment_duration / 0.5))
+        for i in range(num_samples):
+            sample_time_seconds = start + \
+                (segment_duration * i / (num_samples - 1))
+            sample_time = reference_time + \
+                datetime.timedelta(seconds=sample_time_seconds)
+            active_speaker = _legacy_speaker_at_time(
+                speaker_activity, sample_time)
+            if active_speaker:
+                speaker_votes[speaker_id][active_speaker] += 1
+    return speaker_votes
+
+
+def benchmark_speaker_map(args):
+    launch_time, records, transcript = synthesize_timeline(args.hours)
+
+    started = time.perf_counter()
+    engine = DiarizationEngine(records, launch_time)
+    engine.feed_all(transcript["words"])
+    utterances = list(engine.utterances())
+    sweep = time.perf_counter() - started
+
+    segments = engine.runs
+    print(f"Timeline: {args.hours} h, {len(records)} speaker changes, "
+          f"{len(transcript['words'])} words, {len(segments)} runs, "
+          f"{len(utterances)} utterances")
+
+    # The old implementation is far too slow for the whole call, so it is
+    # timed on the first segments and extrapolated
+    sample = segments[:args.legacy_segments]
+    started = time.perf_counter()
+    _legacy_speaker_votes(sample, records, launch_time)
+    legacy = (time.perf_counter() - started) * len(segments) / len(sample)
+
+    print(f"Diarization:      {sweep:.3f} s")
+    print(f"Legacy lookup:    {legacy:.0f} s (extrapolated from "
+          f"{len(sample)} segments)")
+    print(f"Speedup:          {legacy / sweep:.0f}x")
+
+
+def benchmark_pipeline(args):
+    """Run VAD, chunking, STT and diarization offline with the stub engine"""
+    transcription.speech_router = SpeechRouter([StubEngine(latency=args.latency)])
+    launch_time = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    records = [{"timestamp": (launch_time + datetime.timedelta(seconds=second)).isoformat(),
+                "speakers": [f"Speaker {second // 30 % 3}"]}
+               for second in range(0, int(args.minutes * 60), 30)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        audio_path = os.path.join(directory, "call_16k.wav")
+        print(f"Synthesizing {args.minutes} minutes of call audio...")
+        synthesize_call(audio_path, args.minutes)
+
+        started = time.perf_counter()
+        result = transcription._transcribe_speech_only(audio_path, None)
+        transcribed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    engine = DiarizationEngine(records, launch_time)
+    engine.feed_store(result["words"])
+    utterances = list(engine.utterances())
+    diarized = time.perf_counter() - started
+
+    print(f"Words:            {len(result['words'])}, "
+          f"{len(utterances)} utterances")
+    print(f"Transcription:    {transcribed:.2f} s "
+          f"(stub latency {args.latency} s per chunk)")
+    print(f"Diarization:      {diarized:.3f} s")
+
+
+def write_elevenlabs_response(path, hours):
+    """Write an ElevenLabs-style response: words every 0.3 s, each followed
+    by a spacing token, with the speaker changing every 0.5-4 s"""
+    _, _, transcript = synthesize_timeline(hours)
+    words = []
+    for word in transcript["words"]:
+        words.append(dict(word, logprob=-0.1))
+        words.append({"text": " ", "type": "spacing", "start": word["end"],
+                      "end": word["end"] + 0.05, "speaker_id": word["speaker_id"],
+                      "logprob": 0.0})
+    with open(path, "w") as output:
+        json.dump({"language_code": "rus", "language_probability": 0.99,
+                   "text": " ".join(word["text"] for word in transcript["words"]),
+                   "words": words}, output, ensure_ascii=False)
+    return len(transcript["words"])
+
+
+def _measure(function):
+    """
+    Return (result, seconds, peak traced MiB) of a function. Tracing slows
+    small allocations down, so the time comes from a separate untraced run.
+    """
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def benchmark_stt_json(args):
+    launch_time = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc).isoformat()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "response.json")
+        count = write_elevenlabs_response(path, args.hours)
+        size = os.path.getsize(path) / 2**20
+        print(f"Response: {args.hours} h, {count} words, {size:.0f} MiB of JSON")
+
+        def materialized():
+            with open(path, "rb") as source:
+                response = json.load(source)
+            engine = DiarizationEngine([], launch_time)
+            engine.feed_all(response["words"])
+            return len(engine.runs)
+
+        def streamed():
+            with open(path, "rb") as source:
+                response = parse_transcription(source)
+            engine = DiarizationEngine([], launch_time)
+            engine.feed_store(response["words"])
+            return len(engine.runs)
+
+        runs, loaded, loaded_peak = _measure(materialized)
+        streamed_runs, parsed, parsed_peak = _measure(streamed)
+    assert runs == streamed_runs
+    print(f"json.load:        {loaded:.2f} s, peak {loaded_peak:.0f} MiB")
+    print(f"Streaming parse:  {parsed:.2f} s, peak {parsed_peak:.0f} MiB")
+
+
+class FakeChatClient:
+    """Async stand-in for the OpenAI client that answers after a fixed delay"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.chat = self
+        self.completions = self
+
+    async def create(self, **kwargs):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        message = type("Message", (), {"content": "Резюме части совещания."})
+        choice = type("Choice", (), {"message": message})
+        return type("Response", (), {"choices": [choice]})
+
+
+def benchmark_tldr(args):
+    launch_time, records, transcript = synthesize_timeline(args.hours)
+    rng = numpy.random.default_rng(0)
+    vocabulary = ["интеграция", "платежи", "редирект", "мерчант", "страница",
+                  "релиз", "тесты", "договорились", "сделаем", "проверим"]
+    for word in transcript["words"]:
+        word["text"] = vocabulary[int(rng.integers(len(vocabulary)))]
+    engine = DiarizationEngine(records, launch_time)
+    engine.feed_all(transcript["words"])
+    diarized = list(engine.utterances())
+
+    client = FakeChatClient(args.latency)
+    tldr_generator._client = client
+    if args.tpm:
+        scheduler.scheduler = tldr_generator.scheduler = scheduler.RateLimitScheduler(
+            {tldr_generator.SUMMARY_MODEL: scheduler.RateLimit(500, args.tpm)})
+    limit = scheduler.scheduler.limits.get(tldr_generator.SUMMARY_MODEL)
+    with tempfile.TemporaryDirectory() as directory:
+        tldr_generator.summary_cache = DiskCache(directory, 64 * 1024 * 1024)
+        started = time.perf_counter()
+        tldr_generator.generate_tldr({"diarized": diarized})
+        elapsed = time.perf_counter() - started
+        requests = client.requests
+
+        # Regenerate after a re-diarization that only renamed speakers, to
+        # names of other lengths so token counts change
+        names = {}
+        renamed = [dict(utterance, speaker=names.setdefault(
+            utterance["speaker"], f"Участник совещания номер {len(names) + 1}"))
+            for utterance in diarized]
+        client.requests = 0
+        started = time.perf_counter()
+        tldr_generator.generate_tldr({"diarized": renamed})
+        rerun_elapsed = time.perf_counter() - started
+
+    print(f"Transcript:       {args.hours} h, {len(diarized)} utterances")
+    if limit is not None and limit.tokens is not None:
+        print(f"Token limit:      {limit.tokens.rate * 60:.0f} tokens/min, "
+              f"bucket of {limit.tokens.capacity:.0f}")
+    print(f"Requests:         {requests}, "
+          f"at most {client.max_in_flight} at a time")
+    print(f"TLDR time:        {elapsed:.2f} s "
+          f"({elapsed / args.latency:.1f} request latencies)")
+    print(f"Sequential time:  {requests * args.latency:.2f} s")
+    print(f"Renamed re-run:   {client.requests} requests, {rerun_elapsed:.2f} s")
+    if client.requests:
+        raise SystemExit("A re-run that only renamed speakers sent requests")
+
+
+def _legacy_chunks(text):
+    """Chunks of the former TOKENS_PER_CHAR character-budget splitter"""
+    target_length = int(LEGACY_MAX_TOKENS * 0.7 / tldr_generator.TOKENS_PER_CHAR)
+    if len(text) * tldr_generator.TOKENS_PER_CHAR < LEGACY_MAX_TOKENS * 0.7:
+        return [text]
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        if len(current) + len(line) > target_length and current:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _synthetic_transcripts(hours):
+    """Diarized transcripts of synthetic calls with Russian-like text"""
+    rng = numpy.random.default_rng(0)
+    vocabulary = ("интеграция платежи редирект мерчант страница релиз тесты "
+                  "договорились сделаем проверим нужно посмотреть завтра "
+                  "клиент сервер ошибка логи деплой, задача. вопрос? "
+                  "я думаю что это можно сделать до пятницы").split()
+    for duration in hours:
+        launch_time, records, transcript = synthesize_timeline(duration)
+        for word in transcript["words"]:
+            word["text"] = vocabulary[int(rng.integers(len(vocabulary)))]
+        engine = DiarizationEngine(records, launch_time)
+        engine.feed_all(transcript["words"])
+        yield f"synthetic {duration} h", list(engine.utterances())
+
+
+def _recorded_transcripts(paths):
+    """Diarized transcripts exported as JSON, either a list or {"diarized": [...]}"""
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        yield os.path.basename(path), data.get("diarized") if isinstance(data, dict) else data
+
+
+def benchmark_tldr_chunks(args):
+    if args.encoding:
+        tldr_generator._encoding = tiktoken.get_encoding(args.encoding)
+    budget = tldr_generator.CHUNK_TOKENS
+    transcripts = (_recorded_transcripts(args.input) if args.input
+                   else _synthetic_transcripts(args.hours))
+
+    print(f"Chunk budget {budget} tokens")
+    total_legacy = total_packed = 0
+    for name, diarized in transcripts:
+        text = tldr_generator.format_transcript_for_summary(diarized)
+        legacy = [tldr_generator.count_tokens(chunk) / budget
+                  for chunk in _legacy_chunks(text)]
+        _, packed = tldr_generator.pack_chunks(text.split("\n"))
+        # One request per chunk plus the final summary when there are several
+        legacy_calls = len(legacy) + (len(legacy) > 1)
+        packed_calls = len(packed) + (len(packed) > 1)
+        total_legacy += legacy_calls
+        total_packed += packed_calls
+        print(f"{name}: {tldr_generator.count_tokens(text)} tokens, "
+              f"{len(text) / max(tldr_generator.count_tokens(text), 1):.2f} chars/token")
+        print(f"  heuristic: {len(legacy)} chunks, {legacy_calls} calls, fill "
+              f"min {min(legacy):.0%} mean {numpy.mean(legacy):.0%} max {max(legacy):.0%}")
+        print(f"  tokenizer: {len(packed)} chunks, {packed_calls} calls, fill "
+              f"min {min(packed):.0%} mean {numpy.mean(packed):.0%} max {max(packed):.0%}")
+    print(f"Calls: {total_legacy} -> {total_packed} "
+          f"({total_legacy - total_packed} saved)")
+
+
+class SegmentDirectory:
+    """Stand-in for SegmentManifest over STT segment files written by hand"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data = {"samplerate": STT_RATE, "stt_samplerate": STT_RATE}
+
+    def segment_path(self, segment, key="path"):
+        return os.path.join(self.directory, segment[key])
+
+
+def _write_segments(audio_path, directory, segment_seconds):
+    """Cut a call into segment files the way SegmentedWriter would"""
+    segments = []
+    for index, block in enumerate(sf.blocks(
+            audio_path, blocksize=int(segment_seconds * STT_RATE), dtype='int16')):
+        name = f"{index + 1:04d}_16k.wav"
+        sf.write(os.path.join(directory, name), block, STT_RATE, subtype='PCM_16')
+        segments.append({"stt_path": name, "frames": len(block),
+                         "start_frame": index * int(segment_seconds * STT_RATE)})
+    return segments
+
+
+class ProportionalStubEngine(StubEngine):
+    """Stub engine whose latency grows with the duration of the audio"""
+
+    def __init__(self, seconds_per_minute):
+        super().__init__()
+        self.seconds_per_minute = seconds_per_minute
+
+    def transcribe(self, file_path, api_key=None):
+        result = super().transcribe(file_path, api_key)
+        time.sleep(sf.info(file_path).duration / 60 * self.seconds_per_minute)
+        return result
+
+
+def benchmark_live_tldr(args):
+    """Time from the end of a call to its TLDR, after the call vs live"""
+    transcription.speech_router = SpeechRouter(
+        [ProportionalStubEngine(args.stt_latency)])
+    tldr_generator._client = FakeChatClient(args.latency)
+    launch_time = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    records = [{"timestamp": (launch_time + datetime.timedelta(seconds=second)).isoformat(),
+                "speakers": [f"Speaker {second // 30 % 3}"]}
+               for second in range(0, int(args.minutes * 60), 30)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        audio_path = os.path.join(directory, "call_16k.wav")
+        print(f"Synthesizing {args.minutes} minutes of call audio...")
+        synthesize_call(audio_path, args.minutes)
+
+        started = time.perf_counter()
+        transcription.transcribe_audio(audio_path, records, launch_time)
+        after_call = time.perf_counter() - started
+
+        segment_directory = os.path.join(directory, "call.segments")
+        os.makedirs(segment_directory)
+        manifest = SegmentDirectory(segment_directory)
+        segments = _write_segments(audio_path, segment_directory, args.segment_seconds)
+        summarizer = LiveSummarizer(records, launch_time)
+        # The call goes on while earlier windows are processed
+        for segment in segments[:-1]:
+            summarizer.on_segment_closed(manifest, segment)
+        summarizer._executor.submit(lambda: None).result()
+
+        started = time.perf_counter()
+        summarizer.on_segment_closed(manifest, segments[-1])
+        tldr, live_transcription = summarizer.finish()
+        transcription.transcribe_audio(audio_path, records, launch_time,
+                                       transcription=live_transcription, tldr=tldr)
+        live = time.perf_counter() - started
+
+    print(f"Call:             {args.minutes} min, {len(segments)} segments of "
+          f"{args.segment_seconds:.0f} s, live windows of {summarizer.window_seconds:.0f} s")
+    print(f"After the call:   {after_call:.2f} s to transcript and TLDR")
+    print(f"Live:             {live:.2f} s to transcript and TLDR "
+          f"(STT {args.stt_latency} s per minute of audio, "
+          f"{args.latency} s per summary request)")
+
+
+class RateLimitedChatClient(FakeChatClient):
+    """FakeChatClient that answers 429 beyond rpm requests per minute"""
+
+    def __init__(self, latency, rpm):
+        super().__init__(latency)
+        self.bucket = scheduler.TokenBucket(rpm / 60, max(rpm / 60, 1))
+        self.rejected = 0
+
+    async def create(self, **kwargs):
+        now = time.monotonic()
+        if self.bucket.delay(1, now) > 0:
+            self.rejected += 1
+            # Only the attributes the client's error reads
+            response = type("Response", (), {
+                "request": None, "status_code": 429, "headers": {"Retry-After": "1"}})
+            raise openai.RateLimitError("Rate limit reached", body=None,
+                                        response=response)
+        self.bucket.consume(1, now)
+        return await super().create(**kwargs)
+
+
+def benchmark_rate_limit(args):
+    """Meetings ending at the same time, with and without the scheduler"""
+    _, records, transcript = synthesize_timeline(args.hours)
+    launch_time = records[0]["timestamp"]
+    engine = DiarizationEngine(records, launch_time)
+    engine.feed_all(transcript["words"])
+    diarized = list(engine.utterances())
+    tldr_generator.summary_cache = DiskCache(tempfile.gettempdir(), 0)
+    tldr_generator.CHUNK_TOKENS = args.chunk_tokens
+    retries = tldr_generator.RATE_LIMIT_RETRIES
+
+    def run(limits, retries):
+        client = RateLimitedChatClient(args.latency, args.rpm)
+        tldr_generator._client = client
+        tldr_generator.RATE_LIMIT_RETRIES = retries
+        scheduler.scheduler = tldr_generator.scheduler = \
+            scheduler.RateLimitScheduler(limits)
+        finished = {}
+
+        def meeting(index):
+            level = scheduler.PRIORITY_LIVE if index == 0 else scheduler.PRIORITY_BACKFILL
+            with scheduler.priority(level):
+                tldr = tldr_generator.generate_tldr({"diarized": diarized})
+            finished[index] = (time.perf_counter() - started, tldr.startswith("Ошибка"))
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=meeting, args=(index,))
+                   for index in range(args.meetings)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        lost = sum(failed for _, failed in finished.values())
+        return client, finished, lost
+
+    print(f"{args.meetings} meetings of {args.hours} h ending at once, "
+          f"server limit {args.rpm:.0f} requests/min")
+    client, finished, lost = run({}, 0)
+    print(f"Unscheduled:      {client.requests} requests, {client.rejected} 429s, "
+          f"{lost} of {args.meetings} TLDRs lost")
+    client, finished, lost = run(
+        {tldr_generator.SUMMARY_MODEL: scheduler.RateLimit(args.rpm)}, retries)
+    slowest = max(elapsed for elapsed, _ in finished.values())
+    print(f"Scheduled:        {client.requests} requests, {client.rejected} 429s, "
+          f"{lost} of {args.meetings} TLDRs lost, all done in {slowest:.1f} s")
+    print(f"Live meeting:     done in {finished[0][0]:.1f} s, backfill in "
+          f"{min(elapsed for index, (elapsed, _) in finished.items() if index):.1f}"
+          f"-{slowest:.1f} s")
+    print(f"Metrics:          {scheduler.scheduler.metrics()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    vad_parser = subparsers.add_parser(
+        "vad", help="Bytes saved and time spent by silence trimming")
+    vad_parser.add_argument(
+        "--input", help="16 kHz recording to trim instead of a synthetic one")
+    vad_parser.add_argument("--minutes", type=float, default=60)
+    vad_parser.set_defaults(func=benchmark_vad)
+
+    speaker_parser = subparsers.add_parser(
+        "speaker-map", help="Speaker map creation on a synthetic timeline")
+    speaker_parser.add_argument("--hours", type=float, default=3)
+    speaker_parser.add_argument("--legacy-segments", type=int, default=20)
+    speaker_parser.set_defaults(func=benchmark_speaker_map)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="End-to-end pipeline with the offline stub engine")
+    pipeline_parser.add_argument("--minutes", type=float, default=60)
+    pipeline_parser.add_argument("--latency", type=float, default=0)
+    pipeline_parser.set_defaults(func=benchmark_pipeline)
+
+    json_parser = subparsers.add_parser(
+        "stt-json", help="Peak memory of parsing a long ElevenLabs response")
+    json_parser.add_argument("--hours", type=float, default=3)
+    json_parser.set_defaults(func=benchmark_stt_json)
+
+    tldr_parser = subparsers.add_parser(
+        "tldr", help="TLDR map-reduce against a fake fixed-latency client")
+    tldr_parser.add_argument("--hours", type=float, default=3)
+    tldr_parser.add_argument("--latency", type=float, default=2)
+    tldr_parser.add_argument("--tpm", type=float,
+                             help="summary model tokens per minute instead of RATE_LIMITS")
+    tldr_parser.set_defaults(func=benchmark_tldr)
+
+    chunks_parser = subparsers.add_parser(
+        "tldr-chunks", help="TLDR chunk counts, heuristic vs tokenizer packing")
+    chunks_parser.add_argument("--input", nargs="*",
+                               help="diarized transcript JSON files (default: synthetic)")
+    chunks_parser.add_argument("--hours", type=float, nargs="*", default=[0.5, 1, 3])
+    chunks_parser.add_argument("--encoding",
+                               help="tiktoken encoding to use instead of the model's")
+    chunks_parser.set_defaults(func=benchmark_tldr_chunks)
+
+    live_parser = subparsers.add_parser(
+        "live-tldr", help="time to TLDR after the call, post-call vs live")
+    live_parser.add_argument("--minutes", type=float, default=60)
+    live_parser.add_argument("--latency", type=float, default=2,
+                             help="seconds per summary request")
+    live_parser.add_argument("--stt-latency", type=float, default=3,
+                             help="transcription seconds per minute of audio")
+    live_parser.add_argument("--segment-seconds", type=float, default=60)
+    live_parser.set_defaults(func=benchmark_live_tldr)
+
+    rate_parser = subparsers.add_parser(
+        "rate-limit", help="concurrent TLDRs against a rate-limited server")
+    rate_parser.add_argument("--meetings", type=int, default=6)
+    rate_parser.add_argument("--hours", type=float, default=1)
+    rate_parser.add_argument("--rpm", type=float, default=120)
+    rate_parser.add_argument("--latency", type=float, default=0.5)
+    rate_parser.add_argument("--chunk-tokens", type=int, default=4000)
+    rate_parser.set_defaults(func=benchmark_rate_limit)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
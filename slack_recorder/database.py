@@ -4,6 +4,7 @@ from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timezone
 import os
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -38,31 +39,45 @@ class DatabaseManager:
         Base.metadata.create_all(self.engine)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        # Huddle sessions finish on their own threads and share the session
+        self._lock = threading.Lock()
 
     def add_recording(self, filename, source, meeting_name="", transcript=None, diarized_transcript=None, speakers=None, created_at=None, duration=None, tldr=None):
-        """Add a new recording to the database"""
-        try:
-            recording = Recording(
-                filename=filename,
-                source=source,
-                meeting_name=meeting_name,
-                transcript=transcript,
-                diarized_transcript=diarized_transcript,
-                speakers=speakers,
-                created_at=created_at if created_at is not None else datetime.now(
-                    timezone.utc),
-                duration=duration,
-                tldr=tldr
-            )
-            self.session.add(recording)
-            self.session.commit()
+        """
+        Add a new recording to the database.
 
-            logger.info(f"Added recording {filename} to database")
-            return recording
-        except Exception as e:
-            logger.error(f"Failed to add recording to database: {str(e)}")
-            self.session.rollback()
-            raise
+        The extension of filename (.wav, .flac or .ogg) identifies the audio
+        container, which the backend uses to serve the file's media type.
+        """
+        with self._lock:
+            try:
+                recording = Recording(
+                    filename=filename,
+                    source=source,
+                    meeting_name=meeting_name,
+                    transcript=transcript,
+                    diarized_transcript=diarized_transcript,
+                    speakers=speakers,
+                    created_at=created_at if created_at is not None else datetime.now(
+                        timezone.utc),
+                    duration=duration,
+                    tldr=tldr
+                )
+                self.session.add(recording)
+                self.session.commit()
+
+                logger.info(f"Added recording {filename} to database")
+                return recording
+            except Exception as e:
+                logger.error(f"Failed to add recording to database: {str(e)}")
+                self.session.rollback()
+                raise
+
+    def has_recording(self, filename):
+        """Whether a recording with this filename was already added"""
+        with self._lock:
+            return self.session.query(Recording.id).filter_by(
+                filename=filename).first() is not None
 
     def close(self):
         """Close the database session"""
@@ -0,0 +1,224 @@
+import datetime
+from collections import defaultdict
+import numpy
+import dateutil.parser
+
+# Minimum time gap in seconds to consider as a real speaker change
+MIN_SPEAKER_CHANGE_GAP = 0.5
+# Overlaps shorter than this (seconds) are float noise where a run just
+# touches a speaker interval
+MIN_OVERLAP = 1e-6
+
+
+class SpeakerTimeline:
+    """
+    Slack active-speaker records indexed for fast lookup.
+
+    Timestamps are parsed once and stored as seconds from the recording
+    start in a sorted NumPy array, so the active speaker at any number of
+    time points is found with a single searchsorted call.
+    """
+
+    def __init__(self, speaker_activity, recording_start_time):
+        if isinstance(recording_start_time, str):
+            recording_start_time = dateutil.parser.parse(recording_start_time)
+        records = sorted(
+            [((dateutil.parser.parse(activity["timestamp"]) - recording_start_time).total_seconds(),
+              activity["speakers"])
+             for activity in speaker_activity or []],
+            key=lambda record: record[0])
+
+        # Speakers are stored as indices into names. speakers holds the first
+        # active speaker of each record (-1 meaning nobody), active all of them.
+        self.names = sorted({speaker for _, speakers in records
+                             for speaker in speakers})
+        index = {name: i for i, name in enumerate(self.names)}
+        self.offsets = numpy.array([offset for offset, _ in records])
+        self.active = [tuple(index[speaker] for speaker in speakers)
+                       for _, speakers in records]
+        self.speakers = numpy.array(
+            [active[0] if active else -1 for active in self.active], dtype=int)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def speaker_indices_at(self, times):
+        """Return the index into names of the active speaker at each time, or -1"""
+        # Timestamps have microsecond resolution, so compare at that resolution
+        times = numpy.round(numpy.asarray(times, dtype=float), 6)
+        if not len(self):
+            return numpy.full(times.shape, -1, dtype=int)
+        position = numpy.searchsorted(self.offsets, times, side="right") - 1
+        return numpy.where(position >= 0,
+                           self.speakers[numpy.maximum(position, 0)], -1)
+
+    def speaker_at(self, seconds):
+        """Return the name of the active speaker at a time, or None"""
+        index = int(self.speaker_indices_at([seconds])[0])
+        return self.names[index] if index >= 0 else None
+
+
+class DiarizationEngine:
+    """
+    Single-pass diarization of provider words against a Slack speaker timeline.
+
+    feed() or feed_store() consumes words one at a time and folds them into
+    speaker runs:
+    stretches where one speaker_id talks without pausing longer than
+    MIN_SPEAKER_CHANGE_GAP. As each run closes, its exact overlap with the
+    Slack active-speaker intervals is added to the (speaker_id, name) totals
+    by a sweep pointer over the timeline. A run only keeps its speaker_id,
+    times and joined text, so no per-word structures outlive feed().
+
+    Once all words are fed, speaker_map() resolves speaker_ids to names and
+    utterances() yields consolidated utterances, formatting absolute
+    timestamps only as each one is emitted.
+    """
+
+    def __init__(self, speaker_activity, recording_start_time):
+        if isinstance(recording_start_time, str):
+            recording_start_time = dateutil.parser.parse(recording_start_time)
+        self.recording_start_time = recording_start_time
+        self.timeline = SpeakerTimeline(speaker_activity, recording_start_time)
+        self.interval_starts = self.timeline.offsets.tolist()
+        self.interval_ends = self.interval_starts[1:] + [float("inf")]
+
+        # Closed runs as (speaker_id, start, end, text) tuples
+        self.runs = []
+        self.overlaps = defaultdict(lambda: defaultdict(float))
+        self.end_time = 0
+        self._run = None
+        self._first_interval = 0
+
+    def feed(self, word):
+        """Consume one provider word dict"""
+        self.end_time = word.get("end", self.end_time)
+        if word.get("type") != "word":
+            return
+        start_time = word.get("start", 0)
+        self._feed(word.get("text", ""), start_time,
+                   word.get("end", start_time), word.get("speaker_id"))
+
+    def feed_all(self, words):
+        """Consume an iterable of provider word dicts"""
+        for word in words:
+            self.feed(word)
+        self._close_run()
+
+    def feed_store(self, store):
+        """Consume all words of a WordStore"""
+        for text, start_time, end_time, speaker_id in store:
+            self.end_time = end_time
+            self._feed(text, start_time, end_time, speaker_id)
+        self._close_run()
+
+    def _feed(self, text, start_time, end_time, speaker_id):
+        run = self._run
+        # A new speaker or a long pause starts a new run
+        if (run is None or run[0] != speaker_id or
+                start_time - run[2] > MIN_SPEAKER_CHANGE_GAP):
+            self._close_run()
+            self._run = [speaker_id, start_time, end_time, [text]]
+        else:
+            run[2] = end_time
+            run[3].append(text)
+
+    def _close_run(self):
+        if self._run is None:
+            return
+        speaker_id, start, end, texts = self._run
+        self._run = None
+        self.runs.append((speaker_id, start, end, " ".join(texts)))
+        if speaker_id:
+            self._accumulate(speaker_id, start, end)
+
+    def _accumulate(self, speaker_id, start, end):
+        """Add the overlap of one run with the speaker intervals"""
+        starts, ends = self.interval_starts, self.interval_ends
+        count = len(starts)
+        first = self._first_interval
+        # Runs arrive in time order, so intervals that ended before this run
+        # ended before all later ones; step back if a stitched run is early
+        while first > 0 and ends[first - 1] > start:
+            first -= 1
+        while first < count and ends[first] <= start:
+            first += 1
+        self._first_interval = first
+
+        index = first
+        while index < count and starts[index] < end:
+            overlap = min(end, ends[index]) - max(start, starts[index])
+            if overlap > MIN_OVERLAP:
+                for speaker in self.timeline.active[index]:
+                    self.overlaps[speaker_id][self.timeline.names[speaker]] += overlap
+            index += 1
+
+    def speaker_map(self):
+        """
+        Map each speaker_id to the name it overlaps most.
+
+        Returns:
+            tuple: (speaker_id -> name, speaker_id -> confidence between 0
+                    and 1, the winning name's share of the total overlap)
+        """
+        self._close_run()
+        speaker_map = {}
+        speaker_confidence = {}
+        for speaker_id, overlaps in self.overlaps.items():
+            total = sum(overlaps.values())
+            if total > 0:
+                name, overlap = max(overlaps.items(), key=lambda x: x[1])
+                speaker_map[speaker_id] = name
+                speaker_confidence[speaker_id] = overlap / total
+        return speaker_map, speaker_confidence
+
+    def utterances(self, speaker_map=None, speaker_confidence=None):
+        """
+        Yield consolidated utterances: consecutive runs resolved to the same
+        name are merged. Each utterance ends where the next one starts (the
+        last one at the end of the transcript) and carries the lowest
+        confidence of its speaker_ids, 0 for speakers that could not be mapped.
+        """
+        if speaker_map is None:
+            speaker_map, speaker_confidence = self.speaker_map()
+        speaker_confidence = speaker_confidence or {}
+
+        current = None
+        for speaker_id, start, _, text in self.runs:
+            name = speaker_map.get(speaker_id, f"Unknown Speaker ({speaker_id})")
+            if speaker_id not in speaker_map:
+                confidence = 0.0
+            else:
+                confidence = speaker_confidence.get(speaker_id, 1.0)
+
+            if current and current[0] == name:
+                current[2].append(text)
+                current[3] = min(current[3], confidence)
+                continue
+            if current:
+                yield self._format(current, start)
+            current = [name, start, [text], confidence]
+
+        if current:
+            yield self._format(current, self.end_time)
+
+    def _format(self, utterance, end_time):
+        name, start_time, texts, confidence = utterance
+        absolute_start = self.recording_start_time + \
+            datetime.timedelta(seconds=start_time)
+        absolute_end = self.recording_start_time + \
+            datetime.timedelta(seconds=end_time)
+        return {
+            "speaker": name,
+            "text": " ".join(texts),
+            "start": absolute_start.isoformat(),
+            "end": absolute_end.isoformat(),
+            "confidence": round(confidence, 3)
+        }
+
+    def debug_overlaps(self):
+        """Print the overlap seconds per speaker_id and name"""
+        print("Speaker overlap distribution (seconds):")
+        for speaker_id, overlaps in self.overlaps.items():
+            print(f"  Speaker ID '{speaker_id}' overlaps: "
+                  f"{ {name: round(seconds, 2) for name, seconds in overlaps.items()} }")
@@ -0,0 +1,234 @@
+import os
+import time
+import uuid
+import random
+import logging
+import datetime
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+
+from scheduler import scheduler, current_cancellation, RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a connection, and for the response once the upload is sent
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "600"))
+# Failed requests are retried this many times with jittered exponential backoff
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# Longest Retry-After delay honoured before giving up on the request
+RETRY_AFTER_MAX_SECONDS = 300.0
+# Responses with these statuses mean the request was not processed, so it is
+# safe to send again. Other 5xx may come after the server has already done
+# (and billed) the work, so they are returned to the caller.
+RETRY_STATUSES = {408, 425, 429, 503}
+# Upload bodies are read from disk in blocks of this many bytes
+UPLOAD_BLOCK_BYTES = 64 * 1024
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body streamed from disk.
+
+    The form fields and part headers are encoded up front; the file is read
+    in blocks as the connection sends it, so memory use does not depend on
+    the file size. The total length is known, so the request is sent with a
+    Content-Length header rather than chunked encoding. Once the cancelled
+    event is set, reading raises RequestCancelled, which aborts the upload.
+    """
+
+    def __init__(self, fields, file_field, file_path,
+                 content_type="application/octet-stream", cancelled=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        head = b""
+        for name, value in fields.items():
+            head += (f"--{boundary}\r\n"
+                     f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f"{value}\r\n").encode("utf-8")
+        head += (f"--{boundary}\r\n"
+                 f'Content-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{os.path.basename(file_path)}"\r\n'
+                 f"Content-Type: {content_type}\r\n\r\n").encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        self._parts = [head, file_path, tail]
+        self._length = len(head) + os.path.getsize(file_path) + len(tail)
+        self._index = 0
+        self._offset = 0
+        self._file = None
+        self._cancelled = cancelled
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            block = self.read(UPLOAD_BLOCK_BYTES)
+            if not block:
+                return
+            yield block
+
+    def read(self, size=-1):
+        if self._cancelled is not None and self._cancelled.is_set():
+            raise RequestCancelled("Upload cancelled")
+        if size is None or size < 0:
+            size = self._length
+        blocks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                block = part[self._offset:self._offset + size]
+                self._offset += len(block)
+                if self._offset >= len(part):
+                    self._index += 1
+                    self._offset = 0
+            else:
+                if self._file is None:
+                    self._file = open(part, "rb")
+                block = self._file.read(size)
+                if len(block) < size:
+                    self._file.close()
+                    self._file = None
+                    self._index += 1
+            blocks.append(block)
+            size -= len(block)
+        return b"".join(blocks)
+
+    @property
+    def sent(self):
+        """Whether the whole body has been handed to the connection"""
+        return self._index >= len(self._parts)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def retry_after_seconds(response):
+    """Return the delay requested by a Retry-After header, or None"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+class UploadClient:
+    """
+    HTTP client for uploading audio files to speech-to-text APIs.
+
+    Requests go through one pooled keep-alive session, have connect and read
+    timeouts. A request is only retried when the server cannot have processed
+    it: a connection error or timeout before the body was fully sent, or a
+    408/425/429/503 response. Once the whole body is out, a dropped
+    connection or read timeout is raised rather than paying for the upload
+    twice. Retries back off exponentially with full jitter, and a
+    Retry-After header on 429/503 replaces the computed delay. Every attempt
+    streams a fresh body, so a retry sends exactly the same request.
+
+    With a rate_limit_key, every attempt first acquires a slot from the
+    shared scheduler, and a 429 pauses that key for all callers.
+
+    Requests made in a scheduler.cancellation() are given up once its event
+    is set: waiting for a slot or a retry stops, an upload in progress is
+    aborted and a response that arrives anyway is closed unread, all raising
+    RequestCancelled. An upload that was already sent has been processed,
+    and billed, by then; only not waiting for the response is saved.
+    """
+
+    def __init__(self, pool_size=4, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 rate_limit_key=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.rate_limit_key = rate_limit_key
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post_file(self, url, fields, file_field, file_path, headers=None,
+                  stream=False):
+        """
+        POST a file with form fields as streamed multipart/form-data. With
+        stream=True the response body is left unread for the caller.
+
+        Returns:
+            requests.Response: the first non-retryable response
+
+        Raises:
+            requests.exceptions.RequestException: when the last attempt
+                fails, including raise_for_status() of an error response
+            RequestCancelled: when the context's cancellation is set
+        """
+        cancelled = current_cancellation()
+        attempt = 0
+        while True:
+            body = MultipartBody(fields, file_field, file_path,
+                                 cancelled=cancelled)
+            request_headers = dict(headers or {})
+            request_headers["Content-Type"] = body.content_type
+            if self.rate_limit_key:
+                scheduler.acquire(self.rate_limit_key)
+            try:
+                response = self.session.post(
+                    url, data=body, headers=request_headers, timeout=self.timeout,
+                    stream=stream)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if body.sent:
+                    logger.warning(f"Request to {url} failed after the upload "
+                                   f"was sent ({e}), not retrying")
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Request to {url} failed ({e}), "
+                               f"retrying in {delay:.1f}s")
+            else:
+                if cancelled is not None and cancelled.is_set():
+                    response.close()
+                    raise RequestCancelled(f"Request to {url} cancelled")
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = self._backoff(attempt)
+                if response.status_code in (429, 503):
+                    retry_after = retry_after_seconds(response)
+                    if retry_after is not None:
+                        delay = retry_after
+                if response.status_code == 429 and self.rate_limit_key:
+                    scheduler.penalize(self.rate_limit_key, delay)
+                if attempt >= self.max_retries or delay > RETRY_AFTER_MAX_SECONDS:
+                    response.raise_for_status()
+                logger.warning(f"Request to {url} returned {response.status_code}, "
+                               f"retrying in {delay:.1f}s")
+                response.close()
+            finally:
+                body.close()
+
+            if cancelled is None:
+                time.sleep(delay)
+            elif cancelled.wait(delay):
+                raise RequestCancelled(f"Request to {url} cancelled")
+            attempt += 1
+
+    @staticmethod
+    def _backoff(attempt):
+        """Full-jitter exponential backoff delay for a zero-based attempt"""
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS,
+                                     BACKOFF_BASE_SECONDS * 2 ** attempt))
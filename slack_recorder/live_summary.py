@@ -0,0 +1,244 @@
+"""
+Rolling TLDR of a call while it is being recorded.
+
+Closed audio segments are grouped into windows of LIVE_TLDR_WINDOW_SECONDS.
+Each window is transcribed and diarized as soon as it is complete. It is
+cut where its last complete utterance ends and the audio after that is
+carried into the next window, so no utterance is split between two
+transcriptions. Utterances are summarized whenever a full chunk has
+accumulated, and the intermediate summaries are reduced as soon as they
+outgrow one prompt. When the call ends only the last window and the final
+summary are left, and the window transcriptions are stitched into the
+transcript of the call so the recording is not uploaded a second time.
+"""
+import os
+import asyncio
+import tempfile
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import soundfile as sf
+
+import tldr_generator
+from diarization import DiarizationEngine, MIN_SPEAKER_CHANGE_GAP
+from transcription import _transcribe_speech_only, _stitch_transcriptions
+from words import WordStore
+from scheduler import priority, PRIORITY_LIVE
+
+# Summarize calls while they are recorded instead of after transcription
+LIVE_TLDR_ENABLED = os.getenv("LIVE_TLDR_ENABLED", "true").lower() == "true"
+# Seconds of audio transcribed and summarized together during the call
+LIVE_TLDR_WINDOW_SECONDS = float(os.getenv("LIVE_TLDR_WINDOW_SECONDS", "300"))
+
+
+class LiveSummarizer:
+    """
+    Transcribes and summarizes a recording window by window.
+
+    on_segment_closed() is meant to be set as AudioSystem.on_segment_closed.
+    It runs on the audio writer thread, so it only hard-links the segment's
+    STT file (finalize_recording removes the segments) and queues complete
+    windows. Windows are processed in order on a single worker thread, which
+    alone keeps the audio carried from one window into the next.
+    """
+
+    def __init__(self, speaker_records, recording_start_time,
+                 window_seconds=LIVE_TLDR_WINDOW_SECONDS):
+        # Appended to by the speaker poller while the call goes on
+        self.speaker_records = speaker_records
+        self.recording_start_time = recording_start_time
+        self.window_seconds = window_seconds
+        # (offset seconds, transcription or None) of each processed window
+        self.windows = []
+        # Utterance lines not summarized yet and the rolling summaries
+        self.lines = []
+        self.summaries = []
+        self.failed = False
+
+        self._directory = None
+        self._samplerate = None
+        self._segments = []
+        self._segment_seconds = 0.0
+        self._window_offset = None
+        # (path, offset seconds) of the unfinished utterance at the end of
+        # the last window, owned by the worker thread
+        self._carry = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="live-tldr")
+
+    def on_segment_closed(self, manifest, segment):
+        """Queue a closed segment, submitting the window once it is long enough"""
+        data = manifest.data
+        with self._lock:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(
+                    prefix="live-", dir=os.path.dirname(manifest.directory))
+            source = manifest.segment_path(segment, "stt_path")
+            path = os.path.join(self._directory, os.path.basename(source))
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copyfile(source, path)
+
+            self._samplerate = data["stt_samplerate"]
+            if self._window_offset is None:
+                self._window_offset = segment["start_frame"] / data["samplerate"]
+            self._segments.append(path)
+            self._segment_seconds += segment["frames"] / data["samplerate"]
+            if self._segment_seconds >= self.window_seconds:
+                self._submit_window()
+
+    def _submit_window(self, last=False):
+        if not self._segments and not last:
+            return
+        paths, offset = self._segments, self._window_offset
+        self._segments, self._segment_seconds, self._window_offset = [], 0.0, None
+        self._executor.submit(self._process_window, paths, offset, last)
+
+    def _process_window(self, paths, offset, last):
+        """Worker thread: transcribe, diarize and summarize one window"""
+        if self._carry:
+            # The window starts with the utterance the last one was cut before
+            carry_path, offset = self._carry
+            self._carry = None
+            paths = [carry_path] + paths
+        if not paths:
+            return
+        with priority(PRIORITY_LIVE):
+            self._process_window_files(paths, offset, last)
+
+    def _process_window_files(self, paths, offset, last):
+        window_path = paths[0]
+        if len(paths) > 1:
+            window_path = os.path.join(
+                self._directory, f"window_{os.path.basename(paths[0])}")
+        samplerate = self._samplerate
+        try:
+            if len(paths) > 1:
+                with sf.SoundFile(window_path, mode='w', samplerate=samplerate,
+                                  channels=1, format='WAV', subtype='PCM_16') as window:
+                    for path in paths:
+                        for block in sf.blocks(path, blocksize=samplerate * 10,
+                                               dtype='int16'):
+                            window.write(block)
+
+            print(f"Transcribing live window at {offset:.0f}s")
+            transcription = _transcribe_speech_only(window_path, None)
+            if transcription is None:
+                self.windows.append((offset, transcription))
+                self.failed = True
+                return
+            if not last:
+                self._carry_last_utterance(window_path, offset, transcription)
+            self.windows.append((offset, transcription))
+
+            # Diarize in recording time against the speakers seen so far
+            words = WordStore()
+            words.extend(transcription["words"], offset)
+            engine = DiarizationEngine(list(self.speaker_records),
+                                       self.recording_start_time)
+            engine.feed_store(words)
+            text = tldr_generator.format_transcript_for_summary(
+                list(engine.utterances()))
+            if text:
+                self.lines.extend(text.split("\n"))
+            if not self.failed:
+                self._summarize_ready()
+        except Exception as e:
+            print(f"Live summarization of the window at {offset:.0f}s failed: {e}")
+            self.failed = True
+        finally:
+            for path in set(paths + [window_path]):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _carry_last_utterance(self, window_path, offset, transcription):
+        """
+        Drop the window's last utterance, which may go on in the next
+        segments, from its transcription and keep the audio from the end of
+        the utterance before it for the next window. A window of a single
+        utterance is kept whole.
+        """
+        words = transcription["words"]
+        cut = len(words) - 1
+        while cut > 0 and (words.speakers[cut - 1] == words.speakers[cut] and
+                           words.starts[cut] - words.ends[cut - 1] <= MIN_SPEAKER_CHANGE_GAP):
+            cut -= 1
+        if cut <= 0:
+            return
+        cut_seconds = words.ends[cut - 1]
+        words.truncate(cut)
+        transcription["text"] = " ".join(words.texts)
+
+        carry_path = os.path.join(self._directory, f"carry_{len(self.windows)}.wav")
+        with sf.SoundFile(window_path) as window:
+            samplerate = window.samplerate
+            window.seek(min(int(cut_seconds * samplerate), window.frames))
+            with sf.SoundFile(carry_path, mode='w', samplerate=samplerate,
+                              channels=1, format='WAV', subtype='PCM_16') as carry:
+                while True:
+                    block = window.read(samplerate * 10, dtype='int16')
+                    if not len(block):
+                        break
+                    carry.write(block)
+        self._carry = (carry_path, offset + cut_seconds)
+
+    def _summarize_ready(self):
+        """Summarize every full chunk of buffered lines, keeping the last one"""
+        chunks, _ = tldr_generator.pack_lines(self.lines)
+        if len(chunks) < 2:
+            return
+        self.lines = chunks[-1].split("\n")
+        tldr_generator.run_async(self._summarize_chunks(chunks[:-1]))
+
+    async def _summarize_chunks(self, chunks):
+        semaphore = asyncio.Semaphore(tldr_generator.TLDR_CONCURRENCY)
+        summaries = await asyncio.gather(*[
+            tldr_generator.generate_summary_from_text(chunk, semaphore, is_chunk=True)
+            for chunk in chunks])
+        self.summaries.extend(summary for summary in summaries if summary)
+        # Running reduce, so the final summary never waits for a deep one
+        self.summaries = await tldr_generator.reduce_to_prompt(
+            self.summaries, semaphore)
+
+    async def _final_summary(self):
+        semaphore = asyncio.Semaphore(tldr_generator.TLDR_CONCURRENCY)
+        text = "\n".join(self.lines)
+        if not self.summaries:
+            if not text:
+                return "Недостаточно информации для создания TL;DR."
+            if tldr_generator.fits_in_prompt(tldr_generator.normalize_chunk(text)):
+                return await tldr_generator.generate_summary_from_text(text, semaphore)
+        if text:
+            await self._summarize_chunks(tldr_generator.pack_lines(self.lines)[0])
+        if not self.summaries:
+            return "Ошибка при создании итогового TL;DR."
+        return await tldr_generator.generate_final_summary(
+            "\n\n".join(self.summaries), semaphore)
+
+    def finish(self):
+        """
+        Process the last window and produce the TLDR. Call once the
+        recording has stopped and its writer is closed.
+
+        Returns:
+            tuple: (TLDR, stitched transcription with words in a WordStore),
+                   both None when a window failed and the recording has to
+                   be transcribed and summarized after all
+        """
+        with self._lock:
+            self._submit_window(last=True)
+        self._executor.shutdown(wait=True)
+        try:
+            if self.failed or not self.windows:
+                return None, None
+            transcription = _stitch_transcriptions(
+                [transcription for _, transcription in self.windows],
+                [offset for offset, _ in self.windows])
+            with priority(PRIORITY_LIVE):
+                tldr = tldr_generator.run_async(self._final_summary())
+            return tldr_generator.clean_tldr(tldr), transcription
+        finally:
+            if self._directory:
+                shutil.rmtree(self._directory, ignore_errors=True)
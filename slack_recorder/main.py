@@ -4,20 +4,20 @@ import logging
 import sys
 import platform
 import argparse
+import functools
 from dotenv import load_dotenv
 from slack_sdk import WebClient
 from slack_sdk.socket_mode import SocketModeClient
 from slack_sdk.socket_mode.response import SocketModeResponse
-from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import threading
-from datetime import datetime, timezone
 from database import DatabaseManager
-from transcription import transcribe_audio
+from sessions import (SessionManager, launch_browser, process_recording,
+                      recovered_recording_job, RECORDING_JOB)
+from jobs import JobQueue, JobWorkerPool
 from audio import AudioSystem
-from selenium.common.exceptions import StaleElementReferenceException
 
 
 # Configure logging
@@ -41,20 +41,22 @@ class SlackHuddleRecorder:
         self.user_token = user_token
         self.web_client = WebClient(token=self.user_token)
         self.socket_client = None
+        # Signed-in browser whose cookies every huddle session starts with
         self.driver = None
-        self.recording = False
-        self.recorder_thread = None
+        self._driver_lock = threading.Lock()
         self.running = True
-        self.last_huddle_leave_time = 0
-        self.is_joining_huddle = False
-        self.current_huddle_link = None
-        self.current_huddle_name = ""
         self.headless = headless
-        self.speaker_records = []
 
         # Initialize managers
         self.db_manager = DatabaseManager()
         self.audio_system = None
+        # Recordings are transcribed and stored in the background, including
+        # ones queued before a restart
+        self.jobs = JobQueue()
+        self.workers = JobWorkerPool(self.jobs, {
+            RECORDING_JOB: functools.partial(process_recording, self.db_manager)})
+        self.sessions = SessionManager(
+            self.jobs, self._session_cookies, headless=headless)
 
         # Create directories
         os.makedirs('recordings', exist_ok=True)
@@ -81,53 +83,25 @@ class SlackHuddleRecorder:
         try:
             self.audio_system = AudioSystem()
             logger.info("Audio system initialized successfully")
+            # Finalize segments left behind if the container died mid-call
+            recovered = self.audio_system.recover_orphaned_recordings('recordings')
         except Exception as e:
             logger.error(f"Failed to initialize audio system: {str(e)}")
             raise
 
-    # Specialized function for clicking using JavaScript
-    def _js_click(self, element):
-        try:
-            self.driver.execute_script(
-                "arguments[0].click();", element)
-            logger.info("Clicked button using JS. HTML: %s",
-                        element.get_attribute('outerHTML'))
-        except Exception as e:
-            logger.error("JS click failed: %s", e)
+        # and process them like any other finished recording
+        for recording in recovered:
+            try:
+                self.jobs.enqueue(RECORDING_JOB, recovered_recording_job(recording))
+            except Exception as e:
+                logger.error(f"Failed to queue recovered recording "
+                             f"{recording['recording']}: {str(e)}")
+
+        self.workers.start()
 
     def _initialize_browser(self):
         """Initialize or reinitialize the Chrome browser with appropriate options"""
-        options = webdriver.ChromeOptions()
-
-        options.add_argument('--use-fake-ui-for-media-stream')
-        options.add_argument('--window-size=1920,1080')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--disable-gpu')
-        options.add_argument('--disable-software-rasterizer')
-        options.add_argument('--autoplay-policy=no-user-gesture-required')
-
-        if self.headless:
-            options.add_argument('--headless=new')
-
-        # Chrome binary and ChromeDriver with platform-specific defaults
-        if sys.platform == "darwin":
-            chrome_binary = os.environ.get(
-                'CHROME_BIN', '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome')
-            chromedriver_path = os.environ.get(
-                'CHROMEDRIVER_PATH', '/opt/homebrew/bin/chromedriver')
-        else:
-            chrome_binary = os.environ.get('CHROME_BIN', '/usr/bin/chromium')
-            chromedriver_path = os.environ.get(
-                'CHROMEDRIVER_PATH', '/usr/bin/chromedriver')
-
-        options.binary_location = chrome_binary
-        options.add_argument('--browser-binary=' + chrome_binary)
-
-        from selenium.webdriver.chrome.service import Service
-        service = Service(executable_path=chromedriver_path)
-        service.creation_flags = 0  # Ensure no special flags are set
-        self.driver = webdriver.Chrome(service=service, options=options)
+        self.driver = launch_browser(self.headless)
 
         logger.info(
             f"Browser initialized in {'headless' if self.headless else 'normal'} mode")
@@ -266,306 +240,21 @@ class SlackHuddleRecorder:
                 logger.error(f"Failed to log in to Slack: {str(e)}")
                 raise
 
-    def join_huddle(self, huddle_link):
-        """Join a Slack huddle using its link"""
-        if self.is_joining_huddle or self.recording:
-            logger.info(
-                f"Already in or joining a huddle, ignoring join request for: {huddle_link}")
-            return
+    def _session_cookies(self):
+        """Cookies of the signed-in browser, for new huddle sessions"""
+        with self._driver_lock:
+            return self.driver.get_cookies()
 
-        try:
-            self.is_joining_huddle = True
-            self.current_huddle_link = huddle_link
-            self.speaker_records = []
-            # Initialize speaker accumulators for duration and metadata
-            self.speaker_durations = {}   # {speaker_name: total_seconds}
-            # {speaker_name: profile_pic_url (or None)}
-            self.speaker_metadata = {}
-            logger.info(f"Joining huddle: {huddle_link}")
-
-            self.driver.get(huddle_link)
-
-            # Wait for and manually follow the "use Slack in your browser" link
-            browser_link_element = WebDriverWait(self.driver, 20).until(
-                EC.element_to_be_clickable(
-                    (By.CSS_SELECTOR,
-                     "[data-qa='ssb_redirect_open_in_browser']")
-                )
-            )
-            browser_link = browser_link_element.get_attribute('href')
-            logger.info("Following join link: %s", browser_link)
-            self.driver.get(browser_link)
-
-            # Wait for the join button
-            logger.info("Waiting for join button...")
-            join_btn = WebDriverWait(self.driver, 20).until(
-                EC.element_to_be_clickable(
-                    (By.CSS_SELECTOR,
-                     "[data-qa='huddle_from_link_speed_bump_modal_old_go']")
-                )
-            )
-            self._js_click(join_btn)
-
-            # Wait for the huddle to load
-            logger.info("Waiting for huddle to load...")
-            WebDriverWait(self.driver, 20).until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR,
-                     "div[data-qa='peer-tile--self']")
-                )
-            )
-            logger.info("Huddle loaded")
-
-            # Extract huddle name
-            try:
-                huddle_name_element = WebDriverWait(self.driver, 10).until(
-                    EC.presence_of_element_located(
-                        (By.CSS_SELECTOR,
-                         "div.p-huddle_details button[data-qa='huddle_details_title'] span")
-                    )
-                )
-                self.current_huddle_name = huddle_name_element.text.strip()
-                logger.info("Huddle name extracted: %s",
-                            self.current_huddle_name)
-            except Exception as e:
-                logger.warning("Could not extract huddle name: %s", str(e))
-                self.current_huddle_name = "huddle"
-
-            # Start recording
-            timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-            self.start_recording(
-                f"huddle_recording_{timestamp}.wav")
-
-            # Monitor huddle status
-            def check_huddle_status():
-                last_check = time.time()  # Used to compute elapsed polling time
-                previous_speakers = []  # Track the last state of active speakers
-
-                while self.recording:
-                    current_time = time.time()
-                    delta = current_time - last_check
-                    last_check = current_time
-
-                    try:
-                        # Find the peer list and retrieve participant tiles
-                        peer_list = self.driver.find_element(
-                            By.CLASS_NAME, "p-peer_tile_list"
-                        )
-                        all_tiles = peer_list.find_elements(
-                            By.CLASS_NAME, "p-peer_tile__container")
-                        participant_tiles = [tile for tile in all_tiles
-                                             if not tile.find_elements(By.CLASS_NAME, "p-peer_tile__invite_status_overlay")]
-
-                        # If only the bot remains and the call started more than 10 seconds ago, stop recording
-                        if len(participant_tiles) <= 1 and time.time() - self.recording_launch_time.timestamp() > 10:
-                            logger.info(
-                                "Only bot remaining in huddle, disconnecting...")
-                            self.stop_recording()
-                            break
-
-                        # Determine the current active speakers and update durations/metadata
-                        current_speakers = []
-                        for tile in participant_tiles:
-                            # Check if the tile element itself indicates an active speaker
-                            tile_classes = tile.get_attribute("class") or ""
-                            if "p-peer_tile__active_speaker--outline" in tile_classes:
-                                # Extract the user's name from the aria-label (text before the comma)
-                                aria_label = tile.get_attribute("aria-label")
-                                if aria_label:
-                                    name = aria_label.split(",")[0].strip()
-                                    current_speakers.append(name)
-                                    # Update duration for this speaker
-                                    self.speaker_durations[name] = self.speaker_durations.get(
-                                        name, 0) + delta
-                                    # Update speaker metadata if not already captured
-                                    if name not in self.speaker_metadata:
-                                        try:
-                                            img_element = tile.find_element(
-                                                By.TAG_NAME, "img")
-                                            profile_pic = img_element.get_attribute(
-                                                "src")
-                                        except Exception as img_error:
-                                            profile_pic = None
-                                        self.speaker_metadata[name] = profile_pic
-
-                        # Sort for consistent ordering
-                        current_speakers.sort()
-
-                        # If the list of active speakers has changed, add a new record
-                        if current_speakers != previous_speakers:
-                            timestamp = datetime.now(
-                                timezone.utc).isoformat()
-                            self.speaker_records.append({
-                                "timestamp": timestamp,
-                                "speakers": current_speakers.copy()
-                            })
-                            previous_speakers = current_speakers.copy()
-
-                        # Poll every 500ms
-                        time.sleep(0.5)
-
-                    except StaleElementReferenceException:
-                        logger.debug(
-                            "Stale element encountered in check_huddle_status loop. Retrying...")
-                        time.sleep(0.5)
-                        continue
-
-                    except Exception as e:
-                        try:
-                            # Check if screensharing is happening
-                            self.driver.find_element(
-                                By.CSS_SELECTOR, '[data-qa="free-willy-video-element"]')
-                            # Remove active speakers
-                            if previous_speakers != []:
-                                timestamp = datetime.now(
-                                    timezone.utc).isoformat()
-                                self.speaker_records.append({
-                                    "timestamp": timestamp,
-                                    "speakers": []
-                                })
-                                previous_speakers = []
-                            continue
-                        except:
-                            logger.info(
-                                "Huddle ended or disconnected: %s", str(e))
-                            self.stop_recording()
-                            break
-
-                # When recording stops, print out the speaker log to the console
-                logger.info("Speaker activity log: %s", self.speaker_records)
-
-            threading.Thread(target=check_huddle_status, daemon=True).start()
-
-        except Exception as e:
-            logger.error(f"Failed to join huddle: {str(e)}")
-            try:
-                page_source = self.driver.page_source
-                logger.error("Current page HTML at time of failure:")
-                logger.error(page_source)
-            except Exception as page_error:
-                logger.error(f"Could not get page source: {str(page_error)}")
-            self.is_joining_huddle = False
-            self.current_huddle_link = None
-
-    def start_recording(self, filename):
-        """Start recording a huddle"""
-        if not self.recording:
-            self.current_recording_filename = os.path.join(
-                'recordings', filename)
-            self.recording = True
-            self.recorder_thread = threading.Thread(target=self._record)
-            self.recorder_thread.start()
-
-    def _record(self):
-        """Internal method to handle recording"""
-        try:
-            self.recording_launch_time = datetime.now(timezone.utc)
-            logger.info("Audio recording launched at: %s",
-                        self.recording_launch_time.isoformat())
-            self.audio_system.start_recording(self.current_recording_filename)
-        except Exception as e:
-            logger.error(f"Recording failed: {str(e)}")
-            self.recording = False
-
-    def stop_recording(self):
-        """Stop the recording, transcribe it, and add it to database"""
-        if self.recording and self.recorder_thread:
-            self.audio_system.stop_recording()
-            self.recorder_thread.join()
-            self.recording = False
-            recording_end_time = datetime.now(timezone.utc)
-
-            # Calculate duration in seconds
-            duration = int(
-                (recording_end_time - self.recording_launch_time).total_seconds())
-            logger.info(
-                f"Recording duration: {duration} seconds (started at {self.recording_launch_time.isoformat()} and ended at {recording_end_time.isoformat()})")
-
-            # Leave the huddle
-            try:
-                leave_button = WebDriverWait(self.driver, 20).until(
-                    EC.element_to_be_clickable(
-                        (By.CSS_SELECTOR,
-                         "[data-qa='huddle_mini_player_leave_button']")
-                    )
-                )
-                self._js_click(leave_button)
-            except Exception as e:
-                logger.error(f"Failed to click leave huddle button: {str(e)}")
-
-            # Reset huddle state
-            self.is_joining_huddle = False
-            self.current_huddle_link = None
-            self.last_huddle_leave_time = time.time()
-
-            # Process recording
-            if hasattr(self, 'current_recording_filename'):
-                try:
-                    # Transcribe the audio
-                    transcript = transcribe_audio(
-                        self.current_recording_filename,
-                        self.speaker_records,
-                        self.recording_launch_time
-                    )
-
-                    # Add to database including duration and tldr
-                    self.db_manager.add_recording(
-                        filename=os.path.basename(
-                            self.current_recording_filename),
-                        source="slack",
-                        meeting_name=self.current_huddle_name,
-                        transcript=transcript.get("text"),
-                        diarized_transcript=transcript.get("diarized"),
-                        created_at=self.recording_launch_time,
-                        speakers=self._get_speaker_summary(),
-                        duration=duration,
-                        tldr=transcript.get("tldr")
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to process recording: {str(e)}")
-
-            self.current_huddle_name = ""
-
-    def _get_speaker_summary(self):
-        """
-        Generate a summary dictionary of speakers with their name, profile picture, 
-        and total speaking duration (in seconds).
-        """
-        summary = {}
-        for name in self.speaker_metadata:
-            summary[name] = {
-                "name": name,
-                "profile_pic": self.speaker_metadata.get(name),
-                "duration": round(self.speaker_durations.get(name, 0), 2)
-            }
-        return summary
+    def join_huddle(self, huddle_link):
+        """Record a Slack huddle now, or once a session slot is free"""
+        self.sessions.request(huddle_link)
 
     def process_event(self, client, req):
         """Process incoming Slack events"""
         try:
 
-            if req.payload.get("type") == "event_callback":
-                event = req.payload.get("event", {})
-
-                # Ignore huddle events if we're in cooldown period
-                if time.time() - self.last_huddle_leave_time < 30:
-                    logger.info("Ignoring event - in cooldown period")
-                    if hasattr(req, 'envelope_id'):
-                        response = SocketModeResponse(
-                            envelope_id=req.envelope_id)
-                        client.send_socket_mode_response(response)
-                    return
-
-                # Ignore huddle events if we're already in or joining a huddle
-                if self.is_joining_huddle or self.recording:
-                    logger.info(
-                        "Ignoring event - already in or joining a huddle")
-                    if hasattr(req, 'envelope_id'):
-                        response = SocketModeResponse(
-                            envelope_id=req.envelope_id)
-                        client.send_socket_mode_response(response)
-                    return
-
+            # Huddles already recorded, queued or just left are ignored by
+            # the session manager
             if req.payload.get("type") == "event_callback":
                 event = req.payload.get("event", {})
                 logger.info(f"Event callback details: {event}")
@@ -621,8 +310,7 @@ class SlackHuddleRecorder:
         """Cleanup resources"""
         logger.info("Shutting down...")
         self.running = False
-        if self.recording:
-            self.stop_recording()
+        self.sessions.stop_all()
 
         # Close socket client
         if self.socket_client:
@@ -640,6 +328,11 @@ class SlackHuddleRecorder:
         if self.audio_system:
             self.audio_system.cleanup()
 
+        # Give running jobs a moment; unfinished ones are leased again after
+        # the restart
+        self.workers.stop(timeout=30)
+        self.jobs.close()
+
         # Close database session
         self.db_manager.close()
 
@@ -0,0 +1,661 @@
+"""
+Concurrent huddle recording sessions.
+
+Every huddle is recorded by a HuddleSession with its own Chrome instance,
+signed in with the cookies of the recorder's main browser, its own
+PulseAudio null sink that only this Chrome plays into, an AudioSystem
+capturing the monitor of that sink, and its own speaker timeline. When
+the sink cannot be created, the session falls back to the default device
+only if MAX_CONCURRENT_HUDDLES is 1, and does not join otherwise.
+SessionManager runs up to MAX_CONCURRENT_HUDDLES sessions at once and
+queues the huddles that start while every slot is taken.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from transcription import transcribe_audio
+from live_summary import LiveSummarizer, LIVE_TLDR_ENABLED
+from speaker_tracker import SpeakerTracker, COLLECTOR_SCRIPT, SPEAKER_DRAIN_SECONDS
+from browser_events import (BrowserEvents, SPEAKERS_CHANGED, PARTICIPANT_JOINED,
+                            PARTICIPANT_LEFT, SCREEN_SHARE_STARTED,
+                            SCREEN_SHARE_STOPPED, CALL_ENDED, DISCONNECTED)
+from audio import AudioSystem
+from words import parse_transcription
+
+logger = logging.getLogger(__name__)
+
+# Huddles recorded at the same time by this container, each with a browser
+MAX_CONCURRENT_HUDDLES = int(os.getenv("MAX_CONCURRENT_HUDDLES", "1"))
+# Huddles waiting for a free slot; later ones are dropped
+MAX_QUEUED_HUDDLES = int(os.getenv("MAX_QUEUED_HUDDLES", "20"))
+# Seconds after leaving a huddle during which its events are ignored
+REJOIN_COOLDOWN_SECONDS = 30
+# Job kind of a finished recording waiting to be processed
+RECORDING_JOB = "slack_recording"
+# Transcription and TLDR made during the call, saved next to the recording
+# by the job
+LIVE_TRANSCRIPTION_SUFFIX = "_live.json"
+LIVE_TLDR_SUFFIX = "_live_tldr.txt"
+
+# LiveSummarizers of stopped recordings, by live transcription path, until
+# their job finishes them. Jobs run after a restart find none and transcribe
+# the recording instead.
+_live_summarizers = {}
+_live_summarizers_lock = threading.Lock()
+
+
+def launch_browser(headless, env=None):
+    """
+    Start Chrome through ChromeDriver.
+
+    Args:
+        headless: Run without a window
+        env: Environment of ChromeDriver and the browser, by default the
+             recorder's
+    """
+    options = webdriver.ChromeOptions()
+
+    options.add_argument('--use-fake-ui-for-media-stream')
+    options.add_argument('--window-size=1920,1080')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--disable-software-rasterizer')
+    options.add_argument('--autoplay-policy=no-user-gesture-required')
+
+    if headless:
+        options.add_argument('--headless=new')
+
+    # Chrome binary and ChromeDriver with platform-specific defaults
+    if sys.platform == "darwin":
+        chrome_binary = os.environ.get(
+            'CHROME_BIN', '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome')
+        chromedriver_path = os.environ.get(
+            'CHROMEDRIVER_PATH', '/opt/homebrew/bin/chromedriver')
+    else:
+        chrome_binary = os.environ.get('CHROME_BIN', '/usr/bin/chromium')
+        chromedriver_path = os.environ.get(
+            'CHROMEDRIVER_PATH', '/usr/bin/chromedriver')
+
+    options.binary_location = chrome_binary
+    options.add_argument('--browser-binary=' + chrome_binary)
+
+    from selenium.webdriver.chrome.service import Service
+    service = Service(executable_path=chromedriver_path, env=env)
+    service.creation_flags = 0  # Ensure no special flags are set
+    return webdriver.Chrome(service=service, options=options)
+
+
+class _SessionLog(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[{self.extra['session']}] {msg}", kwargs
+
+
+class HuddleSession:
+    """
+    One huddle: joins it in a dedicated browser, records it until it is over
+    and queues the recording for processing. run() does all of it on the
+    calling thread.
+    """
+
+    def __init__(self, manager, huddle_link):
+        self.manager = manager
+        self.id = uuid.uuid4().hex[:8]
+        self.huddle_link = huddle_link
+        self.huddle_name = ""
+        self.log = _SessionLog(logger, {"session": self.id})
+        self.driver = None
+        self.audio_system = None
+        self.recording = False
+        self.recorder_thread = None
+        self.recording_launch_time = None
+        self.recording_filename = None
+        self.live_summarizer = None
+        self.speaker_records = []
+        # {speaker_name: total_seconds}
+        self.speaker_durations = {}
+        # {speaker_name: profile_pic_url (or None)}
+        self.speaker_metadata = {}
+        self._stop_lock = threading.Lock()
+        self._released = False
+
+    @property
+    def sink_name(self):
+        return f"huddle_{self.id}"
+
+    def run(self):
+        """Join and record the huddle, then free the slot"""
+        try:
+            self._open()
+            self.join()
+            if self.recording:
+                self.monitor()
+        except Exception as e:
+            self.log.error(f"Failed to join huddle: {str(e)}")
+            if self.driver:
+                try:
+                    self.log.error("Current page HTML at time of failure:")
+                    self.log.error(self.driver.page_source)
+                except Exception as page_error:
+                    self.log.error(f"Could not get page source: {str(page_error)}")
+            self.stop_recording()
+        finally:
+            self._release()
+
+    def _open(self):
+        """Create the session's sink, audio capture and signed-in browser"""
+        try:
+            self.audio_system = AudioSystem.for_session(self.sink_name)
+            self.log.info(f"Recording from sink {self.sink_name}")
+        except Exception as e:
+            # Sessions on the default device would record each other's
+            # huddles, so it is only used when there is one session at a time
+            if self.manager.capacity > 1:
+                self.log.error(f"Could not create a sink, not joining: {e}")
+                raise
+            self.log.error(f"Could not create a sink, using the default "
+                           f"device: {e}")
+            self.audio_system = AudioSystem()
+
+        env = self.audio_system.browser_env()
+        self.driver = launch_browser(self.manager.headless, env)
+        self.driver.get("https://app.slack.com")
+        for cookie in self.manager.cookies():
+            try:
+                self.driver.add_cookie(cookie)
+            except Exception as e:
+                self.log.debug(f"Skipped cookie {cookie.get('name')}: {e}")
+
+    # Specialized function for clicking using JavaScript
+    def _js_click(self, element):
+        try:
+            self.driver.execute_script(
+                "arguments[0].click();", element)
+            self.log.info("Clicked button using JS. HTML: %s",
+                          element.get_attribute('outerHTML'))
+        except Exception as e:
+            self.log.error("JS click failed: %s", e)
+
+    def join(self):
+        """Join the huddle and start recording it"""
+        self.log.info(f"Joining huddle: {self.huddle_link}")
+        self.driver.get(self.huddle_link)
+
+        # Wait for and manually follow the "use Slack in your browser" link
+        browser_link_element = WebDriverWait(self.driver, 20).until(
+            EC.element_to_be_clickable(
+                (By.CSS_SELECTOR,
+                 "[data-qa='ssb_redirect_open_in_browser']")
+            )
+        )
+        browser_link = browser_link_element.get_attribute('href')
+        self.log.info("Following join link: %s", browser_link)
+        self.driver.get(browser_link)
+
+        # Wait for the join button
+        self.log.info("Waiting for join button...")
+        join_btn = WebDriverWait(self.driver, 20).until(
+            EC.element_to_be_clickable(
+                (By.CSS_SELECTOR,
+                 "[data-qa='huddle_from_link_speed_bump_modal_old_go']")
+            )
+        )
+        self._js_click(join_btn)
+
+        # Wait for the huddle to load
+        self.log.info("Waiting for huddle to load...")
+        WebDriverWait(self.driver, 20).until(
+            EC.presence_of_element_located(
+                (By.CSS_SELECTOR,
+                 "div[data-qa='peer-tile--self']")
+            )
+        )
+        self.log.info("Huddle loaded")
+
+        # Extract huddle name
+        try:
+            huddle_name_element = WebDriverWait(self.driver, 10).until(
+                EC.presence_of_element_located(
+                    (By.CSS_SELECTOR,
+                     "div.p-huddle_details button[data-qa='huddle_details_title'] span")
+                )
+            )
+            self.huddle_name = huddle_name_element.text.strip()
+            self.log.info("Huddle name extracted: %s", self.huddle_name)
+        except Exception as e:
+            self.log.warning("Could not extract huddle name: %s", str(e))
+            self.huddle_name = "huddle"
+
+        # Start recording; the session id keeps simultaneous files apart
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+        self.start_recording(f"huddle_recording_{timestamp}_{self.id}.wav")
+
+    def monitor(self):
+        """
+        Follow the huddle until it is over: the page pushes speaker,
+        participant and end-of-call changes over CDP; without CDP, speaker
+        changes are collected in the page and drained once per
+        SPEAKER_DRAIN_SECONDS
+        """
+        tracker = SpeakerTracker(self.driver, self.speaker_records,
+                                 self.speaker_durations, self.speaker_metadata)
+        events = BrowserEvents(self.driver, COLLECTOR_SCRIPT)
+        if events.start():
+            self.log.info("Following huddle events over CDP")
+            self._follow_huddle_events(events, tracker)
+        else:
+            self.log.info("CDP events unavailable (%s), polling the huddle",
+                          events.error)
+            self._poll_huddle_status(tracker)
+
+        # When recording stops, print out the speaker log to the console
+        self.log.info("Speaker activity log: %s", self.speaker_records)
+
+    def _follow_huddle_events(self, events, tracker):
+        """Stop the recording as soon as the page reports the huddle is over"""
+        participants = None
+        try:
+            while self.recording:
+                event = events.get(timeout=1)
+                if event is None:
+                    tracker.accumulate(time.time() * 1000)
+                elif event.type == SPEAKERS_CHANGED:
+                    tracker.change(event.time * 1000, event.data["speakers"],
+                                   event.data.get("metadata"))
+                elif event.type in (PARTICIPANT_JOINED, PARTICIPANT_LEFT):
+                    participants = event.data["count"]
+                    self.log.info("%s %s the huddle (%d present)", event.data["name"],
+                                  "joined" if event.type == PARTICIPANT_JOINED else "left",
+                                  participants)
+                elif event.type in (SCREEN_SHARE_STARTED, SCREEN_SHARE_STOPPED):
+                    self.log.info("Screen share %s", event.type.rsplit("_", 1)[1])
+                elif event.type in (CALL_ENDED, DISCONNECTED):
+                    self.log.info("Huddle ended or disconnected: %s",
+                                  event.data.get("reason"))
+                    tracker.accumulate(event.time * 1000)
+                    self.stop_recording()
+                    break
+
+                # If only the bot remains and the call started more than 10 seconds ago, stop recording
+                if (participants is not None and participants <= 1 and
+                        time.time() - self.recording_launch_time.timestamp() > 10):
+                    self.log.info("Only bot remaining in huddle, disconnecting...")
+                    tracker.accumulate(time.time() * 1000)
+                    self.stop_recording()
+                    break
+        finally:
+            events.stop()
+
+    def _poll_huddle_status(self, tracker):
+        """Drain the speaker collector until the huddle is over"""
+        while self.recording:
+            try:
+                state = tracker.poll()
+            except Exception as e:
+                self.log.info("Huddle ended or disconnected: %s", str(e))
+                self.stop_recording()
+                break
+
+            if not state["peer_list"]:
+                # The peer list is hidden while someone shares their
+                # screen; otherwise the huddle is gone
+                if not state["screen_share"]:
+                    self.log.info(
+                        "Huddle ended or disconnected: peer list not found")
+                    self.stop_recording()
+                    break
+            # If only the bot remains and the call started more than 10 seconds ago, stop recording
+            elif state["participants"] <= 1 and time.time() - self.recording_launch_time.timestamp() > 10:
+                self.log.info(
+                    "Only bot remaining in huddle, disconnecting...")
+                self.stop_recording()
+                break
+
+            time.sleep(SPEAKER_DRAIN_SECONDS)
+
+    def start_recording(self, filename):
+        """Start recording the huddle"""
+        if not self.recording:
+            self.recording_filename = self.audio_system.get_output_path(
+                os.path.join('recordings', filename))
+            self.recording = True
+            self.recorder_thread = threading.Thread(
+                target=self._record, name=f"record-{self.id}")
+            self.recorder_thread.start()
+
+    def _record(self):
+        """Internal method to handle recording"""
+        try:
+            self.recording_launch_time = datetime.now(timezone.utc)
+            self.log.info("Audio recording launched at: %s",
+                          self.recording_launch_time.isoformat())
+            if LIVE_TLDR_ENABLED:
+                # Transcribe and summarize closed segments during the call
+                self.live_summarizer = LiveSummarizer(
+                    self.speaker_records, self.recording_launch_time)
+                self.audio_system.on_segment_closed = self.live_summarizer.on_segment_closed
+            self.audio_system.recording_metadata = self._recording_metadata
+            self.audio_system.start_recording(self.recording_filename)
+        except Exception as e:
+            self.log.error(f"Recording failed: {str(e)}")
+            self.recording = False
+
+    def stop_recording(self):
+        """
+        Stop the recording, leave the huddle and free the slot, then queue
+        the recording for transcription and the database
+        """
+        with self._stop_lock:
+            if not (self.recording and self.recorder_thread):
+                return
+            self.audio_system.stop_recording()
+            self.recorder_thread.join()
+            self.recording = False
+        recording_end_time = datetime.now(timezone.utc)
+
+        # Calculate duration in seconds
+        duration = int(
+            (recording_end_time - self.recording_launch_time).total_seconds())
+        self.log.info(
+            f"Recording duration: {duration} seconds (started at {self.recording_launch_time.isoformat()} and ended at {recording_end_time.isoformat()})")
+
+        # Leave the huddle
+        try:
+            leave_button = WebDriverWait(self.driver, 20).until(
+                EC.element_to_be_clickable(
+                    (By.CSS_SELECTOR,
+                     "[data-qa='huddle_mini_player_leave_button']")
+                )
+            )
+            self._js_click(leave_button)
+        except Exception as e:
+            self.log.error(f"Failed to click leave huddle button: {str(e)}")
+
+        # The browser and sink are not needed for processing
+        self._release()
+
+        # Hand the recording to the post-processing workers. The job finishes
+        # the live summary, so it is queued before any more requests are made.
+        live_summarizer, self.live_summarizer = self.live_summarizer, None
+        self.audio_system.on_segment_closed = None
+        live_transcription_path = None
+        if live_summarizer:
+            live_transcription_path = os.path.splitext(
+                self.recording_filename)[0] + LIVE_TRANSCRIPTION_SUFFIX
+            with _live_summarizers_lock:
+                _live_summarizers[live_transcription_path] = live_summarizer
+        try:
+            self.manager.jobs.enqueue(RECORDING_JOB, {
+                "recording_filename": self.recording_filename,
+                "stt_filename": self.audio_system.get_stt_path(self.recording_filename),
+                "speaker_records": self.speaker_records,
+                "recording_launch_time": self.recording_launch_time.isoformat(),
+                "huddle_name": self.huddle_name,
+                "speakers": self._get_speaker_summary(),
+                "duration": duration,
+                "live_transcription_path": live_transcription_path
+            })
+        except Exception as e:
+            self.log.error(f"Failed to queue the recording for processing: {str(e)}")
+            if live_summarizer:
+                with _live_summarizers_lock:
+                    _live_summarizers.pop(live_transcription_path, None)
+
+    def _release(self):
+        """Close the browser, audio and sink and hand the slot on, once"""
+        with self._stop_lock:
+            if self._released:
+                return
+            self._released = True
+        if self.driver:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                self.log.warning(f"Failed to close the browser: {str(e)}")
+        if self.audio_system:
+            self.audio_system.cleanup()
+        self.manager.release(self)
+
+    def _recording_metadata(self):
+        """Job details of the recording so far, kept for crash recovery"""
+        return {
+            "huddle_name": self.huddle_name,
+            "recording_launch_time": self.recording_launch_time.isoformat(),
+            "speaker_records": list(self.speaker_records),
+            "speakers": self._get_speaker_summary()
+        }
+
+    def _get_speaker_summary(self):
+        """
+        Generate a summary dictionary of speakers with their name, profile picture,
+        and total speaking duration (in seconds).
+        """
+        summary = {}
+        # The speaker tracker may add speakers while the recording is saved
+        for name in list(self.speaker_metadata):
+            summary[name] = {
+                "name": name,
+                "profile_pic": self.speaker_metadata.get(name),
+                "duration": round(self.speaker_durations.get(name, 0), 2)
+            }
+        return summary
+
+
+def _finish_live_summary(live_path, stage):
+    """
+    Process the last window of a live summary started in this process and
+    save its transcription and TLDR at live_path for the job to use.
+    """
+    with _live_summarizers_lock:
+        live_summarizer = _live_summarizers.pop(live_path, None)
+    if live_summarizer is None:
+        return
+    # Only the last window is left if the call was summarized live
+    try:
+        with stage("live summary"):
+            live_tldr, live_transcription = live_summarizer.finish()
+    except Exception as e:
+        logger.error(f"Live summarization failed: {str(e)}")
+        return
+    if live_tldr is None:
+        logger.warning("Live summarization failed, transcribing the recording")
+        return
+    with open(live_path[:-len(LIVE_TRANSCRIPTION_SUFFIX)] + LIVE_TLDR_SUFFIX, "w") as f:
+        f.write(live_tldr)
+    _save_transcription(live_path, live_transcription)
+    logger.info(f"Live TLDR ready for {os.path.basename(live_path)}")
+
+
+def _save_transcription(path, transcription):
+    """Write a transcription in the provider JSON shape parse_transcription reads"""
+    with open(path, "w") as f:
+        json.dump({"text": transcription.get("text", ""),
+                   "words": list(transcription["words"].words())}, f)
+
+
+def recovered_recording_job(recording):
+    """
+    RECORDING_JOB payload for a recording AudioSystem.recover_orphaned_recordings
+    finalized after a crash. Without the meeting details saved in its
+    manifest, its speakers are left unknown.
+    """
+    meeting = recording["meeting"] or {}
+    return {
+        "recording_filename": recording["recording"],
+        "stt_filename": recording["stt_recording"],
+        "speaker_records": meeting.get("speaker_records", []),
+        "recording_launch_time": meeting.get("recording_launch_time",
+                                             recording["started_at"]),
+        "huddle_name": meeting.get("huddle_name") or "huddle",
+        "speakers": meeting.get("speakers", {}),
+        "duration": int(recording["duration"]),
+        "live_transcription_path": None
+    }
+
+
+def process_recording(db_manager, job):
+    """
+    Worker side of a RECORDING_JOB: transcribe, diarize and summarize the
+    recording and add it to the database. Safe to run again for a recording
+    that was already added.
+    """
+    payload = job.payload
+    filename = os.path.basename(payload["recording_filename"])
+    if db_manager.has_recording(filename):
+        logger.info(f"{filename} is already in the database")
+        return
+
+    transcription, live_tldr = None, None
+    live_path = payload.get("live_transcription_path")
+    if live_path:
+        _finish_live_summary(live_path, job.stage)
+        tldr_path = live_path[:-len(LIVE_TRANSCRIPTION_SUFFIX)] + LIVE_TLDR_SUFFIX
+        if os.path.exists(live_path) and os.path.exists(tldr_path):
+            with open(live_path, "rb") as f:
+                transcription = parse_transcription(f)
+            with open(tldr_path) as f:
+                live_tldr = f.read()
+
+    # Upload the 16 kHz mono derivative when it is available
+    stt_filename = payload["stt_filename"]
+    if not os.path.exists(stt_filename):
+        stt_filename = payload["recording_filename"]
+
+    recording_launch_time = datetime.fromisoformat(payload["recording_launch_time"])
+    transcript = transcribe_audio(
+        stt_filename,
+        payload["speaker_records"],
+        recording_launch_time,
+        transcription=transcription,
+        tldr=live_tldr,
+        stage=job.stage,
+        raise_on_failure=not job.final_attempt
+    )
+
+    # Add to database including duration and tldr
+    with job.stage("database"):
+        db_manager.add_recording(
+            filename=filename,
+            source="slack",
+            meeting_name=payload["huddle_name"],
+            transcript=transcript.get("text"),
+            diarized_transcript=transcript.get("diarized"),
+            created_at=recording_launch_time,
+            speakers=payload["speakers"],
+            duration=payload["duration"],
+            tldr=transcript.get("tldr")
+        )
+    if live_path:
+        for path in (live_path, tldr_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SessionManager:
+    """
+    Runs a HuddleSession per huddle, at most capacity at a time.
+
+    A huddle that starts while every slot is taken waits in a queue and is
+    joined as soon as a session ends. Events for a huddle that is being
+    recorded, already queued or was left in the last REJOIN_COOLDOWN_SECONDS
+    are ignored.
+    """
+
+    def __init__(self, jobs, cookies, headless=True,
+                 capacity=MAX_CONCURRENT_HUDDLES, max_queued=MAX_QUEUED_HUDDLES):
+        """
+        Args:
+            jobs: JobQueue finished recordings are queued on
+            cookies: Callable returning the signed-in Slack cookies
+            headless: Run the session browsers without a window
+        """
+        self.jobs = jobs
+        self.cookies = cookies
+        self.headless = headless
+        self.capacity = max(capacity, 1)
+        self.max_queued = max_queued
+        self.sessions = {}
+        self.queue = deque()
+        self.left = {}
+        self.accepting = True
+        self._lock = threading.Lock()
+
+    def request(self, huddle_link):
+        """
+        Record a huddle now or once a slot is free.
+
+        Returns:
+            str: "started", "queued" or "ignored"
+        """
+        with self._lock:
+            if not self.accepting:
+                return "ignored"
+            if huddle_link in self.sessions or huddle_link in self.queue:
+                logger.info(f"Already in or waiting for huddle: {huddle_link}")
+                return "ignored"
+            if time.time() - self.left.get(huddle_link, 0) < REJOIN_COOLDOWN_SECONDS:
+                logger.info(f"Ignoring huddle left moments ago: {huddle_link}")
+                return "ignored"
+            if len(self.sessions) < self.capacity:
+                self._start(huddle_link)
+                return "started"
+            if len(self.queue) >= self.max_queued:
+                logger.warning(f"Huddle queue is full, dropping: {huddle_link}")
+                return "ignored"
+            self.queue.append(huddle_link)
+            logger.info(f"All {self.capacity} session(s) busy, queued huddle "
+                        f"{huddle_link} ({len(self.queue)} waiting)")
+            return "queued"
+
+    def release(self, session):
+        """Free a session's slot and start the next queued huddle"""
+        with self._lock:
+            if self.sessions.get(session.huddle_link) is not session:
+                return
+            del self.sessions[session.huddle_link]
+            now = time.time()
+            self.left = {link: left for link, left in self.left.items()
+                         if now - left < REJOIN_COOLDOWN_SECONDS}
+            self.left[session.huddle_link] = now
+            while self.accepting and self.queue and len(self.sessions) < self.capacity:
+                self._start(self.queue.popleft())
+
+    def _start(self, huddle_link):
+        """Start a session on its own thread. Call with the lock held."""
+        session = HuddleSession(self, huddle_link)
+        self.sessions[huddle_link] = session
+        logger.info(f"Starting session {session.id} for {huddle_link} "
+                    f"({len(self.sessions)}/{self.capacity} busy)")
+        threading.Thread(target=session.run, name=f"huddle-{session.id}",
+                         daemon=True).start()
+
+    def status(self):
+        """Sessions in progress and huddles waiting for a slot"""
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "sessions": [{"id": session.id, "huddle_link": link,
+                              "huddle_name": session.huddle_name,
+                              "recording": session.recording}
+                             for link, session in self.sessions.items()],
+                "queued": list(self.queue)
+            }
+
+    def stop_all(self):
+        """Stop accepting huddles and stop every recording in progress"""
+        with self._lock:
+            self.accepting = False
+            self.queue.clear()
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.stop_recording()
@@ -0,0 +1,255 @@
+"""
+Active speaker tracking inside the Slack huddle page.
+
+A MutationObserver injected into the peer tile list recomputes the active
+speakers whenever the tiles change; the rest of the page is only watched
+for the list and the screen share coming and going. When the page has a CDP event binding (see
+browser_events), speaker, participant, screen share and end-of-call changes
+are pushed to the recorder as they happen. Otherwise every speaker change
+is buffered with a high-resolution timestamp and the recorder drains the
+buffer with a single execute_script call every SPEAKER_DRAIN_SECONDS,
+instead of several WebDriver round-trips per tile on every poll.
+"""
+import os
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Seconds between drains of the in-page speaker buffer
+SPEAKER_DRAIN_SECONDS = float(os.getenv("SPEAKER_DRAIN_SECONDS", "1"))
+
+# Milliseconds the peer list has to stay closed before the huddle counts as
+# ended, so a re-render of the call window is not taken for the end
+CALL_ENDED_GRACE_MS = int(os.getenv("CALL_ENDED_GRACE_MS", "300"))
+
+# Installs window.__speakerCollector once per page. Times are epoch
+# milliseconds from the page's high-resolution clock.
+COLLECTOR_SCRIPT = r"""
+(function () {
+    if (window.__speakerCollector) {
+        return;
+    }
+    var ACTIVE = "p-peer_tile__active_speaker--outline";
+    var GRACE_MS = %d;
+    var events = [];
+    var metadata = {};
+    var last = "[]";
+    var participants = 0;
+    var peerList = false;
+    var names = {};
+    var screenShare = false;
+    var endTimer = null;
+    var ended = false;
+    var tileObserver = new MutationObserver(snapshot);
+    // The peer list the tile observer is attached to, undefined until the
+    // page was first looked at
+    var observedList;
+
+    function now() {
+        return performance.timeOrigin + performance.now();
+    }
+
+    function emit(type, data) {
+        return !!(window.__recorderEmit && window.__recorderEmit(type, data));
+    }
+
+    function sharing() {
+        return !!document.querySelector('[data-qa="free-willy-video-element"]');
+    }
+
+    function checkEnded() {
+        endTimer = null;
+        if (!ended && !document.querySelector(".p-peer_tile_list") && !sharing()) {
+            ended = emit("call_ended", {reason: "peer list closed"});
+        }
+    }
+
+    function snapshot() {
+        var list = document.querySelector(".p-peer_tile_list");
+        var speakers = [];
+        var present = {};
+        var added = {};
+        peerList = !!list;
+        participants = 0;
+        if (list) {
+            var tiles = list.querySelectorAll(".p-peer_tile__container");
+            for (var i = 0; i < tiles.length; i++) {
+                var tile = tiles[i];
+                if (tile.querySelector(".p-peer_tile__invite_status_overlay")) {
+                    continue;
+                }
+                participants++;
+                var label = tile.getAttribute("aria-label");
+                if (!label) {
+                    continue;
+                }
+                var name = label.split(",")[0].trim();
+                present[name] = true;
+                if (!tile.classList.contains(ACTIVE)) {
+                    continue;
+                }
+                speakers.push(name);
+                if (!(name in metadata)) {
+                    var img = tile.querySelector("img");
+                    metadata[name] = added[name] = img ? img.src : null;
+                }
+            }
+        }
+        // Peers only come and go while the list is shown
+        if (list) {
+            for (var joined in present) {
+                if (!names[joined]) {
+                    emit("participant_joined", {name: joined, count: participants});
+                }
+            }
+            for (var left in names) {
+                if (!present[left]) {
+                    emit("participant_left", {name: left, count: participants});
+                }
+            }
+            names = present;
+        }
+        speakers.sort();
+        var key = JSON.stringify(speakers);
+        if (key !== last) {
+            last = key;
+            if (!emit("speakers_changed", {speakers: speakers, metadata: added})) {
+                events.push({time: now(), speakers: speakers});
+            }
+        }
+        var share = sharing();
+        if (share !== screenShare) {
+            screenShare = share;
+            emit(share ? "screen_share_started" : "screen_share_stopped");
+        }
+        if (!list && !share && endTimer === null) {
+            endTimer = setTimeout(checkEnded, GRACE_MS);
+        }
+    }
+
+    // Speaker outlines only change inside the peer list, so attributes are
+    // only watched there; page-wide changes cost two selector lookups
+    function pageChanged() {
+        var list = document.querySelector(".p-peer_tile_list");
+        if (list !== observedList) {
+            tileObserver.disconnect();
+            observedList = list;
+            if (list) {
+                tileObserver.observe(list, {
+                    subtree: true,
+                    childList: true,
+                    attributes: true,
+                    attributeFilter: ["class", "aria-label"]
+                });
+            }
+            snapshot();
+        } else if (sharing() !== screenShare) {
+            snapshot();
+        }
+    }
+
+    function observe() {
+        new MutationObserver(pageChanged).observe(document.body, {
+            subtree: true,
+            childList: true
+        });
+        pageChanged();
+    }
+
+    window.__speakerCollector = {
+        drain: function () {
+            var drained = events;
+            events = [];
+            return {
+                events: drained,
+                now: now(),
+                participants: participants,
+                peer_list: peerList,
+                screen_share: sharing(),
+                metadata: metadata
+            };
+        }
+    };
+    // Scripts for new documents run before the body exists
+    if (document.body) {
+        observe();
+    } else {
+        document.addEventListener("DOMContentLoaded", observe);
+    }
+})();
+""" % CALL_ENDED_GRACE_MS
+
+DRAIN_SCRIPT = """
+return window.__speakerCollector ? window.__speakerCollector.drain() : null;
+"""
+
+
+def _timestamp(milliseconds):
+    return datetime.fromtimestamp(milliseconds / 1000, timezone.utc).isoformat()
+
+
+class SpeakerTracker:
+    """
+    Folds speaker changes, drained by poll() or pushed as events and passed
+    to change(), into the recorder's speaker records, speaking durations
+    and profile pictures.
+
+    Records are appended in the format the diarization expects:
+    {"timestamp": ISO 8601, "speakers": [sorted names]}.
+    """
+
+    def __init__(self, driver, speaker_records, speaker_durations, speaker_metadata):
+        self.driver = driver
+        self.speaker_records = speaker_records
+        self.speaker_durations = speaker_durations
+        self.speaker_metadata = speaker_metadata
+        self._active = []
+        self._since = None
+
+    def install(self):
+        """Inject the collector into the current page"""
+        self.driver.execute_script(COLLECTOR_SCRIPT)
+
+    def poll(self):
+        """
+        Drain the collector, reinstalling it if the page was reloaded.
+
+        Returns:
+            dict: {"participants", "peer_list", "screen_share"} as last seen
+        """
+        state = self.driver.execute_script(DRAIN_SCRIPT)
+        if state is None:
+            logger.info("Speaker collector missing, installing it")
+            self.install()
+            state = self.driver.execute_script(DRAIN_SCRIPT)
+
+        for event in state["events"]:
+            self.change(event["time"], event["speakers"])
+        self.accumulate(state["now"])
+        for name, profile_pic in state["metadata"].items():
+            self.speaker_metadata.setdefault(name, profile_pic)
+        return state
+
+    def change(self, milliseconds, speakers, metadata=None):
+        """Record the active speakers from a page time on"""
+        self.accumulate(milliseconds)
+        self.speaker_records.append({
+            "timestamp": _timestamp(milliseconds),
+            "speakers": list(speakers)
+        })
+        self._active = speakers
+        for name, profile_pic in (metadata or {}).items():
+            self.speaker_metadata.setdefault(name, profile_pic)
+
+    def accumulate(self, milliseconds):
+        """Credit the active speakers with the time since the last change"""
+        if self._since is not None:
+            # Pushed events may be a little older than the last credit
+            if milliseconds <= self._since:
+                return
+            seconds = (milliseconds - self._since) / 1000
+            for name in self._active:
+                self.speaker_durations[name] = self.speaker_durations.get(
+                    name, 0) + seconds
+        self._since = milliseconds
@@ -0,0 +1,304 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy
+import requests
+import soundfile as sf
+
+from cache import DiskCache, hash_file
+from engines import TranscriptionEngine, ENGINES
+from http_client import UploadClient
+from scheduler import bind_priority, cancellation, RequestCancelled
+from words import WordStore, TeeReader, parse_transcription, as_word_store
+
+# Engines in order of preference (elevenlabs, whisper, local, stub); later
+# ones only receive hedged requests
+STT_PROVIDERS = [name.strip() for name in os.getenv(
+    "STT_PROVIDERS", "elevenlabs,whisper").split(",") if name.strip()]
+# A hedged request goes to the next engine once the primary has taken
+# longer than this percentile of its recent latencies
+HEDGE_PERCENTILE = float(os.getenv("STT_HEDGE_PERCENTILE", "95"))
+# Latency per second of audio assumed until enough requests were observed
+HEDGE_DEFAULT_RATIO = float(os.getenv("STT_HEDGE_DEFAULT_RATIO", "0.5"))
+HEDGE_MIN_SECONDS = float(os.getenv("STT_HEDGE_MIN_SECONDS", "30"))
+LATENCY_WINDOW = 100
+LATENCY_MIN_SAMPLES = 10
+# An engine failing this many times in a row is skipped for a while
+BREAKER_FAILURES = int(os.getenv("STT_BREAKER_FAILURES", "3"))
+BREAKER_RESET_SECONDS = float(os.getenv("STT_BREAKER_RESET_SECONDS", "300"))
+# Raw engine responses are cached by audio content so reprocessing a
+# recording does not upload it again; a size of 0 disables the cache
+TRANSCRIPTION_CACHE_DIR = os.getenv(
+    "TRANSCRIPTION_CACHE_DIR", "recordings/.cache/transcriptions")
+TRANSCRIPTION_CACHE_MAX_BYTES = int(os.getenv(
+    "TRANSCRIPTION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TRANSCRIPTION_WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", "4"))
+
+transcription_cache = DiskCache(
+    TRANSCRIPTION_CACHE_DIR, TRANSCRIPTION_CACHE_MAX_BYTES)
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    After `failures` failures in a row the circuit opens and allow() refuses
+    requests for `reset_seconds`; then a single trial request is let through
+    (half-open), and its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or self._consecutive >= self.failures:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class LatencyTracker:
+    """Recent request latencies, relative to the duration of the audio"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._ratios = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, audio_seconds):
+        with self._lock:
+            self._ratios.append(seconds / max(audio_seconds, 1.0))
+
+    def deadline(self, audio_seconds):
+        """Seconds after which a request for this much audio is late"""
+        with self._lock:
+            ratios = list(self._ratios)
+        ratio = HEDGE_DEFAULT_RATIO
+        if len(ratios) >= LATENCY_MIN_SAMPLES:
+            ratio = float(numpy.percentile(ratios, HEDGE_PERCENTILE))
+        return max(HEDGE_MIN_SECONDS, ratio * audio_seconds)
+
+
+class ElevenLabsEngine(TranscriptionEngine):
+    """ElevenLabs Scribe with diarization and word timestamps"""
+
+    name = "elevenlabs"
+    url = "https://api.elevenlabs.io/v1/speech-to-text"
+    # The primary engine; a key may also be passed per request
+    available = True
+
+    def __init__(self):
+        self.api_key = os.getenv("ELEVENLABS_API_KEY")
+        # One pooled session shared by all concurrent chunk uploads
+        self.client = UploadClient(pool_size=TRANSCRIPTION_WORKERS,
+                                   rate_limit_key=self.name)
+        # Currently, only 'scribe_v1' is available as per the documentation
+        self.data = {
+            "model_id": "scribe_v1",
+            "diarize": True,
+            "language_code": "rus",
+            "timestamps_granularity": "word"
+        }
+
+    def cache_key(self, file_path):
+        # Keys predate the engine interface and are kept so cached
+        # transcriptions remain valid
+        return hash_file(file_path, self.url, *sorted(self.data.items()))
+
+    def transcribe(self, file_path, api_key=None):
+        """
+        Transcribe an audio file, returning the ElevenLabs response with its
+        words in a WordStore, or None.
+
+        The response body is parsed as it arrives and copied verbatim into
+        the transcription cache on the way.
+        """
+        headers = {"xi-api-key": api_key or self.api_key}
+        print(f"Uploading {file_path} for transcription with diarization enabled...")
+
+        try:
+            response = self.client.post_file(
+                self.url, self.data, "file", file_path, headers=headers,
+                stream=True)
+            with response:
+                response.raise_for_status()  # Raise an exception for 4XX/5XX responses
+                response.raw.decode_content = True
+                with transcription_cache.writer(self.cache_key(file_path)) as sink:
+                    return parse_transcription(TeeReader(response.raw, sink))
+        except RequestCancelled:
+            raise
+        except requests.exceptions.RequestException as e:
+            print(f"Error during API request: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                print(f"Response status code: {e.response.status_code}")
+                print(f"Response content: {e.response.text}")
+            return None
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return None
+
+
+class SpeechRouter:
+    """
+    Routes transcription requests across engines.
+
+    A cached response from any engine is returned without a request. The
+    first engine whose circuit is closed gets the request; when it has not
+    answered within the hedge deadline, or fails, the next engine gets the
+    same audio and whichever answers first wins.
+
+    The slower requests are then cancelled (see scheduler.cancellation()):
+    one still waiting for a rate-limit slot never takes it, an ElevenLabs
+    upload in progress is aborted and a response arriving later is closed
+    unread, and none of them counts against the engine's circuit breaker.
+    A request that was already sent, including any Whisper request, which
+    the OpenAI client sends in one go, is processed and billed by the
+    provider regardless, and its slot stays spent; hedging pays for that to
+    cut the latency of a stuck request.
+    """
+
+    def __init__(self, engines):
+        self.engines = [engine for engine in engines if engine.available]
+        self.breakers = {engine.name: CircuitBreaker() for engine in self.engines}
+        self.latencies = {engine.name: LatencyTracker() for engine in self.engines}
+
+    def transcribe(self, file_path, api_keys=None):
+        """
+        Transcribe an audio file with the fastest healthy engine.
+
+        Args:
+            file_path (str): Audio file to transcribe
+            api_keys (dict, optional): Engine name -> API key overrides
+
+        Returns:
+            dict: Transcription with "text" and "words" as a WordStore, or None
+        """
+        for engine in self.engines:
+            if not engine.cacheable:
+                continue
+            cache_key = engine.cache_key(file_path)
+            source = transcription_cache.open(cache_key)
+            if source is None:
+                continue
+            try:
+                with source:
+                    cached = parse_transcription(source)
+            except Exception as e:
+                transcription_cache.discard(cache_key, e)
+                continue
+            print(f"Using cached {engine.name} transcription for {file_path}")
+            return cached
+
+        candidates = [engine for engine in self.engines
+                      if self.breakers[engine.name].allow()]
+        if not candidates:
+            # Every engine is failing; try the primary rather than nothing
+            candidates = self.engines[:1]
+        if not candidates:
+            print("No speech-to-text engine is configured")
+            return None
+
+        audio_seconds = sf.info(file_path).duration
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        cancelled = threading.Event()
+        try:
+            pending = {}
+            remaining = list(candidates)
+            while remaining or pending:
+                if remaining and (not pending or not self._wait_for_deadline(
+                        pending, audio_seconds)):
+                    engine = remaining.pop(0)
+                    if pending:
+                        print(f"Hedging transcription of {file_path} to {engine.name}")
+                    future = executor.submit(
+                        bind_priority(self._call), engine, file_path,
+                        (api_keys or {}).get(engine.name), cancelled)
+                    pending[future] = engine
+                    continue
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.pop(future)
+                    result = future.result()
+                    if result is not None:
+                        return result
+            return None
+        finally:
+            # Any request still pending lost the race
+            cancelled.set()
+            executor.shutdown(wait=False)
+
+    def _wait_for_deadline(self, pending, audio_seconds):
+        """
+        Wait until the newest pending request is due or any request finishes.
+        Returns True when a request finished, False when the deadline passed.
+        """
+        future, engine = list(pending.items())[-1]
+        timeout = self.latencies[engine.name].deadline(audio_seconds)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        return bool(done)
+
+    def _call(self, engine, file_path, api_key, cancelled):
+        breaker = self.breakers[engine.name]
+        started = time.monotonic()
+        try:
+            with cancellation(cancelled):
+                result = engine.transcribe(file_path, api_key)
+        except RequestCancelled:
+            result = None
+        except Exception as e:
+            print(f"{engine.name} transcription failed: {e}")
+            result = None
+
+        if cancelled.is_set():
+            # Another engine answered first, so this one is not to blame
+            # for failing and its result is not used
+            print(f"Cancelled the {engine.name} transcription of {file_path}")
+            return None
+        if result is None:
+            breaker.record_failure()
+            return None
+        breaker.record_success()
+        self.latencies[engine.name].record(
+            time.monotonic() - started, sf.info(file_path).duration)
+        # Engines that stream into a WordStore have cached the raw response
+        if engine.cacheable and not isinstance(result.get("words"), WordStore):
+            transcription_cache.set(engine.cache_key(file_path), result)
+        return as_word_store(result)
+
+
+def create_speech_router():
+    """Build a router over the engines named in STT_PROVIDERS"""
+    known = dict(ENGINES, elevenlabs=ElevenLabsEngine)
+    return SpeechRouter([known[name]() for name in STT_PROVIDERS if name in known])
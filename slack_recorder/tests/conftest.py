@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The recorder's modules import each other, and the ones shared with the
+# other recorder, as top-level modules
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(root, "recorder_common"))
+sys.path.insert(0, os.path.join(root, "slack_recorder"))
@@ -0,0 +1,172 @@
+"""
+UploadClient retries against a local stub server.
+
+A retried upload is a second paid transcription, so only failures where
+the server cannot have processed the request may be retried.
+"""
+import os
+import time
+import socket
+import threading
+import http.server
+from collections import defaultdict
+import pytest
+import requests
+
+import http_client
+from http_client import UploadClient
+from scheduler import cancellation, RequestCancelled
+
+READ_TIMEOUT = 1.0
+# Larger than the socket buffers, so a reset arrives while the body is sent
+UPLOAD_BYTES = 8 * 2**20
+
+
+class StubUploadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Speech-to-text stand-in. The path picks how the first request is
+    answered; later requests to the same path succeed.
+    """
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.attempts[self.path] += 1
+            first = server.attempts[self.path] == 1
+        if first and self.path == "/reset":
+            # Drop the connection before reading the upload
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if self.path == "/slow-upload":
+            server.received[self.path] = self._read_slowly(
+                int(self.headers["Content-Length"]))
+            self._reply(200)
+            return
+        server.received[self.path] = self.rfile.read(
+            int(self.headers["Content-Length"]))
+        if first and self.path == "/rate-limited":
+            self._reply(429, {"Retry-After": "1"})
+        elif first and self.path == "/unavailable":
+            self._reply(503)
+        elif first and self.path == "/error":
+            self._reply(500)
+        elif self.path == "/slow":
+            time.sleep(READ_TIMEOUT + 1)
+            self._reply(200)
+        else:
+            self._reply(200)
+
+    def _read_slowly(self, length):
+        received = b""
+        while len(received) < length:
+            block = self.rfile.read(min(64 * 1024, length - len(received)))
+            if not block:
+                break
+            received += block
+            time.sleep(0.01)
+        return received
+
+    def _reply(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubUploadHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.attempts = defaultdict(int)
+    server.received = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def upload(tmp_path):
+    path = tmp_path / "upload.bin"
+    path.write_bytes(os.urandom(UPLOAD_BYTES))
+    return str(path)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF_BASE_SECONDS", 0.01)
+    return UploadClient(read_timeout=READ_TIMEOUT, max_retries=2)
+
+
+def post(client, server, upload, path):
+    return client.post_file(server.url + path, {"model_id": "stub"}, "file", upload)
+
+
+def test_upload_is_streamed_intact(client, server, upload):
+    response = post(client, server, upload, "/ok")
+    assert response.status_code == 200
+    assert server.attempts["/ok"] == 1
+    with open(upload, "rb") as f:
+        assert f.read() in server.received["/ok"]
+
+
+def test_connection_reset_during_upload_is_retried(client, server, upload):
+    response = post(client, server, upload, "/reset")
+    assert response.status_code == 200
+    assert server.attempts["/reset"] == 2
+
+
+def test_rate_limited_upload_waits_for_retry_after(client, server, upload):
+    started = time.monotonic()
+    response = post(client, server, upload, "/rate-limited")
+    assert response.status_code == 200
+    assert server.attempts["/rate-limited"] == 2
+    assert time.monotonic() - started >= 1.0
+
+
+def test_unavailable_upload_is_retried(client, server, upload):
+    response = post(client, server, upload, "/unavailable")
+    assert response.status_code == 200
+    assert server.attempts["/unavailable"] == 2
+
+
+def test_server_error_is_not_retried(client, server, upload):
+    response = post(client, server, upload, "/error")
+    assert response.status_code == 500
+    assert server.attempts["/error"] == 1
+
+
+def test_read_timeout_after_upload_is_not_retried(client, server, upload):
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        post(client, server, upload, "/slow")
+    assert server.attempts["/slow"] == 1
+
+
+def test_cancelled_upload_is_aborted(client, server, upload):
+    cancelled = threading.Event()
+    threading.Timer(0.3, cancelled.set).start()
+    started = time.monotonic()
+    with cancellation(cancelled), pytest.raises(RequestCancelled):
+        post(client, server, upload, "/slow-upload")
+    assert time.monotonic() - started < 1.0
+    assert server.attempts["/slow-upload"] == 1
+    # Give the server time to notice the dropped connection
+    time.sleep(0.2)
+    assert len(server.received.get("/slow-upload", b"")) < UPLOAD_BYTES
+
+
+def test_cancelled_request_is_not_retried(client, server, upload):
+    cancelled = threading.Event()
+    threading.Timer(0.3, cancelled.set).start()
+    started = time.monotonic()
+    with cancellation(cancelled), pytest.raises(RequestCancelled):
+        post(client, server, upload, "/rate-limited")
+    assert time.monotonic() - started < 1.0
+    assert server.attempts["/rate-limited"] == 1
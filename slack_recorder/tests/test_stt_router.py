@@ -0,0 +1,63 @@
+"""
+Hedged transcriptions cancel the request that lost the race.
+"""
+import time
+import numpy
+import pytest
+import soundfile as sf
+
+import stt_router
+from engines import TranscriptionEngine
+from scheduler import current_cancellation, RequestCancelled
+from stt_router import SpeechRouter
+
+
+class SlowEngine(TranscriptionEngine):
+    """Answers after 5 s unless its request is cancelled first"""
+
+    name = "slow"
+    cacheable = False
+
+    def __init__(self):
+        super().__init__()
+        self.cancellations = []
+
+    def transcribe(self, file_path, api_key=None):
+        cancelled = current_cancellation()
+        self.cancellations.append(cancelled)
+        if cancelled.wait(5):
+            raise RequestCancelled("cancelled")
+        return {"text": "slow", "words": []}
+
+
+class FastEngine(TranscriptionEngine):
+    name = "fast"
+    cacheable = False
+
+    def transcribe(self, file_path, api_key=None):
+        return {"text": "fast", "words": []}
+
+
+@pytest.fixture
+def audio(tmp_path):
+    path = str(tmp_path / "chunk.wav")
+    sf.write(path, numpy.zeros(16000, dtype=numpy.int16), 16000)
+    return path
+
+
+def test_hedge_winner_cancels_the_slower_request(audio, monkeypatch):
+    monkeypatch.setattr(stt_router, "HEDGE_MIN_SECONDS", 0.1)
+    monkeypatch.setattr(stt_router, "HEDGE_DEFAULT_RATIO", 0.0)
+    slow = SlowEngine()
+    router = SpeechRouter([slow, FastEngine()])
+    # As many races as it takes failures to open a circuit
+    for _ in range(stt_router.BREAKER_FAILURES):
+        assert router.transcribe(audio)["text"] == "fast"
+    assert len(slow.cancellations) == stt_router.BREAKER_FAILURES
+    for cancelled in slow.cancellations:
+        assert cancelled.wait(1)
+    # Let the cancelled requests return
+    time.sleep(0.2)
+    # Losing a race is not a failure of the slower engine
+    assert router.breakers["slow"].state == "closed"
+    assert router.breakers["slow"].allow()
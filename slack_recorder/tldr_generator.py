@@ -1,11 +1,62 @@
 import os
 import json
+import asyncio
+import threading
 import openai
-from typing import List, Dict, Any, Optional
+import tiktoken
+from typing import List, Dict, Any, Optional, Tuple
 
-# Maximum token limit for OpenAI model context window
-MAX_TOKENS = 16000  # Conservative estimate for gpt-4o context window
+from cache import DiskCache, hash_text
+from http_client import retry_after_seconds
+from scheduler import scheduler, current_priority, with_priority
+
+# Only used when the model tokenizer cannot be loaded
 TOKENS_PER_CHAR = 0.4  # Rough estimate for Russian language tokens per character
+# Tokens of transcript per summary request, leaving room for prompt and response
+CHUNK_TOKENS = int(os.getenv("TLDR_CHUNK_TOKENS", "14000"))
+# Maximum number of summary requests in flight at the same time
+TLDR_CONCURRENCY = int(os.getenv("TLDR_CONCURRENCY", "16"))
+# Rate-limited requests are queued again this many times before giving up
+RATE_LIMIT_RETRIES = int(os.getenv("TLDR_RATE_LIMIT_RETRIES", "3"))
+SUMMARY_MODEL = "gpt-4o"
+SUMMARY_TEMPERATURE = 0.3
+SUMMARY_MAX_TOKENS = 300
+SYSTEM_PROMPT = "Вы - помощник, который создает краткие и точные резюме деловых совещаний на русском языке."
+CHUNK_PROMPT = """Вот часть стенограммы совещания. Создайте краткое промежуточное резюме основных обсуждаемых тем:
+
+{text}
+
+Промежуточное резюме (на русском языке):"""
+TLDR_PROMPT = """Прочтите следующую стенограмму совещания и создайте TLDR (краткое резюме) на русском языке в 1-2 предложениях, 
+которые охватывают основные обсуждаемые темы. Перечислите ключевые темы через запятую.
+Резюме должно быть похоже на этот пример по стилю: "Интеграция пип-порта, проблемы с редиректом, работа с QR-кодом, обсуждение работы мерчантов, настройка платежной страницы."
+Не используйте кавычки в начале и конце резюме.
+
+Стенограмма:
+{text}
+
+TLDR (на русском языке):"""
+# Summaries are cached by prompt and model, with transcript text keyed
+# normalized, so regenerating a TLDR only sends the chunks whose content
+# changed, and the reduce and final requests over unchanged summaries hit
+# the cache as well. Entries unused for the TTL expire; a size of 0
+# disables the cache
+SUMMARY_CACHE_DIR = os.getenv("SUMMARY_CACHE_DIR", "recordings/.cache/summaries")
+SUMMARY_CACHE_MAX_BYTES = int(os.getenv(
+    "SUMMARY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SUMMARY_CACHE_TTL_SECONDS = float(os.getenv(
+    "SUMMARY_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+summary_cache = DiskCache(SUMMARY_CACHE_DIR, SUMMARY_CACHE_MAX_BYTES,
+                          SUMMARY_CACHE_TTL_SECONDS)
+
+# Summaries run on one background event loop with one shared client, so
+# connections are reused across meetings and callers can stay synchronous
+_loop = None
+_client = None
+_loop_lock = threading.Lock()
+# Tokenizer of SUMMARY_MODEL, False when it could not be loaded
+_encoding = None
 
 
 def generate_tldr(transcript_data: Dict[str, Any]) -> str:
@@ -18,9 +69,6 @@ def generate_tldr(transcript_data: Dict[str, Any]) -> str:
     Returns:
         str: A 1-2 sentence TLDR summary in Russian
     """
-    # Set API key and base URL if provided, otherwise use environment variables
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-
     # Extract diarized transcript
     diarized_transcript = transcript_data.get("diarized", [])
 
@@ -30,18 +78,49 @@ def generate_tldr(transcript_data: Dict[str, Any]) -> str:
     # Process transcript in chunks if needed
     tldr = process_transcript_chunks(diarized_transcript)
 
-    # Remove any wrapping quotes if present
+    return clean_tldr(tldr)
+
+
+def clean_tldr(tldr: str) -> str:
+    """Remove any wrapping quotes from a generated TLDR"""
     tldr = tldr.strip()
     if tldr.startswith('"') and tldr.endswith('"'):
         tldr = tldr[1:-1].strip()
-
     return tldr
 
 
+def run_async(coroutine):
+    """
+    Run a coroutine on the shared summary event loop and wait for it, with
+    the caller's request priority
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="tldr-loop",
+                             daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(
+        with_priority(coroutine, current_priority()), _loop).result()
+
+
+def get_client() -> openai.AsyncOpenAI:
+    """Return the shared async OpenAI client, creating it on first use"""
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"))
+    return _client
+
+
 def process_transcript_chunks(diarized_transcript: List[Dict[str, Any]]) -> str:
     """
     Process transcript in chunks if it exceeds the context window.
 
+    Chunks are summarized concurrently and the summaries are reduced to the
+    final TLDR, hierarchically when they do not fit in one prompt.
+
     Args:
         diarized_transcript: List of utterances with speaker and text
 
@@ -50,22 +129,188 @@ def process_transcript_chunks(diarized_transcript: List[Dict[str, Any]]) -> str:
     """
     # Convert transcript to a simple format for processing
     formatted_text = format_transcript_for_summary(diarized_transcript)
+    return run_async(summarize_text(formatted_text))
 
-    # If transcript is short enough, process it directly
-    if len(formatted_text) * TOKENS_PER_CHAR < MAX_TOKENS * 0.7:  # Leave room for prompt and response
-        return generate_summary_from_text(formatted_text)
 
-    # Otherwise, split into chunks and process each chunk
-    chunks = split_into_chunks(formatted_text)
-    chunk_summaries = []
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with the summary model's tokenizer, falling back to the
+    TOKENS_PER_CHAR estimate when the tokenizer cannot be loaded.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(SUMMARY_MODEL)
+        except Exception as e:
+            print(f"Could not load the {SUMMARY_MODEL} tokenizer, estimating tokens: {e}")
+            _encoding = False
+    if _encoding is False:
+        return int(len(text) * TOKENS_PER_CHAR) + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def fits_in_prompt(text: str) -> bool:
+    """Whether text leaves room for the prompt and response in one request"""
+    return count_tokens(text) <= CHUNK_TOKENS
+
+
+def pack_chunks(items: List[str], separator: str = "\n",
+                budget: Optional[int] = None,
+                measure: Optional[List[str]] = None) -> Tuple[List[str], List[float]]:
+    """
+    Pack items greedily into chunks of at most budget tokens, never
+    splitting an item; an item larger than the budget gets its own chunk.
+    Items are counted as the matching text of measure when it is given.
 
-    for chunk in chunks:
-        chunk_summary = generate_summary_from_text(chunk, is_chunk=True)
-        chunk_summaries.append(chunk_summary)
+    Returns:
+        tuple: (chunk texts, fill ratio of each chunk against the budget)
+    """
+    budget = budget or CHUNK_TOKENS
+    separator_tokens = count_tokens(separator)
+    chunks, fills = [], []
+    current, current_tokens = [], 0
+    for index, item in enumerate(items):
+        tokens = count_tokens(measure[index] if measure else item) + separator_tokens
+        if current and current_tokens + tokens > budget:
+            chunks.append(separator.join(current))
+            fills.append(current_tokens / budget)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        chunks.append(separator.join(current))
+        fills.append(current_tokens / budget)
+    return chunks, fills
+
+
+def pack_lines(lines: List[str]) -> Tuple[List[str], List[float]]:
+    """
+    Pack transcript lines into chunks, counting them as normalized lines,
+    so chunk boundaries and with them the cache keys do not move when a
+    re-diarization only renamed speakers.
+    """
+    speakers = {}
+    return pack_chunks(lines, measure=[normalize_line(line, speakers)
+                                       for line in lines])
+
+
+async def summarize_text(formatted_text: str) -> str:
+    """
+    Map-reduce summarization of a formatted transcript.
+
+    Args:
+        formatted_text: Transcript as "Speaker: text" lines
+
+    Returns:
+        str: A TLDR summary in Russian
+    """
+    semaphore = asyncio.Semaphore(TLDR_CONCURRENCY)
+
+    # If transcript is short enough, process it directly
+    if fits_in_prompt(normalize_chunk(formatted_text)):
+        return await generate_summary_from_text(formatted_text, semaphore)
+
+    # Otherwise, split into chunks and summarize them all at once
+    chunks, fills = pack_lines(formatted_text.split("\n"))
+    print(f"Summarizing {len(chunks)} chunks of up to {CHUNK_TOKENS} tokens, "
+          f"fill ratios {', '.join(f'{fill:.0%}' for fill in fills)}")
+    summaries = await asyncio.gather(*[
+        generate_summary_from_text(chunk, semaphore, is_chunk=True)
+        for chunk in chunks])
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return "Ошибка при создании TL;DR."
+
+    # Reduce groups of summaries until they fit in the final prompt
+    summaries = await reduce_to_prompt(summaries, semaphore)
+    if not summaries:
+        return "Ошибка при создании итогового TL;DR."
 
     # Combine chunk summaries into a final summary
-    combined_summary_text = "\n\n".join(chunk_summaries)
-    return generate_final_summary(combined_summary_text)
+    return await generate_final_summary("\n\n".join(summaries), semaphore)
+
+
+async def reduce_to_prompt(summaries: List[str], semaphore: asyncio.Semaphore) -> List[str]:
+    """
+    Reduce consecutive summaries in groups until all of them fit in one
+    prompt. Returns the remaining summaries, empty if every reduce failed.
+    """
+    while len(summaries) > 1 and not fits_in_prompt("\n\n".join(summaries)):
+        groups, _ = pack_chunks(summaries, separator="\n\n")
+        if len(groups) == len(summaries):
+            break
+        reduced = await asyncio.gather(*[
+            reduce_summaries(group, semaphore) for group in groups])
+        summaries = [summary for summary in reduced if summary]
+    return summaries
+
+
+async def complete(prompt: str, semaphore: asyncio.Semaphore,
+                   cache_prompt: Optional[str] = None) -> str:
+    """
+    Answer one summary request from the summary cache, or send it through
+    the shared client once the rate-limit scheduler grants it; a 429 pauses
+    the model for every caller and the request queues again.
+
+    Args:
+        cache_prompt: The prompt as it is keyed in the cache, if not prompt
+    """
+    cache_key = summary_cache_key(cache_prompt or prompt)
+    cached = summary_cache.get(cache_key)
+    if cached is not None:
+        return cached["summary"]
+    summary = await request_summary(prompt, semaphore)
+    summary_cache.set(cache_key, {"summary": summary})
+    return summary
+
+
+async def request_summary(prompt: str, semaphore: asyncio.Semaphore) -> str:
+    tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(prompt) + SUMMARY_MAX_TOKENS
+    attempt = 0
+    while True:
+        async with semaphore:
+            await scheduler.acquire_async(SUMMARY_MODEL, tokens)
+            try:
+                response = await get_client().chat.completions.create(
+                    model=SUMMARY_MODEL,
+                    messages=[
+                        {"role": "system", "content": SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=SUMMARY_TEMPERATURE,
+                    max_tokens=SUMMARY_MAX_TOKENS
+                )
+                return response.choices[0].message.content.strip()
+            except openai.RateLimitError as e:
+                if attempt >= RATE_LIMIT_RETRIES:
+                    raise
+                scheduler.penalize(SUMMARY_MODEL, retry_after_seconds(e.response))
+        attempt += 1
+
+
+def normalize_line(line: str, speakers: Dict[str, str]) -> str:
+    """
+    Transcript line with whitespace collapsed and its speaker replaced by
+    their number in order of appearance, kept in speakers
+    """
+    speaker, separator, said = line.partition(": ")
+    if separator:
+        speaker = speakers.setdefault(speaker, f"S{len(speakers)}")
+    return " ".join(f"{speaker}{separator}{said}".split())
+
+
+def normalize_chunk(text: str) -> str:
+    """
+    Transcript text as it is keyed in the summary cache, so a
+    re-diarization that only renamed speakers keeps the cached summaries
+    """
+    speakers = {}
+    return "\n".join(normalize_line(line, speakers) for line in text.split("\n"))
+
+
+def summary_cache_key(prompt: str) -> str:
+    return hash_text(prompt, SUMMARY_MODEL, SYSTEM_PROMPT,
+                     SUMMARY_TEMPERATURE, SUMMARY_MAX_TOKENS)
 
 
 def format_transcript_for_summary(diarized_transcript: List[Dict[str, Any]]) -> str:
@@ -95,89 +340,68 @@ def split_into_chunks(text: str) -> List[str]:
     Split the transcript text into chunks that fit within model context limits.
 
     Args:
-        text: Full transcript text
+        text: Full transcript text, one utterance per line
 
     Returns:
         List[str]: List of text chunks
     """
-    lines = text.split("\n")
-    chunks = []
-    current_chunk = []
-    current_length = 0
-
-    # Target tokens per chunk (conservative to leave room for prompt and response)
-    target_length = int(MAX_TOKENS * 0.7 / TOKENS_PER_CHAR)
-
-    for line in lines:
-        line_length = len(line)
-
-        # If adding this line would exceed the target length, finish the current chunk
-        if current_length + line_length > target_length and current_chunk:
-            chunks.append("\n".join(current_chunk))
-            current_chunk = [line]
-            current_length = line_length
-        else:
-            current_chunk.append(line)
-            current_length += line_length
-
-    # Add the last chunk if not empty
-    if current_chunk:
-        chunks.append("\n".join(current_chunk))
-
+    chunks, _ = pack_lines(text.split("\n"))
     return chunks
 
 
-def generate_summary_from_text(text: str, is_chunk: bool = False) -> str:
+async def generate_summary_from_text(text: str, semaphore: asyncio.Semaphore,
+                                     is_chunk: bool = False) -> Optional[str]:
     """
     Generate a summary from the formatted transcript text using OpenAI API.
 
     Args:
         text: Formatted transcript text
+        semaphore: Limits the number of concurrent requests
         is_chunk: Whether this is a chunk of a larger transcript
 
     Returns:
-        str: Generated summary
+        str: Generated summary, or None for a failed chunk
     """
-    if is_chunk:
-        prompt = f"""Вот часть стенограммы совещания. Создайте краткое промежуточное резюме основных обсуждаемых тем:
+    template = CHUNK_PROMPT if is_chunk else TLDR_PROMPT
+    try:
+        return await complete(template.format(text=text), semaphore,
+                              template.format(text=normalize_chunk(text)))
+    except Exception as e:
+        print(f"Error generating summary: {str(e)}")
+        return None if is_chunk else "Ошибка при создании TL;DR."
 
-{text}
 
-Промежуточное резюме (на русском языке):"""
-    else:
-        prompt = f"""Прочтите следующую стенограмму совещания и создайте TLDR (краткое резюме) на русском языке в 1-2 предложениях, 
-которые охватывают основные обсуждаемые темы. Перечислите ключевые темы через запятую.
-Резюме должно быть похоже на этот пример по стилю: "Интеграция пип-порта, проблемы с редиректом, работа с QR-кодом, обсуждение работы мерчантов, настройка платежной страницы."
-Не используйте кавычки в начале и конце резюме.
+async def reduce_summaries(summaries_text: str, semaphore: asyncio.Semaphore) -> Optional[str]:
+    """
+    Merge a group of intermediate summaries into one intermediate summary.
 
-Стенограмма:
-{text}
+    Args:
+        summaries_text: Combined text of consecutive chunk summaries
+        semaphore: Limits the number of concurrent requests
 
-TLDR (на русском языке):"""
+    Returns:
+        str: Merged summary, or None on failure
+    """
+    prompt = f"""Вот промежуточные резюме нескольких последовательных частей совещания. Объедините их в одно краткое промежуточное резюме основных обсуждаемых тем:
+
+{summaries_text}
+
+Промежуточное резюме (на русском языке):"""
 
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Вы - помощник, который создает краткие и точные резюме деловых совещаний на русском языке."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=300
-        )
-        summary = response.choices[0].message.content.strip()
-        return summary
+        return await complete(prompt, semaphore)
     except Exception as e:
-        print(f"Error generating summary: {str(e)}")
-        return "Ошибка при создании TL;DR."
+        print(f"Error reducing summaries: {str(e)}")
+        return None
 
 
-def generate_final_summary(chunk_summaries_text: str) -> str:
+async def generate_final_summary(chunk_summaries_text: str, semaphore: asyncio.Semaphore) -> str:
     """
     Generate a final summary from multiple chunk summaries.
 
     Args:
         chunk_summaries_text: Combined text from all chunk summaries
+        semaphore: Limits the number of concurrent requests
 
     Returns:
         str: Final TLDR summary
@@ -194,17 +418,7 @@ def generate_final_summary(chunk_summaries_text: str) -> str:
 Финальное TLDR (на русском языке):"""
 
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Вы - помощник, который создает краткие и точные резюме деловых совещаний на русском языке."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=300
-        )
-        summary = response.choices[0].message.content.strip()
-        return summary
+        return await complete(prompt, semaphore)
     except Exception as e:
         print(f"Error generating final summary: {str(e)}")
         return "Ошибка при создании итогового TL;DR."
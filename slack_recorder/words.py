@@ -0,0 +1,151 @@
+import sys
+from array import array
+import numpy
+import ijson
+
+# Provider responses are read from the network or cache in blocks of this size
+PARSE_BLOCK_BYTES = 64 * 1024
+
+
+class WordStore:
+    """
+    Columnar storage of transcript words.
+
+    Start and end times are kept in float arrays and speakers as indices
+    into speaker_ids, with word texts interned, so a multi-hour transcript
+    costs a few dozen bytes per word instead of a dict per token.
+    """
+
+    def __init__(self):
+        self.starts = array('d')
+        self.ends = array('d')
+        self.speakers = array('i')
+        self.texts = []
+        # speaker_ids[i] is the provider speaker_id of speaker index i
+        self.speaker_ids = []
+        self._speaker_index = {}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def speaker_index(self, speaker_id):
+        """Return the index of a speaker_id, adding it if it is new"""
+        index = self._speaker_index.get(speaker_id)
+        if index is None:
+            index = self._speaker_index[speaker_id] = len(self.speaker_ids)
+            self.speaker_ids.append(speaker_id)
+        return index
+
+    def append(self, text, start, end, speaker_id):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.speakers.append(self.speaker_index(speaker_id))
+        self.texts.append(sys.intern(text))
+
+    @classmethod
+    def from_words(cls, words):
+        """Build a store from provider word dicts, keeping only real words"""
+        store = cls()
+        for word in words:
+            if word.get("type", "word") == "word":
+                start = word.get("start", 0)
+                store.append(word.get("text", ""), start,
+                             word.get("end", start), word.get("speaker_id"))
+        return store
+
+    def extend(self, other, offset=0.0, speaker_suffix=""):
+        """
+        Append another store, shifting its times by offset and suffixing
+        its speaker_ids (None stays None).
+        """
+        mapping = array('i', [
+            self.speaker_index(f"{speaker_id}{speaker_suffix}" if speaker_id else speaker_id)
+            for speaker_id in other.speaker_ids])
+        self.starts.frombytes((numpy.asarray(other.starts) + offset).tobytes())
+        self.ends.frombytes((numpy.asarray(other.ends) + offset).tobytes())
+        self.speakers.extend(mapping[index] for index in other.speakers)
+        self.texts.extend(other.texts)
+
+    def truncate(self, count):
+        """Keep only the first count words"""
+        del self.starts[count:]
+        del self.ends[count:]
+        del self.speakers[count:]
+        del self.texts[count:]
+
+    def map_times(self, function):
+        """Replace start and end times with function(array of times)"""
+        if not len(self):
+            return
+        self.starts = array('d', numpy.asarray(
+            function(numpy.asarray(self.starts)), dtype=numpy.float64).tobytes())
+        self.ends = array('d', numpy.asarray(
+            function(numpy.asarray(self.ends)), dtype=numpy.float64).tobytes())
+
+    def __iter__(self):
+        """Yield (text, start, end, speaker_id) for each word"""
+        speaker_ids = self.speaker_ids
+        for text, start, end, speaker in zip(self.texts, self.starts,
+                                             self.ends, self.speakers):
+            yield text, start, end, speaker_ids[speaker]
+
+    def words(self):
+        """Yield the words as provider-style dicts"""
+        for text, start, end, speaker_id in self:
+            yield {"text": text, "type": "word", "start": start, "end": end,
+                   "speaker_id": speaker_id}
+
+
+class TeeReader:
+    """File wrapper that copies everything read from source to a sink"""
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data and self.sink is not None:
+            self.sink.write(data)
+        return data
+
+
+def parse_transcription(source):
+    """
+    Parse an ElevenLabs-shaped JSON transcription from a binary file
+    incrementally. Words go straight into a WordStore and spacing and other
+    non-word tokens are dropped, so the full word list is never built.
+
+    Returns:
+        dict: {"text", "words": WordStore}
+    """
+    store = WordStore()
+    # Each coroutine runs the C parser over the same blocks and only builds
+    # the objects under its prefix
+    words = ijson.sendable_list()
+    texts = ijson.sendable_list()
+    parsers = [ijson.items_coro(words, "words.item", use_float=True),
+               ijson.items_coro(texts, "text")]
+    while True:
+        block = source.read(PARSE_BLOCK_BYTES)
+        if not block:
+            break
+        for parser in parsers:
+            parser.send(block)
+        for word in words:
+            if word.get("type", "word") == "word":
+                start = word.get("start", 0)
+                store.append(word.get("text", ""), start,
+                             word.get("end", start), word.get("speaker_id"))
+        del words[:]
+    for parser in parsers:
+        parser.close()
+    return {"text": (texts[0] if texts else None) or "", "words": store}
+
+
+def as_word_store(transcription):
+    """Return the transcription with its word list converted to a WordStore"""
+    if transcription is not None and not isinstance(transcription.get("words"), WordStore):
+        transcription = dict(transcription)
+        transcription["words"] = WordStore.from_words(transcription.get("words") or [])
+    return transcription